@@ -4,8 +4,9 @@ from django.utils.encoding import smart_str
 from django.core.cache import cache
 from django.conf import settings
 
-from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache.invalidate import CACHE_DELETER, model_label
 from ella.core.cache.utils import normalize_key
+from ella.core.cache.regenerate import get_recipe_key
 from ella.core.conf import core_settings
 
 
@@ -106,12 +107,28 @@ class Box(object):
         rend = cache.get(key)
         if rend is None:
             rend = self._render()
-            cache.set(key, rend, core_settings.CACHE_TIMEOUT)
-            for model, test in self.get_cache_tests():
-                CACHE_DELETER.register_test(model, test, key)
-            CACHE_DELETER.register_pk(self.obj, key)
+            self.store(key, rend)
         return rend
 
+    def store(self, key, rend):
+        " Cache rendered box and register it for invalidation (and regeneration). "
+        cache.set(key, rend, core_settings.CACHE_TIMEOUT)
+        for model, test in self.get_cache_tests():
+            CACHE_DELETER.register_test(model, test, key)
+        CACHE_DELETER.register_pk(self.obj, key)
+        if core_settings.BOX_REGENERATE_THREADS and not self.can_double_render:
+            cache.set(get_recipe_key(key), self.get_recipe(), core_settings.BOX_RECIPE_TIMEOUT)
+
+    def get_recipe(self):
+        " Return what is needed to render the box again, see ella.core.cache.regenerate. "
+        return {
+            'model': model_label(self.obj),
+            'pk': self.obj.pk,
+            'box_type': self.box_type,
+            'params': self.params.lists(),
+            'template_name': self.template_name,
+        }
+
     def double_render(self):
         if self.template_name:
             t_name = self.template_name
@@ -1,13 +1,54 @@
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+"""
+Cache invalidation bus.
 
+Every cached entry that should be invalidated when some object changes is
+registered via ``CACHE_DELETER`` (``register_pk``, ``register_test`` and
+``register_dependency``), every save and delete of any model is propagated
+the same way. The messages are small dictionaries carrying just the model
+label, primary key and field values, they are collected and sent in batches
+(``CI_BATCH_SIZE`` or at the end of request) using a pluggable transport:
+
+    ``ella.core.cache.invalidate.LocalTransport``
+        register lives in the memory of the current process, messages are
+        processed immediately, no daemon is needed. Suitable for single
+        process deployments and development.
+
+    ``ella.core.cache.invalidate.FileQueueTransport``
+        messages are appended to ``CI_QUEUE_FILE``, ``cacheinvalidator``
+        management command consumes them.
+
+    ``ella.core.cache.invalidate.StompTransport``
+        messages are sent to ActiveMQ (``ACTIVE_MQ_HOST``, ``ACTIVE_MQ_PORT``,
+        ``CI_AMQ_DESTINATION``), ``cacheinvalidator`` management command
+        consumes them.
+
+The transport is selected by ``CI_TRANSPORT`` setting, ``StompTransport`` is
+used when only ``ACTIVE_MQ_HOST`` is set.
+
+The register is kept by a storage from ``ella.core.cache.storage``. Large
+sites can run several ``cacheinvalidator`` processes with ``--shard``, each
+handling the models with matching hash; this needs a transport delivering
+all messages to every process (``StompTransport`` with a topic).
+"""
+import os
+import time
 import logging
-from django.dispatch import dispatcher
-from django.db.models import signals
+import atexit
+from binascii import crc32
+from threading import Lock
+
+import anyjson
+
+from django.db.models import signals, TextField
+from django.core import signals as core_signals
+from django.utils.encoding import smart_unicode
+from django.utils.importlib import import_module
+from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from ella.core.conf import core_settings
+from ella.core.cache.storage import get_storage, get_field_terms, REGISTER_KEY, DEPS_KEY
+
 
 log = logging.getLogger('cache')
 
@@ -15,81 +56,374 @@ AMQ_DESTINATION = getattr(settings, 'CI_AMQ_DESTINATION', '/topic/ella')
 AMQ_HOST = getattr(settings, 'ACTIVE_MQ_HOST', None)
 AMQ_PORT = getattr(settings, 'ACTIVE_MQ_PORT', 61613)
 
+CI_TRANSPORT = getattr(settings, 'CI_TRANSPORT', AMQ_HOST and 'ella.core.cache.invalidate.StompTransport' or None)
+CI_BATCH_SIZE = getattr(settings, 'CI_BATCH_SIZE', 100)
+CI_QUEUE_FILE = getattr(settings, 'CI_QUEUE_FILE', None)
 
-class MsgWrapper(object):
-    pass
 
-class CacheDeleter(object):
+
+def model_label(model):
+    " Return 'app_label.model' string identifying given model class or instance. "
+    if isinstance(model, basestring):
+        return model
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
+
+def dump_instance(instance):
+    """
+    Return field values of given instance that invalidation tests can refer
+    to - all local fields by their attname, except for potentially large
+    text fields.
+    """
+    fields = {}
+    for f in instance._meta.fields:
+        if isinstance(f, TextField):
+            continue
+        value = getattr(instance, f.attname)
+        if value is not None:
+            value = smart_unicode(value)
+        fields[f.attname] = value
+    return fields
+
+
+def get_shard(model, shards):
+    " Return index of the invalidator shard responsible for given model. "
+    return (crc32(model_label(model)) & 0xffffffff) % shards
+
+
+class InvalidationRegister(object):
+    """
+    Register of cache keys and the conditions under which they should be
+    invalidated. Consumes messages produced by CacheDeleter.
+
+    When ``shard`` (tuple of index and number of shards) is given, only
+    messages for models belonging to this shard (see ``get_shard``) are
+    processed. Dependencies are only kept by the shards that can invalidate
+    their source key - the key was registered for one of their models or is
+    itself a dependency of such key.
+    """
+    def __init__(self, persistent=True, regenerator=None, storage=None, shard=None):
+        if storage is None:
+            storage = get_storage(persistent)
+        self.storage = storage
+        self.regenerator = regenerator
+        self.shard = shard
+
+    def owns(self, model):
+        if not self.shard:
+            return True
+        index, shards = self.shard
+        return get_shard(model, shards) == index
+
+    def process(self, messages):
+        " Process a batch of messages sent by CacheDeleter. "
+        for msg in messages:
+            type = msg['type']
+            if type == 'dep':
+                if not self.shard or self.storage.has_key(msg['key']):
+                    self.register_dependency(msg['key'], msg['dst'])
+            elif type not in ('pk', 'test', 'del'):
+                log.warning('CI: unknown message type %r.' % type)
+            elif not self.owns(msg['model']):
+                continue
+            elif type == 'pk':
+                self.append_pk(msg['model'], msg['pk'], msg['key'])
+            elif type == 'test':
+                self.append_test(msg['model'], msg['test'], msg['key'])
+            elif type == 'del':
+                self.run(msg['model'], msg['pk'], msg['fields'])
+        self.storage.commit()
+
+    def append_test(self, model, test, key):
+        " Append invalidation test to _registry "
+        self.storage.add_test(model, test, key)
+        if self.shard:
+            self.storage.add_key(key)
+        log.debug('CI appended test - model: %s, test: %s, key: %s' % (model, test, key))
+
+    def append_pk(self, model, pk, key):
+        " Append PK to _registry "
+        self.storage.add_pk(model, smart_unicode(pk), key)
+        if self.shard:
+            self.storage.add_key(key)
+
+    def register_dependency(self, src_key, dst_key):
+        self.storage.add_dependency(src_key, dst_key)
+        if self.shard:
+            self.storage.add_key(dst_key)
+        log.debug('CI register dependency, src: %s, dst: %s' % (src_key, dst_key))
+
+    def _check_test(self, fields, test_str):
+        " Check test params on instance's field values "
+
+        log.debug('Trying test "%s" for %s.' % (test_str, fields))
+
+        if not test_str:
+            return True
+
+        # Parse string
+        for subtest in test_str.split(';'):
+            attr = subtest.split(':')
+            if not (smart_unicode(fields.get(attr[0].strip())) == attr[1].strip()):
+                return False
+        log.debug('CI True test(s) %s on %s.' % (test_str, fields))
+        return True
+
+    def run(self, model, pk, fields):
+        " Process cache invalidation PKs and tests "
+
+        log.debug('CI start processing invalidation sender: %s, pk: %s.' % (model, pk))
+
+        pk = smart_unicode(pk)
+        for key in self.storage.pop_pk(model, pk):
+            self.invalidate(model, key, from_test=False)
+
+        fields = dict(fields, pk=pk)
+        invalidated = set()
+        for key, test in self.storage.get_tests(model, get_field_terms(fields)):
+            if key not in invalidated and self._check_test(fields, test):
+                invalidated.add(key)
+                self.storage.remove_tests(model, key)
+                self.invalidate(model, key)
+
+    def invalidate(self, sender, key, from_test=True):
+        " Invalidate cache key and all keys depending on it. "
+        from ella.core.cache.utils import delete_cached_object
+
+        keys = [key]
+        seen = set()
+        while keys:
+            key = keys.pop(0)
+            if key in seen:
+                continue
+            seen.add(key)
+
+            delete_cached_object(key, auto_normalize=False)
+            log.debug('CI invalidate key "%s".' % key)
+            if self.regenerator is not None:
+                self.regenerator.schedule(key)
+
+            # Process cache dependencies
+            keys.extend(self.storage.pop_dependencies(key))
+            if self.shard:
+                self.storage.remove_key(key)
+
+
+class Transport(object):
+    " Base class for CacheDeleter transports. "
+    # every listening process receives all messages (needed for sharding)
+    broadcast = False
+
+    def send(self, messages):
+        " Deliver a batch of messages to the invalidator. "
+        raise NotImplementedError()
+
+    def listen(self, register):
+        " Block and feed incoming messages to register (used by the cacheinvalidator command). "
+        raise NotImplementedError()
+
+class LocalTransport(Transport):
+    " Process messages right away within the current process. "
     def __init__(self):
-        self.signal_handler = self
-        self.conn = None
+        regenerator = None
+        if core_settings.BOX_REGENERATE_THREADS:
+            from ella.core.cache.regenerate import BoxRegenerator
+            regenerator = BoxRegenerator()
+        self.register = InvalidationRegister(persistent=False, regenerator=regenerator)
 
-    def on_error(self, header, message):
-        " Log AMQ/stomp error message "
-        log.error('AMQ: %s' % header)
+    def send(self, messages):
+        self.register.process(messages)
 
-    def on_disconnected(self):
-        log.error('AMQ: Connection was lost!')
+    def listen(self, register):
+        raise ImproperlyConfigured('LocalTransport needs no cacheinvalidator daemon.')
 
-    def _send(self, msg, type, key=None, model=None):
-        " Send message to AMQ "
+class FileQueueTransport(Transport):
+    """
+    Append batches of messages to a file (one JSON list per line), the
+    consumer atomically reads and truncates it. Both sides hold an exclusive
+    lock on the file while working with it.
+    """
+    def __init__(self, path=None, poll_interval=1):
+        self.path = path or CI_QUEUE_FILE
+        if not self.path:
+            raise ImproperlyConfigured('FileQueueTransport requires CI_QUEUE_FILE setting.')
+        self.poll_interval = poll_interval
+
+    def send(self, messages):
+        import fcntl
+        data = anyjson.serialize(messages) + '\n'
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(data)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def receive(self):
+        " Read and remove all batches currently waiting in the queue. "
+        import fcntl
+        if not os.path.exists(self.path):
+            return []
+        f = open(self.path, 'r+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            lines = f.readlines()
+            f.seek(0)
+            f.truncate()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+        batches = []
+        for line in lines:
+            try:
+                batches.append(anyjson.deserialize(line))
+            except ValueError:
+                log.error('CI: broken message in queue %s: %r' % (self.path, line))
+        return batches
+
+    def listen(self, register):
+        while True:
+            batches = self.receive()
+            for messages in batches:
+                register.process(messages)
+            if not batches:
+                time.sleep(self.poll_interval)
+
+class StompTransport(Transport):
+    " Send batches of messages as JSON bodies via ActiveMQ. "
+    def __init__(self, host=None, port=None, destination=None):
+        self.host = host or AMQ_HOST
+        self.port = port or AMQ_PORT
+        self.destination = destination or AMQ_DESTINATION
+        self.broadcast = self.destination.startswith('/topic/')
+        self.conn = None
+
+    def connect(self):
+        import stomp
+        self.conn = stomp.Connection([(self.host, self.port)])
+        self.conn.start()
+        self.conn.connect()
+
+    def disconnect(self):
         if self.conn:
-            headers = {'Type': type, 'Key': key, 'Model': model}
-            self.conn.send(msg, headers=headers, destination=AMQ_DESTINATION)
+            self.conn.stop()
+            self.conn = None
+
+    def send(self, messages):
+        if self.conn is None:
+            self.connect()
+        self.conn.send(anyjson.serialize(messages), headers={'type': 'batch'}, destination=self.destination)
+
+    def listen(self, register):
+        import stomp
+
+        class Listener(object):
+            def on_error(self, headers, message):
+                log.error('ActiveMQ/Stomp on_error')
+
+            def on_disconnected(self):
+                log.error('CI: Connection was lost!')
+
+            def on_message(self, headers, message):
+                register.process(anyjson.deserialize(message))
+
+        conn = stomp.Connection([(self.host, self.port)])
+        conn.add_listener(Listener())
+        conn.start()
+        conn.connect()
+        conn.subscribe(destination=self.destination, ack='auto')
+        log.info('CI now listen on "%s"' % self.destination)
+        try:
+            while True:
+                time.sleep(1)
+        finally:
+            conn.unsubscribe(destination=self.destination)
+            conn.stop()
+
+def get_transport(path=None):
+    " Instantiate transport class given by its dotted path (defaults to CI_TRANSPORT). "
+    path = path or CI_TRANSPORT
+    module, attr = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module), attr)()
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Error loading cache invalidation transport %s: "%s"' % (path, e))
+
+
+class CacheDeleter(object):
+    """
+    Collect invalidation messages and send them in batches through the
+    transport. Without a transport all messages are dropped.
+    """
+    def __init__(self, transport=None, batch_size=CI_BATCH_SIZE):
+        self.transport = transport
+        self.batch_size = batch_size
+        self._queue = []
+        self._lock = Lock()
+
+    def _send(self, msg):
+        if self.transport is None:
+            return
+        self._lock.acquire()
+        try:
+            self._queue.append(msg)
+            full = len(self._queue) >= self.batch_size
+        finally:
+            self._lock.release()
+        if full:
+            self.flush()
+
+    def flush(self, **kwargs):
+        " Send all queued messages. Called at the end of each request. "
+        self._lock.acquire()
+        try:
+            messages, self._queue = self._queue, []
+        finally:
+            self._lock.release()
+        if not messages:
+            return
+        try:
+            self.transport.send(messages)
+        except Exception, e:
+            log.error('CI: cannot send %d messages: %s' % (len(messages), e))
 
     def register_test(self, model, test, key):
-        self._send(test, 'test', key, model)
+        self._send({'type': 'test', 'model': model_label(model), 'test': test, 'key': key})
 
     def register_pk(self, instance, key):
-        msg = pickle.dumps(instance)
-        self._send(msg, 'pk', key)
+        self._send({'type': 'pk', 'model': model_label(instance), 'pk': instance._get_pk_val(), 'key': key})
 
     def register_dependency(self, src_key, obj_key):
-        self._send('', 'dep', src_key, obj_key)
+        self._send({'type': 'dep', 'key': src_key, 'dst': obj_key})
 
-    def propagate_signal(self, sender, instance):
+    def propagate_signal(self, sender, instance, **kwargs):
         """
-        Trap the pre_save and pre_delete signal and
+        Trap the post_save and post_delete signal and
         invalidate the relative cache entries.
         """
         # log about received signal
         log.debug('Signal from "%s" received.' % sender)
-        try:
-            # propagate the signal to Cache Invalidator
-            self._send(pickle.dumps(instance), 'del')
-        except:
-            log.error('Can not send message to AMQ.')
-
-    def connect(self, *args, **kwargs):
-
-        # initialize connection to ActiveMQ
-        self.conn = stomp.Connection(*args, **kwargs)
-        self.conn.start()
-        self.conn.connect()
-
-    def disconnect(self):
-        self.conn.stop()
+        pk = instance._get_pk_val()
+        fields = dump_instance(instance)
+        # objects registered under parent models (Publishable for Article) share the pk
+        for model in [instance.__class__] + list(instance._meta.get_parent_list()):
+            self._send({'type': 'del', 'model': model_label(model), 'pk': pk, 'fields': fields})
 
 CACHE_DELETER = CacheDeleter()
 
 
-if AMQ_HOST:
+if CI_TRANSPORT:
     try:
-        import stomp
-        import socket
-
-        # check connection to defined AMQ
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((AMQ_HOST, AMQ_PORT))
-        s.close()
-
-        # connection checked, connect CACHE_DELETER
-        CACHE_DELETER.connect([(AMQ_HOST, AMQ_PORT)])
+        CACHE_DELETER.transport = get_transport()
 
         # start listening for any model
-        dispatcher.connect(CACHE_DELETER.propagate_signal, signal=signals.post_save)
-        dispatcher.connect(CACHE_DELETER.propagate_signal, signal=signals.post_delete)
+        signals.post_save.connect(CACHE_DELETER.propagate_signal, dispatch_uid='ella.core.cache.invalidate')
+        signals.post_delete.connect(CACHE_DELETER.propagate_signal, dispatch_uid='ella.core.cache.invalidate')
+        core_signals.request_finished.connect(CACHE_DELETER.flush, dispatch_uid='ella.core.cache.invalidate')
+        atexit.register(CACHE_DELETER.flush)
         log.debug('Start listening for any model')
-    except:
-        log.warning('ActiveMQ not running')
+    except ImproperlyConfigured, e:
+        log.warning('Cache invalidation disabled: %s' % e)
 
@@ -0,0 +1,138 @@
+"""
+Eager regeneration of invalidated boxes.
+
+With ``BOX_REGENERATE_THREADS`` set, every rendered ``Box`` stores a recipe
+(object, box type and parameters) next to its cached HTML. When the cache
+invalidator deletes the box or any box it depends on, the keys are handed
+to ``BoxRegenerator`` which renders them again in background threads so
+that the next request finds them in the cache.
+
+Boxes are re-rendered with no request, in a context filled only by the
+request independent context processors (``BOX_REGENERATE_CONTEXT_PROCESSORS``
+that are enabled in ``TEMPLATE_CONTEXT_PROCESSORS``), boxes that need
+request specific data (``can_double_render``) are never regenerated.
+"""
+import logging
+from Queue import Queue, Empty
+from threading import Thread, Lock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.http import HttpRequest
+from django.template import Context, NodeList
+from django.utils.datastructures import MultiValueDict
+from django.utils.importlib import import_module
+
+from ella.core.conf import core_settings
+
+
+log = logging.getLogger('ella.core.cache.regenerate')
+
+KEY_FORMAT_RECIPE = 'ella.core.box.recipe:%s'
+
+def get_recipe_key(key):
+    return KEY_FORMAT_RECIPE % key
+
+def get_regenerate_context(key):
+    """
+    Return context for rendering box cached under ``key`` outside of a
+    request with the same values of the request independent context
+    processors as on the front end.
+    """
+    context = Context({core_settings.BOX_INFO: key})
+    request = HttpRequest()
+    for path in settings.TEMPLATE_CONTEXT_PROCESSORS:
+        if path in core_settings.BOX_REGENERATE_CONTEXT_PROCESSORS:
+            module, attr = path.rsplit('.', 1)
+            context.update(getattr(import_module(module), attr)(request))
+    return context
+
+def regenerate_box(key):
+    """
+    Render the box cached under ``key`` again and store it. Return False if
+    there is nothing to do - the box is already cached, its recipe has
+    expired or its object no longer exists.
+    """
+    from ella.core.box import Box
+    from ella.core.cache.invalidate import CACHE_DELETER
+    from ella.core.cache.utils import get_cached_object
+
+    if cache.get(key) is not None:
+        return False
+
+    recipe = cache.get(get_recipe_key(key))
+    if recipe is None:
+        return False
+
+    model = models.get_model(*recipe['model'].split('.'))
+    try:
+        obj = get_cached_object(model, pk=recipe['pk'])
+    except model.DoesNotExist:
+        return False
+
+    box = getattr(obj, 'box_class', Box)(obj, recipe['box_type'], NodeList())
+    box.params = MultiValueDict(dict(recipe['params']))
+    box.template_name = recipe['template_name']
+    if box.get_cache_key() != key:
+        log.warning('Recipe for box %s renders different box %s, skipping.' % (key, box.get_cache_key()))
+        return False
+
+    # nested boxes will register their dependencies on this one
+    box._context = get_regenerate_context(key)
+    box.store(key, box._render())
+    CACHE_DELETER.flush()
+    return True
+
+class BoxRegenerator(object):
+    """
+    Queue of invalidated box keys processed by a pool of threads. Each key
+    is queued at most once until it is picked up by a worker.
+    """
+    def __init__(self, threads=None):
+        self.queue = Queue()
+        self._pending = set()
+        self._lock = Lock()
+
+        if threads is None:
+            threads = core_settings.BOX_REGENERATE_THREADS
+        for i in range(threads):
+            t = Thread(target=self.work, name='BoxRegenerator-%d' % i)
+            t.setDaemon(True)
+            t.start()
+
+    def schedule(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        finally:
+            self._lock.release()
+        self.queue.put(key)
+
+    def regenerate(self, key):
+        self._lock.acquire()
+        try:
+            self._pending.discard(key)
+        finally:
+            self._lock.release()
+
+        try:
+            if regenerate_box(key):
+                log.debug('Box %s regenerated.' % key)
+        except Exception, e:
+            log.error('Cannot regenerate box %s: %s' % (key, e))
+
+    def work(self):
+        while True:
+            self.regenerate(self.queue.get())
+
+    def process_queue(self):
+        " Regenerate all queued boxes in the current thread. "
+        while True:
+            try:
+                key = self.queue.get_nowait()
+            except Empty:
+                return
+            self.regenerate(key)
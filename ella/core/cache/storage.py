@@ -0,0 +1,217 @@
+"""
+Storage engines for the cache invalidation register (see
+``ella.core.cache.invalidate.InvalidationRegister``).
+
+Every storage keeps three indexes:
+
+    * ``(model, pk) -> keys`` for keys registered via ``register_pk``
+    * ``(model, first term of the test) -> (key, test)`` for keys registered
+      via ``register_test``, where term is the ``field:value`` part of the
+      test before the first ``;``
+    * ``src key -> dst keys`` for dependencies
+    * set of keys a sharded register can invalidate, see
+      ``InvalidationRegister``
+
+Changes are made incrementally and written out by ``commit()`` that the
+register calls once for every batch of messages.
+
+    ``MemoryStorage``
+        plain dictionaries, optionally pickled into the cache under
+        ``CI_REGISTER_KEY`` and ``CI_DEPS_KEY`` (suffixed by the shard
+        index) on commit.
+
+    ``SQLiteStorage``
+        local SQLite database given by ``CI_STORAGE_PATH``, survives
+        restarts and cache evictions and only writes the changed rows.
+"""
+import logging
+
+from django.conf import settings
+from django.utils.encoding import smart_unicode
+
+
+log = logging.getLogger('cache')
+
+REGISTER_KEY = getattr(settings, 'CI_REGISTER_KEY', 'ella_ci_register')
+DEPS_KEY = getattr(settings, 'CI_DEPS_KEY', 'ella_ci_deps')
+CI_STORAGE_PATH = getattr(settings, 'CI_STORAGE_PATH', None)
+
+
+def get_test_term(test):
+    " Return the first ``field:value`` term of invalidation test. "
+    if not test:
+        return u''
+    attr = test.split(';', 1)[0].split(':', 1)
+    return u':'.join(a.strip() for a in attr)
+
+def get_field_terms(fields):
+    " Return all terms that can match the given field values. "
+    terms = set(u'%s:%s' % (k, smart_unicode(v)) for k, v in fields.items())
+    terms.add(u'')
+    return terms
+
+
+class MemoryStorage(object):
+    def __init__(self, persistent=False, suffix=''):
+        self.persistent = persistent
+        self.register_key = REGISTER_KEY + suffix
+        self.deps_key = DEPS_KEY + suffix
+        self._pks = {}
+        self._tests = {}
+        self._deps = {}
+        self._keys = set()
+        self._changed = False
+
+        if persistent:
+            self._load()
+
+    def _load(self):
+        from django.core.cache import cache
+        r = cache.get(self.register_key)
+        if isinstance(r, dict) and 'pks' in r and 'tests' in r:
+            self._pks, self._tests = r['pks'], r['tests']
+            self._keys = r.get('keys', set())
+            log.info('CI: I have loaded existing register from cache.')
+        d = cache.get(self.deps_key)
+        if isinstance(d, dict):
+            self._deps = d
+            log.info('CI: I have loaded existing dependencies from cache.')
+
+    def commit(self):
+        if self.persistent and self._changed:
+            from django.core.cache import cache
+            cache.set(self.register_key, {'pks': self._pks, 'tests': self._tests, 'keys': self._keys})
+            cache.set(self.deps_key, self._deps)
+        self._changed = False
+
+    def add_pk(self, model, pk, key):
+        keys = self._pks.setdefault(model, {}).setdefault(pk, [])
+        if key not in keys:
+            keys.append(key)
+            self._changed = True
+
+    def pop_pk(self, model, pk):
+        keys = self._pks.get(model, {}).pop(pk, [])
+        if keys:
+            self._changed = True
+        return keys
+
+    def add_test(self, model, test, key):
+        tests = self._tests.setdefault(model, {}).setdefault(get_test_term(test), {}).setdefault(key, [])
+        if test not in tests:
+            tests.append(test)
+            self._changed = True
+
+    def get_tests(self, model, terms):
+        out = []
+        by_term = self._tests.get(model, {})
+        for term in terms:
+            for key, tests in by_term.get(term, {}).items():
+                out.extend((key, test) for test in tests)
+        return out
+
+    def remove_tests(self, model, key):
+        for tests in self._tests.get(model, {}).values():
+            if key in tests:
+                del tests[key]
+                self._changed = True
+
+    def add_dependency(self, src, dst):
+        dsts = self._deps.setdefault(src, [])
+        if dst not in dsts:
+            dsts.append(dst)
+            self._changed = True
+
+    def pop_dependencies(self, src):
+        dsts = self._deps.pop(src, [])
+        if dsts:
+            self._changed = True
+        return dsts
+
+    def add_key(self, key):
+        if key not in self._keys:
+            self._keys.add(key)
+            self._changed = True
+
+    def has_key(self, key):
+        return key in self._keys
+
+    def remove_key(self, key):
+        if key in self._keys:
+            self._keys.remove(key)
+            self._changed = True
+
+class SQLiteStorage(object):
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS pks (model TEXT, pk TEXT, key TEXT, PRIMARY KEY (model, pk, key))',
+        'CREATE TABLE IF NOT EXISTS tests (model TEXT, term TEXT, key TEXT, test TEXT, PRIMARY KEY (model, term, key, test))',
+        'CREATE INDEX IF NOT EXISTS tests_key ON tests (model, key)',
+        'CREATE TABLE IF NOT EXISTS deps (src TEXT, dst TEXT, PRIMARY KEY (src, dst))',
+        'CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY)',
+    )
+
+    def __init__(self, path=None):
+        import sqlite3
+        self.path = path or CI_STORAGE_PATH
+        # messages can be delivered by a thread of the transport
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        for sql in self.SCHEMA:
+            self.conn.execute(sql)
+        self.conn.commit()
+        log.info('CI: using register stored in %s.' % self.path)
+
+    def commit(self):
+        self.conn.commit()
+
+    def add_pk(self, model, pk, key):
+        self.conn.execute('INSERT OR IGNORE INTO pks VALUES (?, ?, ?)', (model, pk, key))
+
+    def pop_pk(self, model, pk):
+        keys = [r[0] for r in self.conn.execute('SELECT key FROM pks WHERE model = ? AND pk = ?', (model, pk))]
+        if keys:
+            self.conn.execute('DELETE FROM pks WHERE model = ? AND pk = ?', (model, pk))
+        return keys
+
+    def add_test(self, model, test, key):
+        self.conn.execute('INSERT OR IGNORE INTO tests VALUES (?, ?, ?, ?)', (model, get_test_term(test), key, test))
+
+    def get_tests(self, model, terms):
+        terms = list(terms)
+        return [tuple(r) for r in self.conn.execute(
+                'SELECT key, test FROM tests WHERE model = ? AND term IN (%s)' % ', '.join(['?'] * len(terms)),
+                [model] + terms
+            )]
+
+    def remove_tests(self, model, key):
+        self.conn.execute('DELETE FROM tests WHERE model = ? AND key = ?', (model, key))
+
+    def add_dependency(self, src, dst):
+        self.conn.execute('INSERT OR IGNORE INTO deps VALUES (?, ?)', (src, dst))
+
+    def pop_dependencies(self, src):
+        dsts = [r[0] for r in self.conn.execute('SELECT dst FROM deps WHERE src = ?', (src, ))]
+        if dsts:
+            self.conn.execute('DELETE FROM deps WHERE src = ?', (src, ))
+        return dsts
+
+    def add_key(self, key):
+        self.conn.execute('INSERT OR IGNORE INTO keys VALUES (?)', (key, ))
+
+    def has_key(self, key):
+        return self.conn.execute('SELECT 1 FROM keys WHERE key = ?', (key, )).fetchone() is not None
+
+    def remove_key(self, key):
+        self.conn.execute('DELETE FROM keys WHERE key = ?', (key, ))
+
+def get_storage(persistent=True, path=None, shard=None):
+    """
+    Return SQLiteStorage for persistent register if ``path`` or
+    ``CI_STORAGE_PATH`` is given, MemoryStorage otherwise. Every ``shard``
+    (index) gets its own database file or cache keys.
+    """
+    path = path or CI_STORAGE_PATH
+    suffix = shard is not None and '.%d' % shard or ''
+    if persistent and path:
+        return SQLiteStorage(path + suffix)
+    return MemoryStorage(persistent, suffix)
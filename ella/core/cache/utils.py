@@ -1,6 +1,13 @@
 from hashlib import md5
+from threading import local, Lock
+import time
 import logging
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 from django.db.models import ObjectDoesNotExist, signals
 from django.core.cache import cache
 from django.http import Http404
@@ -9,20 +16,239 @@ from django.utils.encoding import smart_str
 from django.conf import settings
 
 from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.conf import core_settings
 
 
 log = logging.getLogger('ella.core.cache.utils')
 
 KEY_FORMAT_LIST = 'ella.core.cache.utils.get_cached_list'
 KEY_FORMAT_OBJECT = 'ella.core.cache.utils.get_cached_object'
+KEY_FORMAT_GENERATION = 'ella.core.cache.utils.generation:%s'
 CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 10*60)
 
 
+class LocalCache(object):
+    """
+    Bounded in-process cache with a timeout on every entry. When full, the
+    least recently used entries are culled. Values are stored pickled so that
+    no two threads ever share the same instance.
+    """
+    def __init__(self, max_entries, timeout, cull_frequency=4):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.cull_frequency = cull_frequency
+        self.hits = self.misses = 0
+        self._data = {}
+        self._tick = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            try:
+                expires, value, tick = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._tick += 1
+            self._data[key] = (expires, value, self._tick)
+            self.hits += 1
+        finally:
+            self._lock.release()
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._lock.acquire()
+        try:
+            if key not in self._data and len(self._data) >= self.max_entries:
+                self._cull()
+            self._tick += 1
+            self._data[key] = (time.time() + timeout, value, self._tick)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def _cull(self):
+        " Drop the least recently used fraction of entries, caller must hold the lock. "
+        now = time.time()
+        for key, (expires, value, tick) in self._data.items():
+            if expires < now:
+                del self._data[key]
+        if len(self._data) < self.max_entries:
+            return
+        by_tick = sorted(self._data.items(), key=lambda item: item[1][2])
+        for key, item in by_tick[:max(1, len(by_tick) // self.cull_frequency)]:
+            del self._data[key]
+
+# process-wide L1 cache, disabled unless CACHE_LOCAL_MAX_ENTRIES is set
+if core_settings.CACHE_LOCAL_MAX_ENTRIES:
+    PROCESS_CACHE = LocalCache(core_settings.CACHE_LOCAL_MAX_ENTRIES, core_settings.CACHE_LOCAL_TIMEOUT)
+else:
+    PROCESS_CACHE = None
+
+# request-scoped L1 cache, only active between start_request_cache() and end_request_cache()
+_request = local()
+
+def start_request_cache():
+    " Activate request-scoped cache for current thread (see RequestCacheMiddleware). "
+    _request.cache = {}
+    _request.stats = {'hits': 0, 'misses': 0}
+
+def end_request_cache():
+    " Deactivate request-scoped cache for current thread and return its hit/miss counters. "
+    stats = get_request_cache_stats()
+    _request.cache = None
+    _request.stats = None
+    return stats
+
+def get_request_cache_stats():
+    """
+    Return dictionary with number of lookups served from the local caches
+    (``hits``) and sent over to django's cache (``misses``) during current
+    request, None if the request-scoped cache is not active.
+    """
+    stats = getattr(_request, 'stats', None)
+    if stats is None:
+        return None
+    return stats.copy()
+
+def _cache_get(key):
+    " Look the key up in the L1 caches before going to django's cache. "
+    rc = getattr(_request, 'cache', None)
+    if rc is not None and key in rc:
+        _request.stats['hits'] += 1
+        return rc[key]
+
+    value = None
+    if PROCESS_CACHE is not None:
+        value = PROCESS_CACHE.get(key)
+
+    if value is None:
+        if rc is not None:
+            _request.stats['misses'] += 1
+        value = cache.get(key)
+        if value is not None and PROCESS_CACHE is not None:
+            PROCESS_CACHE.set(key, value)
+    elif rc is not None:
+        _request.stats['hits'] += 1
+
+    if rc is not None and value is not None:
+        rc[key] = value
+    return value
+
+def _cache_get_many(keys):
+    " Multi-key version of _cache_get, one round-trip to django's cache for all the L1 misses. "
+    rc = getattr(_request, 'cache', None)
+    found = {}
+    missing = []
+    for key in keys:
+        if rc is not None and key in rc:
+            found[key] = rc[key]
+            continue
+        value = None
+        if PROCESS_CACHE is not None:
+            value = PROCESS_CACHE.get(key)
+        if value is None:
+            missing.append(key)
+        else:
+            found[key] = value
+
+    if rc is not None:
+        _request.stats['hits'] += len(found)
+        _request.stats['misses'] += len(missing)
+
+    if missing:
+        fetched = cache.get_many(missing)
+        if PROCESS_CACHE is not None:
+            for key, value in fetched.iteritems():
+                PROCESS_CACHE.set(key, value)
+        found.update(fetched)
+
+    if rc is not None:
+        rc.update(found)
+    return found
+
+def _cache_set(key, value, timeout):
+    cache.set(key, value, timeout)
+    rc = getattr(_request, 'cache', None)
+    if rc is not None:
+        rc[key] = value
+    if PROCESS_CACHE is not None:
+        PROCESS_CACHE.set(key, value, timeout)
+
+def _cache_set_many(data, timeout):
+    cache.set_many(data, timeout)
+    rc = getattr(_request, 'cache', None)
+    if rc is not None:
+        rc.update(data)
+    if PROCESS_CACHE is not None:
+        for key, value in data.iteritems():
+            PROCESS_CACHE.set(key, value, timeout)
+
+def _cache_delete(key):
+    cache.delete(key)
+    rc = getattr(_request, 'cache', None)
+    if rc is not None:
+        rc.pop(key, None)
+    if PROCESS_CACHE is not None:
+        PROCESS_CACHE.delete(key)
+
+class SoftExpiringValue(object):
+    """
+    Cached value together with the time it should be refreshed at. The
+    entry itself lives in the cache CACHE_STALE_TIMEOUT seconds longer so
+    that stale value can be served while one process recomputes it.
+    """
+    def __init__(self, value, refresh_at):
+        self.value = value
+        self.refresh_at = refresh_at
+
+def _unwrap(key, value):
+    """
+    Return the cached value or None if the caller should recompute it. Only
+    the first caller to see a stale value gets None (and has to refresh the
+    cache), everybody else is served the stale value in the meantime.
+    """
+    if not isinstance(value, SoftExpiringValue):
+        return value
+    if value.refresh_at > time.time():
+        return value.value
+    if cache.add('ella.core.cache.utils.refresh_lock:' + key, 1, core_settings.CACHE_REFRESH_TIMEOUT):
+        log.debug('Refreshing stale cache key %s.' % key)
+        return None
+    return value.value
+
+def _cache_get_fresh(key):
+    return _unwrap(key, _cache_get(key))
+
+def _cache_set_fresh(key, value, timeout):
+    _cache_set(key, SoftExpiringValue(value, time.time() + timeout), timeout + core_settings.CACHE_STALE_TIMEOUT)
+
 def delete_cached_object(key, auto_normalize=True):
     """ proxy function for direct object deletion from cache. May be implemented through ActiveMQ in future. """
     if auto_normalize:
         key = normalize_key(key)
-    cache.delete(key)
+    _cache_delete(key)
 
 def normalize_key(key):
     return md5(key).hexdigest()
@@ -57,11 +283,11 @@ def get_cached_list(model, *args, **kwargs):
 
     key = _get_key(KEY_FORMAT_LIST, model, kwargs)
 
-    l = cache.get(key)
+    l = _cache_get_fresh(key)
     if l is None:
         log.debug('get_cached_list(model=%s), object not cached.' % str(model))
         l = list(model._default_manager.filter(*args, **kwargs))
-        cache.set(key, l, CACHE_TIMEOUT)
+        _cache_set_fresh(key, l, CACHE_TIMEOUT)
         for o in l:
             CACHE_DELETER.register_pk(o, key)
         #CACHE_DELETER.register_test(model, lambda x: model._default_manager.filter(**kwargs).filter(pk=x._get_pk_val()) == 1, key)
@@ -84,13 +310,161 @@ def get_cached_object(model, **kwargs):
 
     key = _get_key(KEY_FORMAT_OBJECT, model, kwargs)
 
-    obj = cache.get(key)
+    obj = _cache_get_fresh(key)
     if obj is None:
         obj = model._default_manager.get(**kwargs)
-        cache.set(key, obj, CACHE_TIMEOUT)
+        _cache_set_fresh(key, obj, CACHE_TIMEOUT)
         CACHE_DELETER.register_pk(obj, key)
     return obj
 
+def get_cached_objects(model, pks):
+    """
+    Return a list of cached objects identified by ``pks``, in the same order.
+    All the objects are looked up in the cache using one ``get_many`` call,
+    only the missing ones are retrieved from the database (single ``pk__in``
+    query) and stored back to the cache via ``set_many``. Objects are cached
+    under the same keys as ``get_cached_object(model, pk=pk)`` uses.
+
+    Params:
+        model - Model class ContentType instance representing the model's class
+        pks - list of primary keys to retrieve
+
+    Primary keys that do not exist in the database are silently skipped.
+    """
+    if isinstance(model, ContentType):
+        model = model.model_class()
+
+    keys = {}
+    for pk in pks:
+        if pk not in keys:
+            keys[pk] = _get_key(KEY_FORMAT_OBJECT, model, {'pk': pk})
+
+    cached = _cache_get_many(keys.values())
+    objects = {}
+    missing = []
+    for pk, key in keys.iteritems():
+        obj = _unwrap(key, cached.get(key))
+        if obj is None:
+            missing.append(pk)
+        else:
+            objects[pk] = obj
+
+    if missing:
+        log.debug('get_cached_objects(model=%s), %d objects not cached.' % (str(model), len(missing)))
+        # match the objects to the pks as they were requested (int vs. string)
+        requested = {}
+        for pk in missing:
+            requested.setdefault(smart_str(pk), []).append(pk)
+
+        to_cache = {}
+        for obj in model._default_manager.filter(pk__in=missing):
+            for pk in requested.get(smart_str(obj.pk), ()):
+                objects[pk] = obj
+                to_cache[keys[pk]] = obj
+        refresh_at = time.time() + CACHE_TIMEOUT
+        _cache_set_many(
+                dict((key, SoftExpiringValue(obj, refresh_at)) for key, obj in to_cache.iteritems()),
+                CACHE_TIMEOUT + core_settings.CACHE_STALE_TIMEOUT
+            )
+        for key, obj in to_cache.iteritems():
+            CACHE_DELETER.register_pk(obj, key)
+
+    return [objects[pk] for pk in pks if pk in objects]
+
+def prefetch_generic_targets(objects, ct_attname, pk_attname, cache_attr):
+    """
+    Resolve generic relations of given objects in bulk - the related objects
+    are grouped by content type and each group is retrieved using a single
+    ``get_cached_objects`` call. Results are stored on the objects under
+    ``cache_attr`` so that subsequent access doesn't hit the cache again.
+
+    Params:
+        objects - list of instances that hold the generic relation
+        ct_attname - name of the attribute with ContentType id
+        pk_attname - name of the attribute with the related object's pk
+        cache_attr - name of the attribute to store the related object to
+    """
+    by_ct = {}
+    for o in objects:
+        if hasattr(o, cache_attr):
+            continue
+        ct_id = getattr(o, ct_attname, None)
+        if ct_id:
+            by_ct.setdefault(ct_id, []).append(o)
+
+    for ct_id, objs in by_ct.iteritems():
+        ct = ContentType.objects.get_for_id(ct_id)
+        targets = dict((smart_str(t.pk), t) for t in get_cached_objects(ct, [getattr(o, pk_attname) for o in objs]))
+        for o in objs:
+            setattr(o, cache_attr, targets.get(smart_str(getattr(o, pk_attname)), None))
+
+def prefetch_foreign_key(objects, name):
+    """
+    Resolve ForeignKey called ``name`` for all the ``objects`` with one
+    ``get_cached_objects`` call. Return list of the related objects.
+    """
+    if not objects:
+        return []
+    f = objects[0]._meta.get_field(name)
+    cache_name = f.get_cache_name()
+    attname = f.get_attname()
+
+    missing = [o for o in objects if not hasattr(o, cache_name) and getattr(o, attname) is not None]
+    if missing:
+        related = dict((smart_str(r.pk), r) for r in get_cached_objects(f.rel.to, [getattr(o, attname) for o in missing]))
+        for o in missing:
+            setattr(o, cache_name, related.get(smart_str(getattr(o, attname)), None))
+
+    return [getattr(o, cache_name) for o in objects if getattr(o, cache_name, None) is not None]
+
+def prefetch_generic_foreign_key(objects, name):
+    """
+    Resolve CachedGenericForeignKey (or GenericForeignKey) called ``name``
+    for all the ``objects`` with one cache round-trip per content type.
+    """
+    if not objects:
+        return
+    opts = objects[0]._meta
+    for f in opts.virtual_fields:
+        if f.name == name:
+            break
+    else:
+        raise AttributeError('%s has no generic foreign key %r' % (opts.object_name, name))
+    ct_attname = opts.get_field(f.ct_field).get_attname()
+    prefetch_generic_targets(objects, ct_attname, f.fk_field, f.cache_attr)
+
+def get_generations(namespaces):
+    """
+    Return current generation numbers of given namespaces as a list (in the
+    same order). Cache keys that fold in the generations of all the
+    namespaces they depend on are effectively invalidated by
+    ``bump_generation``, without having to know the keys.
+
+    Generations start at current timestamp so that a namespace evicted from
+    the cache doesn't start reusing old keys.
+    """
+    keys = [KEY_FORMAT_GENERATION % ns for ns in namespaces]
+    found = cache.get_many(keys)
+    gens = []
+    for key in keys:
+        gen = found.get(key)
+        if gen is None:
+            gen = int(time.time())
+            if not cache.add(key, gen, core_settings.CACHE_GENERATION_TIMEOUT):
+                gen = cache.get(key, gen)
+            found[key] = gen
+        gens.append(gen)
+    return gens
+
+def bump_generation(*namespaces):
+    " Start new generation for given namespaces, see get_generations. "
+    for ns in namespaces:
+        key = KEY_FORMAT_GENERATION % ns
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time()), core_settings.CACHE_GENERATION_TIMEOUT)
+
 def get_cached_object_or_404(model, **kwargs):
     """
     Shortcut that will raise Http404 if there is no object matching the query
@@ -108,13 +482,13 @@ def cache_this(key_getter, invalidator=None, timeout=CACHE_TIMEOUT):
             key = key_getter(func, *args, **kwargs)
             if key is not None:
                 key = normalize_key(key)
-                result = cache.get(key)
+                result = _cache_get_fresh(key)
             else:
                 result = None
             if result is None:
                 log.debug('cache_this(key=%s), object not cached.' % key)
                 result = func(*args, **kwargs)
-                cache.set(key, result, timeout)
+                _cache_set_fresh(key, result, timeout)
                 if invalidator:
                     invalidator(key, *args, **kwargs)
             return result
@@ -4,18 +4,49 @@ from django.utils.datetime_safe import datetime
 # caching
 CACHE_TIMEOUT = 10*60
 CACHE_TIMEOUT_LONG = 60*60
+# process-wide in-memory cache in front of django's cache, 0 to disable
+CACHE_LOCAL_MAX_ENTRIES = 0
+CACHE_LOCAL_TIMEOUT = 10
+# how long after the timeout stale values can be served while being recomputed
+CACHE_STALE_TIMEOUT = 5*60
+# how long one process has to recompute a stale value before another one tries
+CACHE_REFRESH_TIMEOUT = 10
+# lifetime of generation counters used to invalidate groups of keys
+CACHE_GENERATION_TIMEOUT = 30*24*60*60
+# how long can the number of listings used for pagination be out of date
+CACHE_LISTING_COUNT_TIMEOUT = 10*60
 
 # Box
 BOX_INFO = 'ella.core.box.BOX_INFO'
 MEDIA_KEY = 'ella.core.box.MEDIA_KEY'
+# number of threads re-rendering invalidated boxes in the invalidator, 0 to disable
+BOX_REGENERATE_THREADS = 0
+BOX_RECIPE_TIMEOUT = 24*60*60
+# context processors (not depending on the request) applied to regenerated boxes,
+# only those also present in TEMPLATE_CONTEXT_PROCESSORS are used
+BOX_REGENERATE_CONTEXT_PROCESSORS = (
+    'django.core.context_processors.media',
+    'django.core.context_processors.static',
+    'django.core.context_processors.i18n',
+)
+
+# how often processes check whether their in-memory category tree is outdated
+CATEGORY_TREE_CHECK_INTERVAL = 5
 
 CATEGORY_LISTINGS_PAGINATE_BY = 20
+# paginate category archives by cursors instead of page numbers
+CATEGORY_LISTINGS_KEYSET_PAGINATION = False
 DEFAULT_LISTING_PRIORITY = 0
 USE_PRIORITIES = False
 LISTING_UNIQUE_DEFAULT_SET = 'unique_set_default'
 PUBLISH_FROM_WHEN_EMPTY = datetime(3000, 1, 1)
 LISTING_USE_COMMERCIAL_FLAG = False
 
+# buffer hits in memory and write them every N seconds, 0 to write every hit
+HITCOUNT_FLUSH_INTERVAL = 0
+# max number of placements in hit buffer before it is flushed
+HITCOUNT_BUFFER_SIZE = 500
+
 # context_processor
 MEDIA_URL = ''
 STATIC_URL = MEDIA_URL
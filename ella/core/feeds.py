@@ -4,7 +4,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.http import Http404
 from django.conf import settings
 
-from ella.core.models import Listing, Category
+from ella.core.models import Listing, Category, prefetch_listings
 from ella.core.views import get_content_type
 from ella.core.cache.utils import get_cached_object, get_cached_object_or_404
 from ella.core.conf import core_settings
@@ -62,7 +62,7 @@ class RSSTopCategoryListings(Feed):
         if kwa['category'].tree_parent != None:
             kwa['children'] = Listing.objects.ALL
 
-        return Listing.objects.get_listing(count=core_settings.RSS_NUM_IN_FEED, **kwa)
+        return prefetch_listings(Listing.objects.get_listing(count=core_settings.RSS_NUM_IN_FEED, **kwa))
 
     def link(self, obj):
         if isinstance(obj, tuple):
@@ -0,0 +1,70 @@
+from datetime import datetime
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ella.core.models import Listing, Category
+
+
+class Command(BaseCommand):
+    help = 'Compare the single-query and the python-merge implementations of Listing.objects.get_listing on current data.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--category',
+            dest='category',
+            default=None,
+            help='tree_path of the category to list, all listings are used if omitted'),
+        make_option('--children',
+            dest='children',
+            default=Listing.objects.ALL,
+            type='int',
+            help='NONE (0), IMMEDIATE (1) or ALL (2) - defaults to ALL'),
+        make_option('--count',
+            dest='count',
+            default=10,
+            type='int',
+            help='Number of listings on a page'),
+        make_option('--pages',
+            dest='pages',
+            default='1,10,50',
+            help='Comma separated list of pages to fetch'),
+        make_option('--repeat',
+            dest='repeat',
+            default=3,
+            type='int',
+            help='Number of repetitions, the best time is reported'),
+        )
+
+    def measure(self, func, repeat):
+        best = None
+        for i in range(repeat):
+            start = time()
+            result = func()
+            duration = time() - start
+            if best is None or duration < best:
+                best = duration
+        return best, result
+
+    def handle(self, *args, **options):
+        category = None
+        if options['category'] is not None:
+            try:
+                category = Category.objects.get(tree_path=options['category'])
+            except Category.DoesNotExist:
+                raise CommandError('Category with tree_path %r does not exist.' % options['category'])
+
+        now = datetime.now()
+        qset = Listing.objects.get_listing_queryset(category, options['children'], now=now)
+        print 'Listings in queryset: %d' % qset.count()
+
+        count = options['count']
+        for page in map(int, options['pages'].split(',')):
+            offset = (page - 1) * count
+            limit = offset + count
+            merged_time, merged = self.measure(lambda: Listing.objects.get_merged_listing(qset, now, offset, limit, set()), options['repeat'])
+            ordered_time, ordered = self.measure(lambda: Listing.objects.get_ordered_listing(qset, now, offset, limit), options['repeat'])
+            print 'page %4d: merged %8.4fs, ordered %8.4fs%s' % (
+                    page, merged_time, ordered_time,
+                    merged != ordered and ' (RESULTS DIFFER)' or ''
+                )
@@ -1,15 +1,20 @@
 from datetime import datetime, timedelta
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from copy import copy
+from threading import Lock
+from time import time
 
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 from django.db.models import F, Q
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import smart_str
 
-from ella.core.cache import cache_this
-from ella.core.cache.invalidate import CACHE_DELETER
+from ella.core.cache import cache_this, get_cached_object, get_generations, bump_generation
 from ella.core.conf import core_settings
 
+qn = connection.ops.quote_name
+
 
 class RelatedManager(models.Manager):
     def get_related_for_object(self, obj, count, mods=[], only_from_same_site=True):
@@ -79,19 +84,87 @@ class RelatedManager(models.Manager):
         return related
 
 
-def invalidate_listing(key, self, *args, **kwargs):
-    CACHE_DELETER.register_test(self.model, '', key)
-
-def get_listings_key(func, self, category=None, count=10, offset=1, mods=[], content_types=[], **kwargs):
+def get_listing_namespaces(category=None, mods=[], content_types=[]):
+    """
+    Return generation namespaces a listing depends on - the category if
+    given, content types if listing objects of some models from all
+    categories, everything otherwise.
+    """
+    if category:
+        return ['category:%d' % category.id]
+    if mods or content_types:
+        ct_ids = [ContentType.objects.get_for_model(m).pk for m in mods] + [getattr(ct, 'pk', ct) for ct in content_types]
+        return ['content_type:%s' % ct_id for ct_id in ct_ids]
+    return ['listings']
+
+def invalidate_listings(category_ids, ct_id=None):
+    """
+    Bump generations of all namespaces that listings of objects of the given
+    content type in the given categories could be cached under - the
+    categories, all their ancestors (for listings with children), the
+    content type and the global one.
+    """
+    from ella.core.models import Category
+    namespaces = set(['listings'])
+    if ct_id:
+        namespaces.add('content_type:%s' % ct_id)
+    for cat_id in category_ids:
+        while cat_id and 'category:%d' % cat_id not in namespaces:
+            namespaces.add('category:%d' % cat_id)
+            try:
+                cat_id = get_cached_object(Category, pk=cat_id).tree_parent_id
+            except Category.DoesNotExist:
+                break
+    bump_generation(*namespaces)
+
+def _get_listing_params_key(category, mods, content_types, kwargs):
     c = category and  category.id or ''
 
-    return 'ella.core.managers.ListingManager.get_listing:%s:%d:%d:%s:%s:%s' % (
-            c, count, offset,
+    return '%s:%s:%s:%s:%s' % (
+            c,
             ','.join(str(model._meta) for model in mods),
             ','.join(map(str, content_types)),
             ','.join(':'.join((k, smart_str(v))) for k, v in kwargs.items()),
+            ','.join(map(str, get_generations(get_listing_namespaces(category, mods, content_types)))),
     )
 
+def get_listings_key(func, self, category=None, count=10, offset=1, mods=[], content_types=[], **kwargs):
+    return 'ella.core.managers.ListingManager.get_listing:%d:%d:%s' % (
+            count, offset, _get_listing_params_key(category, mods, content_types, kwargs)
+    )
+
+def get_listings_after_key(func, self, cursor=None, count=10, category=None, mods=[], content_types=[], **kwargs):
+    return 'ella.core.managers.ListingManager.get_listing_after:%s:%d:%s' % (
+            cursor or '', count, _get_listing_params_key(category, mods, content_types, kwargs)
+    )
+
+def get_listing_count_key(func, self, category=None, mods=[], content_types=[], **kwargs):
+    return 'ella.core.managers.ListingManager.get_listing_count:%s' % _get_listing_params_key(category, mods, content_types, kwargs)
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S'
+
+def encode_listing_cursor(listing):
+    """
+    Return an opaque string pointing just after ``listing`` in a listing
+    ordered by ``(publish_from, id)``, see ``ListingManager.get_listing_after``.
+    """
+    d = listing.publish_from
+    return urlsafe_b64encode('%s.%06d:%d' % (d.strftime(CURSOR_DATE_FORMAT), d.microsecond, listing.pk))
+
+def decode_listing_cursor(cursor):
+    """
+    Return ``(publish_from, id)`` tuple encoded in ``cursor``, raise
+    ``ValueError`` if the cursor is malformed.
+    """
+    try:
+        value = urlsafe_b64decode(str(cursor))
+        date, pk = value.split(':')
+        date, microsecond = date.split('.')
+        publish_from = datetime.strptime(date, CURSOR_DATE_FORMAT).replace(microsecond=int(microsecond))
+        return publish_from, int(pk)
+    except (TypeError, ValueError, UnicodeEncodeError), e:
+        raise ValueError('Invalid listing cursor %r: %s' % (cursor, e))
+
 class PlacementManager(models.Manager):
     def get_query_set(self, *args, **kwargs):
         qset = super(PlacementManager, self).get_query_set(*args, **kwargs).select_related('publishable')
@@ -135,10 +208,10 @@ class ListingManager(models.Manager):
                 qset = qset.filter(category=category)
             elif children == self.IMMEDIATE:
                 # this category and its children
-                qset = qset.filter(models.Q(category__tree_parent=category) | models.Q(category=category))
+                qset = qset.filter(category__in=category.get_tree().get_children(category.pk, include_self=True))
             elif children == self.ALL:
                 # this category and all its descendants
-                qset = qset.filter(category__tree_path__startswith=category.tree_path, category__site=category.site_id)
+                qset = qset.filter(category__in=category.get_tree().get_descendants(category.pk, include_self=True))
 
             else:
                 raise AttributeError('Invalid children value (%s) - should be one of (%s, %s, %s)' % (children, self.NONE, self.IMMEDIATE, self.ALL))
@@ -149,7 +222,7 @@ class ListingManager(models.Manager):
 
         return qset.exclude(publish_to__lt=now)
 
-    @cache_this(get_listings_key, invalidate_listing)
+    @cache_this(get_listings_key)
     def get_listing(self, category=None, children=NONE, count=10, offset=1, mods=[], content_types=[], unique=None, **kwargs):
         """
         Get top objects for given category and potentionally also its child categories.
@@ -163,28 +236,6 @@ class ListingManager(models.Manager):
             [unique] - set of already listed Placement IDs
             **kwargs - rest of the parameter are passed to the queryset unchanged
         """
-        def mark_before_output(output):
-            for l in output:
-                listed_targets.add(l.placement_id)
-
-        def make_items_unique(qset):
-
-            out = []
-            listed_targets_now = set()
-            for l in qset:
-                tgt = l.placement_id
-                if tgt in listed_targets or tgt in listed_targets_now:
-                    continue
-                listed_targets_now.add(tgt)
-                out.append(l)
-                if len(out) == limit:
-                    result = out[offset:limit]
-                    mark_before_output(result)
-                    return result
-            mark_before_output(out)
-            return out
-
-        # TODO try to write  SQL (.extra())
         assert offset > 0, "Offset must be a positive integer"
         assert count >= 0, "Count must be a positive integer"
 
@@ -200,32 +251,88 @@ class ListingManager(models.Manager):
         offset -= 1
         limit = offset + count
 
-        # take out unwanted objects
+        # already listed placements have to be skipped in python
         if unique:
-            listed_targets = unique.copy()
+            return self.get_merged_listing(qset, now, offset, limit, unique.copy())
+
+        return self.get_ordered_listing(qset, now, offset, limit)
+
+    def order_by_priority(self, qset, now):
+        """
+        Order listings by their effective priority - ``priority_value`` while
+        the priority override is active, ``DEFAULT_LISTING_PRIORITY`` otherwise.
+        The ordering is equivalent to listing modded-up objects first, then the
+        objects with default priority and modded-down objects last.
+        """
+        table = qn(self.model._meta.db_table)
+        column = lambda name: '%s.%s' % (table, qn(self.model._meta.get_field(name).column))
+        effective_priority = 'CASE WHEN %(value)s IS NOT NULL AND %(from)s IS NOT NULL AND %(from)s <= %%s AND %(to)s >= %%s THEN %(value)s ELSE %%s END' % {
+                'value': column('priority_value'),
+                'from': column('priority_from'),
+                'to': column('priority_to'),
+            }
+        return qset.extra(
+                select={'effective_priority': effective_priority},
+                select_params=(now, now, core_settings.DEFAULT_LISTING_PRIORITY)
+            ).order_by('-effective_priority', '-publish_from', '-id')
+
+    def get_ordered_listing(self, qset, now, offset, limit):
+        """
+        Return ``limit - offset`` listings using a single ordered query.
+        Only ids and placement ids are read from the database to skip
+        duplicate placements, full objects are then loaded just for the
+        returned page.
+        """
+        if core_settings.USE_PRIORITIES:
+            qset = self.order_by_priority(qset, now)
+            fields = ('id', 'placement', 'effective_priority')
         else:
-            listed_targets = set([])
-
-        # only use priorities if somebody wants them
-        if not core_settings.USE_PRIORITIES:
-            return make_items_unique(qset)[offset:limit]
-
-        # listings with active priority override
-        active = models.Q(
-                    priority_value__isnull=False,
-                    priority_from__isnull=False,
-                    priority_from__lte=now,
-                    priority_to__gte=now
-        )
+            qset = qset.order_by('-publish_from', '-id')
+            fields = ('id', 'placement')
+
+        ids = []
+        listed_targets = set()
+        start = 0
+        while len(ids) < limit:
+            rows = list(qset.values_list(*fields)[start:start + limit])
+            for row in rows:
+                if row[1] in listed_targets:
+                    continue
+                listed_targets.add(row[1])
+                ids.append(row[0])
+            if len(rows) < limit:
+                break
+            start += limit
 
-        qsets = (
-            # modded-up objects
-            qset.filter(active, priority_value__gt=core_settings.DEFAULT_LISTING_PRIORITY).order_by('-priority_value', '-publish_from'),
-            # default priority
-            qset.exclude(active).order_by('-publish_from'),
-            # modded-down priority
-            qset.filter(active, priority_value__lt=core_settings.DEFAULT_LISTING_PRIORITY).order_by('-priority_value', '-publish_from'),
-        )
+        ids = ids[offset:limit]
+        objects = self.in_bulk(ids)
+        return [objects[i] for i in ids if i in objects]
+
+    def get_merged_listing(self, qset, now, offset, limit, listed_targets):
+        """
+        Return ``limit - offset`` listings by iterating through the listings
+        in python, skipping placements present in ``listed_targets``.
+        """
+        if core_settings.USE_PRIORITIES:
+            # listings with active priority override
+            active = models.Q(
+                        priority_value__isnull=False,
+                        priority_from__isnull=False,
+                        priority_from__lte=now,
+                        priority_to__gte=now
+            )
+
+            qsets = (
+                # modded-up objects
+                qset.filter(active, priority_value__gt=core_settings.DEFAULT_LISTING_PRIORITY).order_by('-priority_value', '-publish_from'),
+                # default priority, either without active override or set explicitly
+                qset.exclude(active, priority_value__gt=core_settings.DEFAULT_LISTING_PRIORITY).exclude(
+                        active, priority_value__lt=core_settings.DEFAULT_LISTING_PRIORITY).order_by('-publish_from'),
+                # modded-down priority
+                qset.filter(active, priority_value__lt=core_settings.DEFAULT_LISTING_PRIORITY).order_by('-priority_value', '-publish_from'),
+            )
+        else:
+            qsets = (qset, )
 
         out = []
 
@@ -240,7 +347,64 @@ class ListingManager(models.Manager):
                 out.append(l)
                 if len(out) == limit:
                     return out[offset:limit]
-        return out[offset:offset + count]
+        return out[offset:limit]
+
+    @cache_this(get_listings_after_key)
+    def get_listing_after(self, cursor=None, count=10, category=None, children=NONE, mods=[], content_types=[], **kwargs):
+        """
+        Get ``count`` listings published before the one ``cursor`` points to.
+        Listings are ordered by ``(publish_from, id)`` only so that any page
+        can be fetched by an index seek regardless of its depth, priorities
+        are not taken into account.
+
+        Returns tuple ``(listings, next_cursor)`` where ``next_cursor`` is
+        None on the last page. Placements are only unique within one page.
+
+        Params are the same as for ``get_listing``, raises ``ValueError``
+        for invalid cursor.
+        """
+        assert count > 0, "Count must be a positive integer"
+
+        now = datetime.now()
+        if 'now' in kwargs:
+            now = kwargs.pop('now')
+        qset = self.get_listing_queryset(category, children, mods, content_types, now, **kwargs).order_by('-publish_from', '-id')
+
+        if cursor:
+            publish_from, pk = decode_listing_cursor(cursor)
+        else:
+            publish_from = None
+
+        out = []
+        listed_targets = set()
+        # fetch one extra listing to find out if there is a next page
+        while len(out) <= count:
+            q = qset
+            if publish_from:
+                q = q.filter(Q(publish_from__lt=publish_from) | Q(publish_from=publish_from, id__lt=pk))
+            wanted = count + 1 - len(out)
+            rows = list(q[:wanted])
+            for l in rows:
+                if l.placement_id not in listed_targets:
+                    listed_targets.add(l.placement_id)
+                    out.append(l)
+            if len(rows) < wanted:
+                break
+            publish_from, pk = rows[-1].publish_from, rows[-1].pk
+
+        if len(out) > count:
+            return out[:count], encode_listing_cursor(out[count - 1])
+        return out, None
+
+    @cache_this(get_listing_count_key, timeout=core_settings.CACHE_LISTING_COUNT_TIMEOUT)
+    def get_listing_count(self, category=None, children=NONE, mods=[], content_types=[], **kwargs):
+        """
+        Return number of listings matching the parameters of ``get_listing``.
+        The count is cached for ``CACHE_LISTING_COUNT_TIMEOUT`` seconds (or
+        until listings in the category change) and may be out of date until
+        then.
+        """
+        return self.get_listing_queryset(category, children, mods, content_types, **kwargs).count()
 
     def get_queryset_wrapper(self, kwargs):
         return ListingQuerySetWrapper(self, kwargs)
@@ -261,7 +425,7 @@ class ListingQuerySetWrapper(object):
 
     def count(self):
         if not hasattr(self, '_count'):
-            self._count = self.manager.get_listing_queryset(**self._kwargs).count()
+            self._count = self.manager.get_listing_count(**self._kwargs)
         return self._count
 
 
@@ -270,19 +434,152 @@ def get_top_objects_key(func, self, count, days=None, mods=[]):
             settings.SITE_ID, count, str(days), ','.join('.'.join(str(model._meta) for model in mods))
         )
 
+class HitCountBuffer(object):
+    """
+    Per-process buffer of hits that were not yet written to the database,
+    see ``HitCountManager.hit``.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._hits = {}
+        self._last_flush = time()
+
+    def add(self, placement_id, hits=1):
+        """
+        Buffer ``hits`` for placement, return True if the buffer should be
+        flushed.
+        """
+        self._lock.acquire()
+        try:
+            self._hits[placement_id] = self._hits.get(placement_id, 0) + hits
+            size = len(self._hits)
+        finally:
+            self._lock.release()
+        return size >= core_settings.HITCOUNT_BUFFER_SIZE or self.is_due()
+
+    def update(self, hits):
+        for placement_id, count in hits.items():
+            self.add(placement_id, count)
+
+    def is_due(self):
+        return bool(self._hits) and time() - self._last_flush >= core_settings.HITCOUNT_FLUSH_INTERVAL
+
+    def pending(self):
+        " Return dictionary of placement_id -> hits in flight. "
+        self._lock.acquire()
+        try:
+            return self._hits.copy()
+        finally:
+            self._lock.release()
+
+    def pop(self):
+        " Empty the buffer and return its contents. "
+        self._lock.acquire()
+        try:
+            hits, self._hits = self._hits, {}
+            self._last_flush = time()
+        finally:
+            self._lock.release()
+        return hits
+
+HIT_BUFFER = HitCountBuffer()
+
 class HitCountManager(models.Manager):
 
     def hit(self, placement):
+        """
+        Count a hit for placement. With ``HITCOUNT_FLUSH_INTERVAL`` set the
+        hit is only buffered and written along with others by ``flush_hits``.
+        """
+        if core_settings.HITCOUNT_FLUSH_INTERVAL:
+            if HIT_BUFFER.add(placement.pk):
+                self.flush_hits()
+            return
+
         count = self.filter(placement=placement).update(hits=F('hits')+1)
 
         if count < 1:
             self.create(placement=placement, hits=1)
 
-    @cache_this(get_top_objects_key)
+    def flush_hits(self):
+        " Write all buffered hits to the database. "
+        hits = HIT_BUFFER.pop()
+        try:
+            self.add_hits(hits)
+        except:
+            # keep the hits for the next flush
+            HIT_BUFFER.update(hits)
+            raise
+
+    def add_hits(self, hits):
+        """
+        Add ``hits`` (dictionary placement_id -> number of hits) to the
+        stored counters. Existing counters are updated by one ``UPDATE``
+        statement per ``HITCOUNT_BUFFER_SIZE`` placements, missing ones are
+        created.
+        """
+        if not hits:
+            return
+
+        opts = self.model._meta
+        params = {
+            'table': qn(opts.db_table),
+            'pk': qn(opts.get_field('placement').column),
+            'hits': qn(opts.get_field('hits').column),
+            'last_seen': qn(opts.get_field('last_seen').column),
+        }
+        now = datetime.now()
+        existing = sorted(self.filter(placement__in=hits.keys()).values_list('placement', flat=True))
+
+        cursor = connection.cursor()
+        step = core_settings.HITCOUNT_BUFFER_SIZE
+        for i in range(0, len(existing), step):
+            chunk = existing[i:i + step]
+            params['cases'] = ' '.join(['WHEN %s THEN %s'] * len(chunk))
+            params['ids'] = ', '.join(['%s'] * len(chunk))
+            sql = 'UPDATE %(table)s SET %(hits)s = %(hits)s + CASE %(pk)s %(cases)s END, %(last_seen)s = %%s WHERE %(pk)s IN (%(ids)s)' % params
+            args = []
+            for pk in chunk:
+                args.extend((pk, hits[pk]))
+            args.append(now)
+            args.extend(chunk)
+            cursor.execute(sql, args)
+
+        existing = set(existing)
+        for pk, count in hits.items():
+            if pk in existing:
+                continue
+            sid = transaction.savepoint()
+            try:
+                self.create(placement_id=pk, hits=count)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # created by somebody else in the meantime
+                transaction.savepoint_rollback(sid)
+                self.filter(placement=pk).update(hits=F('hits') + count)
+        transaction.commit_unless_managed()
+
     def get_top_objects(self, count, days=None, mods=[]):
         """
         Return count top rated objects. Cache this for 10 minutes without any chance of cache invalidation.
+        Hits buffered in this process are added to the stored ones.
         """
+        if not core_settings.HITCOUNT_FLUSH_INTERVAL:
+            return self.get_stored_top_objects(count, days, mods)
+
+        # buffered hits can move objects just below the top up
+        top = self.get_stored_top_objects(count * 2, days, mods)
+        pending = HIT_BUFFER.pending()
+        if pending:
+            # the stored list may be shared through the cache, adjust copies
+            top = [copy(hc) for hc in top]
+            for hc in top:
+                hc.hits += pending.get(hc.placement_id, 0)
+            top.sort(key=lambda hc: hc.hits, reverse=True)
+        return top[:count]
+
+    @cache_this(get_top_objects_key)
+    def get_stored_top_objects(self, count, days=None, mods=[]):
         qset = self.filter(placement__category__site=settings.SITE_ID).order_by('-hits')
 
         if mods:
@@ -9,6 +9,7 @@ from django.core.cache import cache
 from django.utils.cache import get_cache_key, add_never_cache_headers, learn_cache_key
 from django.conf import settings
 from ella.core.conf import core_settings
+from ella.core.cache.utils import start_request_cache, end_request_cache
 
 class DoubleRenderMiddleware(object):
 
@@ -47,6 +48,29 @@ class DoubleRenderMiddleware(object):
 
         return response
 
+class RequestCacheMiddleware(object):
+    """
+    Keep objects retrieved via ella.core.cache in memory for the duration
+    of the request so that repeated lookups of the same Category, Placement
+    etc. don't go over the network. Logs the number of lookups saved.
+
+    Should be placed as early in MIDDLEWARE_CLASSES as possible.
+    """
+    def process_request(self, request):
+        start_request_cache()
+
+    def _finish(self, request):
+        stats = end_request_cache()
+        if stats is not None:
+            log.debug('Request cache for %s: %d hits, %d misses', request.path, stats['hits'], stats['misses'])
+
+    def process_response(self, request, response):
+        self._finish(request)
+        return response
+
+    def process_exception(self, request, exception):
+        self._finish(request)
+
 class CacheMiddleware(DjangoCacheMiddleware):
     def process_request(self, request):
         resp = super(CacheMiddleware, self).process_request(request)
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models import signals
 from django.core.urlresolvers import reverse
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
@@ -9,6 +10,9 @@ from django.contrib.auth.models import User
 
 from ella.core.box import Box
 from ella.core.cache import get_cached_object, cache_this, CachedGenericForeignKey
+from ella.core.tree import get_category_tree, invalidate_category_tree
+
+qn = connection.ops.quote_name
 
 
 class Author(models.Model):
@@ -97,9 +101,36 @@ class Category(models.Model):
         super(Category, self).save(**kwargs)
         if old_tree_path != self.tree_path:
             # the tree_path has changed, update children
-            children = Category.objects.filter(tree_path__startswith=old_tree_path+'/').order_by('tree_path')
-            for child in children:
-                child.save(force_update=True)
+            self.update_children_paths(old_tree_path)
+
+    def update_children_paths(self, old_tree_path):
+        """
+        Rewrite tree_path of all descendants by one UPDATE statement and send
+        post_save for each of them so that their caches are invalidated.
+        """
+        old_prefix = old_tree_path + '/'
+        children = list(Category.objects.filter(site=self.site_id, tree_path__startswith=old_prefix).values_list('pk', 'tree_path'))
+        if not children:
+            return
+
+        new_prefix = self.tree_path and self.tree_path + '/' or ''
+        opts = self._meta
+        sql = 'UPDATE %(table)s SET %(path)s = CASE %(pk)s %(cases)s END WHERE %(pk)s IN (%(ids)s)' % {
+            'table': qn(opts.db_table),
+            'path': qn(opts.get_field('tree_path').column),
+            'pk': qn(opts.pk.column),
+            'cases': ' '.join(['WHEN %s THEN %s'] * len(children)),
+            'ids': ', '.join(['%s'] * len(children)),
+        }
+        args = []
+        for pk, tree_path in children:
+            args.extend((pk, new_prefix + tree_path[len(old_prefix):]))
+        args.extend([pk for pk, tree_path in children])
+        connection.cursor().execute(sql, args)
+        transaction.commit_unless_managed()
+
+        for child in Category.objects.filter(pk__in=[pk for pk, tree_path in children]):
+            signals.post_save.send(sender=Category, instance=child, created=False, raw=False)
 
     def get_tree_parent(self):
         "Cached method."
@@ -107,19 +138,21 @@ class Category(models.Model):
             return get_cached_object(Category, pk=self.tree_parent_id)
         return None
 
+    def get_tree(self):
+        " Return in-memory index of the category's site tree containing this category. "
+        return get_category_tree(self.site_id, self.pk)
+
     @property
     def main_parent(self):
         """
         Cached. Used for highlight main category via ifequal tag.
         """
-        def _get_main_parent(category):
-            if not category.get_tree_parent():
-                return None
-            if not category.get_tree_parent().get_tree_parent():
-                return category
-            else:
-                return _get_main_parent(category.get_tree_parent())
-        return _get_main_parent(self)
+        pk = self.get_tree().get_main_parent_id(self.pk)
+        if pk is None:
+            return None
+        if pk == self.pk:
+            return self
+        return get_cached_object(Category, pk=pk)
 
     @property
     def path(self):
@@ -164,6 +197,9 @@ class Category(models.Model):
     def __unicode__(self):
         return '%s/%s' % (self.site.name, self.tree_path)
 
+signals.post_save.connect(invalidate_category_tree, sender=Category)
+signals.post_delete.connect(invalidate_category_tree, sender=Category)
+
 class Dependency(models.Model):
     """
     Object dependency - model for recording dependent items. For example when we use photo in article content.
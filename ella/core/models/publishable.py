@@ -1,6 +1,10 @@
+import atexit
+import logging
 from datetime import datetime
 
 from django.db import models
+from django.db.models import signals
+from django.core.signals import request_finished
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.utils.safestring import mark_safe, mark_for_escaping
@@ -11,13 +15,17 @@ from django.template.defaultfilters import slugify
 from django.core.urlresolvers import reverse
 from django.contrib.redirects.models import Redirect
 
-from ella.core.managers import ListingManager, HitCountManager, PlacementManager, RelatedManager
-from ella.core.cache import get_cached_object, get_cached_list, CachedGenericForeignKey
+from ella.core.managers import ListingManager, HitCountManager, PlacementManager, RelatedManager, invalidate_listings, \
+        HIT_BUFFER
+from ella.core.cache import get_cached_object, get_cached_list, CachedGenericForeignKey, prefetch_generic_targets, prefetch_foreign_key
 from ella.core.models.main import Category, Author, Source
 from ella.photos.models import Photo
 from ella.core.box import Box
 from ella.core.conf import core_settings
 
+
+log = logging.getLogger('ella.core.models')
+
 def PublishableBox(publishable, box_type, nodelist, model=None):
     "add some content type info of self.target"
     if not model:
@@ -28,6 +36,35 @@ def PublishableBox(publishable, box_type, nodelist, model=None):
         box_class = Box
     return box_class(publishable, box_type, nodelist, model=model)
 
+def prefetch_targets(publishables):
+    """
+    Fill in the ``target`` of all the given Publishable objects using one
+    cache round-trip (and at most one query) per content type.
+    """
+    prefetch_generic_targets(publishables, 'content_type_id', 'pk', '_target')
+
+def prefetch_publishables(publishables):
+    """
+    Fill in ``target``, ``photo`` and ``category`` of all the given
+    Publishable objects with one cache round-trip per model. Authors are
+    loaded for all of them at once on the first ``get_authors()`` call.
+    """
+    publishables = list(publishables)
+    prefetch_targets(publishables)
+    # targets share the publishable's fields, fill them in as well
+    group = publishables + [p._target for p in publishables if p._target is not None and p._target is not p]
+    prefetch_foreign_key(group, 'photo')
+    prefetch_foreign_key(group, 'category')
+    for p in group:
+        p._prefetch_group = group
+    return publishables
+
+def prefetch_listings(listings):
+    " Fill in placements and publishables of the listings, see prefetch_publishables. "
+    placements = prefetch_foreign_key(listings, 'placement')
+    prefetch_publishables(prefetch_foreign_key(placements, 'publishable'))
+    return listings
+
 class Publishable(models.Model):
     """
     Base class for all object that can be published in ella
@@ -67,6 +104,21 @@ class Publishable(models.Model):
             self._target = self.content_type.get_object_for_this_type(pk=self.pk)
         return self._target
 
+    def get_authors(self):
+        """
+        Return list of authors. For objects prefetched together (see
+        prefetch_publishables) authors of all of them are read by one query.
+        """
+        if not hasattr(self, '_authors'):
+            group = getattr(self, '_prefetch_group', [self])
+            authors = {}
+            through = Publishable.authors.through.objects.filter(publishable__in=[p.pk for p in group])
+            for item in through.select_related('author').order_by('pk'):
+                authors.setdefault(item.publishable_id, []).append(item.author)
+            for p in group:
+                p._authors = authors.get(p.pk, [])
+        return self._authors
+
     if 'ella.oldcomments' in settings.INSTALLED_APPS:
         from ella.oldcomments.models import Comment
         comments = generic.GenericRelation(Comment, object_id_field='target_id', content_type_field='target_ct')
@@ -370,6 +422,29 @@ class Listing(models.Model):
         verbose_name_plural = _('Listings')
         ordering = ('-publish_from',)
 
+def remember_listing_category(sender, instance, **kwargs):
+    " Store listing's original category so that both old and new get invalidated. "
+    if instance.pk:
+        instance._old_category_ids = list(Listing.objects.filter(pk=instance.pk).values_list('category', flat=True))
+
+def invalidate_listing_cache(sender, instance, **kwargs):
+    " Invalidate cached listings that the Listing could have appeared in. "
+    category_ids = [instance.category_id] + getattr(instance, '_old_category_ids', [])
+    ct_id = Publishable.objects.filter(placement=instance.placement_id).values_list('content_type', flat=True)
+    invalidate_listings(category_ids, ct_id and ct_id[0] or None)
+
+def invalidate_placement_listing_cache(sender, instance, **kwargs):
+    " Invalidate cached listings containing any of the Placement's listings. "
+    category_ids = [instance.category_id] + list(Listing.objects.filter(placement=instance).values_list('category', flat=True))
+    ct_id = Publishable.objects.filter(pk=instance.publishable_id).values_list('content_type', flat=True)
+    invalidate_listings(category_ids, ct_id and ct_id[0] or None)
+
+signals.pre_save.connect(remember_listing_category, sender=Listing)
+signals.post_save.connect(invalidate_listing_cache, sender=Listing)
+signals.post_delete.connect(invalidate_listing_cache, sender=Listing)
+signals.post_save.connect(invalidate_placement_listing_cache, sender=Placement)
+signals.post_delete.connect(invalidate_placement_listing_cache, sender=Placement)
+
 class HitCount(models.Model):
     """
     Count hits for individual objects.
@@ -394,6 +469,20 @@ class HitCount(models.Model):
         verbose_name = _('Hit Count')
         verbose_name_plural = _('Hit Counts')
 
+def write_buffered_hits():
+    " Write buffered hits, failures are only logged, the hits stay buffered. "
+    try:
+        HitCount.objects.flush_hits()
+    except Exception:
+        log.exception('Cannot write buffered hits.')
+
+def flush_hit_buffer(sender, **kwargs):
+    if HIT_BUFFER.is_due():
+        write_buffered_hits()
+
+request_finished.connect(flush_hit_buffer)
+atexit.register(write_buffered_hits)
+
 class Related(models.Model):
     """
     Related objects - model for recording related items. For example related articles.
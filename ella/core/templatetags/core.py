@@ -7,7 +7,7 @@ from django.utils.encoding import smart_str
 from django.utils.safestring import mark_safe
 from django.template.defaultfilters import stringfilter
 
-from ella.core.models import Listing, Category
+from ella.core.models import Listing, Category, prefetch_listings
 from ella.core.cache.utils import get_cached_object
 from ella.core.cache.invalidate import CACHE_DELETER
 from ella.core.box import Box
@@ -45,6 +45,7 @@ class ListingNode(template.Node):
             isinstance(self.resolved_parameters['category'], basestring):
             self.resolved_parameters['category'] = get_cached_object(Category, tree_path=self.resolved_parameters['category'], site__id=settings.SITE_ID)
         out = Listing.objects.get_listing(**self.resolved_parameters)
+        prefetch_listings(out)
 
         if 'unique' in self.parameters:
             unique = self.resolved_parameters['unique'] #context[unique_var_name]
@@ -236,7 +237,8 @@ class BoxNode(template.Node):
                 source_key = context[core_settings.BOX_INFO]
             elif core_settings.ECACHE_INFO in context:
                 source_key = context[core_settings.ECACHE_INFO]
-            CACHE_DELETER.register_dependency(source_key, box_key)
+            # invalidating the box invalidates the enclosing box or page
+            CACHE_DELETER.register_dependency(box_key, source_key)
 
         return result
 
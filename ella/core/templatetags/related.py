@@ -1,7 +1,7 @@
 from django import template
 from django.db import models
 
-from ella.core.models import Related
+from ella.core.models import Related, Publishable, prefetch_publishables
 
 register = template.Library()
 
@@ -17,6 +17,7 @@ class RelatedNode(template.Node):
 
         count = self.count
         related = Related.objects.get_related_for_object(obj, self.count, self.models)
+        prefetch_publishables([r for r in related if isinstance(r, Publishable)])
         context[self.var_name] = related
         return ''
 
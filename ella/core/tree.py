@@ -0,0 +1,123 @@
+"""
+In-memory index of the category tree.
+
+Every process keeps, for each site, all categories with their ancestors and
+descendants precomputed so that walking the tree (``Category.main_parent``,
+position fallback, listings with ``children=ALL``) costs no queries. The
+index is loaded on first use, dropped when a category of the site is saved
+or deleted and reloaded when another process announces a change through
+the cache (checked at most every ``CATEGORY_TREE_CHECK_INTERVAL`` seconds).
+"""
+from threading import Lock
+from time import time
+
+from django.core.cache import cache
+
+from ella.core.conf import core_settings
+
+
+KEY_FORMAT_VERSION = 'ella.core.tree.version:%s'
+
+class CategoryTree(object):
+    """
+    Categories of one site given as ``(id, tree_parent_id, tree_path)``
+    triples.
+    """
+    def __init__(self, site_id, categories, version=None):
+        self.site_id = site_id
+        self.version = version
+        self.checked = time()
+
+        # sorted by tree_path so that children and descendants come out in tree order
+        categories = sorted(categories, key=lambda c: c[2])
+        self.parents = {}
+        self.children = {}
+        self.paths = {}
+        for pk, parent_id, tree_path in categories:
+            self.parents[pk] = parent_id
+            self.paths[pk] = tree_path
+            self.children.setdefault(pk, [])
+            if parent_id is not None:
+                self.children.setdefault(parent_id, []).append(pk)
+
+        self.ancestors = {}
+        for pk in self.parents:
+            ancestors = []
+            parent_id = self.parents[pk]
+            while parent_id is not None and parent_id in self.parents and len(ancestors) < len(self.parents):
+                ancestors.append(parent_id)
+                parent_id = self.parents[parent_id]
+            self.ancestors[pk] = ancestors
+
+        self.descendants = dict((pk, []) for pk in self.parents)
+        for pk, parent_id, tree_path in categories:
+            for ancestor_id in self.ancestors[pk]:
+                self.descendants[ancestor_id].append(pk)
+
+    def __contains__(self, pk):
+        return pk in self.parents
+
+    def get_ancestors(self, pk):
+        " Ids of all ancestors of the category, from its parent to the root. "
+        return self.ancestors[pk]
+
+    def get_children(self, pk, include_self=False):
+        return (include_self and [pk] or []) + self.children[pk]
+
+    def get_descendants(self, pk, include_self=False):
+        " Ids of all categories below the category, in tree order. "
+        return (include_self and [pk] or []) + self.descendants[pk]
+
+    def get_main_parent_id(self, pk):
+        " Id of the ancestor directly below the root, None for the root itself. "
+        ancestors = self.ancestors[pk]
+        if not ancestors:
+            return None
+        if len(ancestors) == 1:
+            return pk
+        return ancestors[-2]
+
+_trees = {}
+_lock = Lock()
+
+def load_category_tree(site_id):
+    from ella.core.models import Category
+    # read the version first, a category saved meanwhile makes the tree
+    # outdated instead of being hidden behind the new version
+    version = cache.get(KEY_FORMAT_VERSION % site_id)
+    return CategoryTree(
+        site_id,
+        Category.objects.filter(site=site_id).values_list('pk', 'tree_parent', 'tree_path'),
+        version
+    )
+
+def get_category_tree(site_id, category_id=None):
+    """
+    Return CategoryTree of the site. If ``category_id`` is given and it is
+    not in the index (created by another process), the index is reloaded.
+    """
+    tree = _trees.get(site_id)
+    if tree is not None and time() - tree.checked > core_settings.CATEGORY_TREE_CHECK_INTERVAL:
+        version = cache.get(KEY_FORMAT_VERSION % site_id)
+        if version is not None and version != tree.version:
+            tree = None
+        else:
+            tree.checked = time()
+
+    if tree is None or (category_id is not None and category_id not in tree):
+        tree = load_category_tree(site_id)
+        _lock.acquire()
+        try:
+            _trees[site_id] = tree
+        finally:
+            _lock.release()
+    return tree
+
+def invalidate_category_tree(sender, instance, **kwargs):
+    " Drop the local index of the category's site and tell other processes to do the same. "
+    _lock.acquire()
+    try:
+        _trees.pop(instance.site_id, None)
+    finally:
+        _lock.release()
+    cache.set(KEY_FORMAT_VERSION % instance.site_id, time(), core_settings.CACHE_TIMEOUT_LONG * 24)
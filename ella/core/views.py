@@ -8,7 +8,7 @@ from django.db import models
 from django.http import Http404
 from django.shortcuts import render
 
-from ella.core.models import Listing, Category, Placement
+from ella.core.models import Listing, Category, Placement, prefetch_listings
 from ella.core.cache import get_cached_object_or_404, cache_this
 from ella.core import custom_urls
 from ella.core.conf import core_settings
@@ -206,8 +206,7 @@ class ListContentType(EllaCoreView):
             now = datetime.now()
             try:
                 year = Listing.objects.filter(
-                        category__site__id=settings.SITE_ID,
-                        category__tree_path__startswith=category.tree_path,
+                        category__in=category.get_tree().get_descendants(category.pk, include_self=True),
                         publish_from__lte=now
                     ).values('publish_from')[0]['publish_from'].year
             except:
@@ -222,8 +221,13 @@ class ListContentType(EllaCoreView):
         else:
             page_no = 1
 
+        if core_settings.CATEGORY_LISTINGS_KEYSET_PAGINATION:
+            first_page = not request.GET.get('c')
+        else:
+            first_page = page_no == 1
+
         # if we are not on the first page, display a different template
-        category_title_page = page_no == 1
+        category_title_page = first_page
 
         kwa = {}
         if year:
@@ -258,25 +262,38 @@ class ListContentType(EllaCoreView):
         else:
             ct = False
 
-        qset = Listing.objects.get_queryset_wrapper(kwa)
-        paginator = Paginator(qset, paginate_by)
+        if core_settings.CATEGORY_LISTINGS_KEYSET_PAGINATION:
+            cursor = request.GET.get('c')
+            try:
+                listings, next_cursor = Listing.objects.get_listing_after(cursor=cursor, count=paginate_by, **kwa)
+            except ValueError:
+                raise Http404()
+            page = None
+            is_paginated = bool(cursor or next_cursor)
+        else:
+            qset = Listing.objects.get_queryset_wrapper(kwa)
+            paginator = Paginator(qset, paginate_by)
 
-        if page_no > paginator.num_pages or page_no < 1:
-            raise Http404()
+            if page_no > paginator.num_pages or page_no < 1:
+                raise Http404()
 
-        page = paginator.page(page_no)
-        listings = page.object_list
+            page = paginator.page(page_no)
+            listings = page.object_list
+            next_cursor = None
+            is_paginated = paginator.num_pages > 1
+        prefetch_listings(listings)
 
         context = {
                 'page': page,
-                'is_paginated': paginator.num_pages > 1,
+                'is_paginated': is_paginated,
+                'next_cursor': next_cursor,
                 'results_per_page': paginate_by,
 
                 'content_type' : ct,
                 'content_type_name' : content_type,
                 'listings' : listings,
                 'category' : cat,
-                'is_homepage': not bool(category) and page_no == 1 and year is None,
+                'is_homepage': not bool(category) and first_page and year is None,
                 'is_title_page': category_title_page,
                 'archive_entry_year' : lambda: self._archive_entry_year(cat),
             }
@@ -6,8 +6,8 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 from django.utils.datastructures import SortedDict
 
-from ella.core.models import Publishable
-from ella.core.cache.utils import cache_this, CachedGenericForeignKey
+from ella.core.models import Publishable, prefetch_publishables
+from ella.core.cache.utils import cache_this, CachedGenericForeignKey, prefetch_generic_foreign_key
 from ella.core.cache.invalidate import CACHE_DELETER
 from ella.core.custom_urls import resolver
 from ella.photos.models import Photo
@@ -50,7 +50,10 @@ class Gallery(Publishable):
         Values are tuples of items and their targets.
         """
         slugs_count = {}
-        itms = [ (item, item.target) for item in self.galleryitem_set.all() ]
+        items = list(self.galleryitem_set.all())
+        prefetch_generic_foreign_key(items, 'target')
+        prefetch_publishables([i.target for i in items if isinstance(i.target, Publishable)])
+        itms = [ (item, item.target) for item in items ]
         slugs_unique = set((i[1].slug for i in itms))
         res = SortedDict()
 
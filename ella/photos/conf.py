@@ -29,5 +29,21 @@ TYPE_EXTENSION = {
 PHOTO_MIN_WIDTH=150
 PHOTO_MIN_HEIGHT=150
 
+# generate missing formated photos in background, see ella.photos.generator
+# (call ella.photos.generator.GENERATOR.start() when the web worker starts)
+ASYNC_GENERATION = False
+GENERATE_PROCESSES = 2
+GENERATE_LOCK_TIMEOUT = 60
+
+# resolve urls of formated photos and thumbnails from the DerivedFile
+# manifest instead of checking the filesystem
+USE_MANIFEST = False
+MANIFEST_CACHE_TIMEOUT = 60 * 60
+
+# name formated photos by hash of the source file, format and crop box so
+# that their urls never change content, superseded files are left for the
+# sweep_formated_photos command
+CONTENT_ADDRESSED_FILES = False
+
 photos_settings = Settings('ella.photos.conf', 'PHOTOS')
 
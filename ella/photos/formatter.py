@@ -1,11 +1,91 @@
+import struct
+from math import ceil
+
 from PIL import Image
 
-def detect_img_type(imagePath):
+# JPEG start of frame markers carrying image dimensions
+JPEG_SOF_MARKERS = (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+
+class ImageInfo(object):
+    " Format and dimensions of an image file. "
+    def __init__(self, format, width, height):
+        self.format = format
+        self.width = width
+        self.height = height
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+def _probe_jpeg(f):
+    " Walk JPEG segments up to the start of frame, skipping everything else. "
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            return None
+        while marker[1] == '\xff':
+            # fill bytes
+            marker = marker[1] + f.read(1)
+        code = ord(marker[1])
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            # markers without payload
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        if code in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>xHH', f.read(5))
+            return ImageInfo('JPEG', width, height)
+        f.seek(length - 2, 1)
+
+def probe_image(imagePath):
+    """
+    Return ImageInfo of the image reading only its header, None if the file
+    is missing or is not an image. JPEG, PNG and GIF headers are parsed
+    directly, other formats are left to PIL.
+    """
+    try:
+        f = open(imagePath, 'rb')
+    except IOError:
+        return None
+
+    try:
+        try:
+            head = f.read(24)
+            if head[:8] == '\x89PNG\r\n\x1a\n' and head[12:16] == 'IHDR':
+                width, height = struct.unpack('>II', head[16:24])
+                return ImageInfo('PNG', width, height)
+            if head[:6] in ('GIF87a', 'GIF89a'):
+                width, height = struct.unpack('<HH', head[6:10])
+                return ImageInfo('GIF', width, height)
+            if head[:2] == '\xff\xd8':
+                f.seek(2)
+                info = _probe_jpeg(f)
+                if info is not None:
+                    return info
+        except (struct.error, IOError):
+            pass
+    finally:
+        f.close()
+
     try:
         im = Image.open(imagePath)
-        return im.format
     except IOError:
         return None
+    return ImageInfo(im.format, *im.size)
+
+def detect_img_type(imagePath):
+    info = probe_image(imagePath)
+    return info and info.format or None
+
+def draft_image(image, scale):
+    """
+    Configure JPEG image to be decoded shrinked by up to ``scale`` times.
+    Return ratio of the original size to the decoded size.
+    """
+    if getattr(image, 'format', None) != 'JPEG' or scale < 2:
+        return 1
+    iw, ih = image.size
+    image.draft(image.mode, (int(ceil(iw / scale)), int(ceil(ih / scale))))
+    return float(iw) / image.size[0]
 
 class Formatter(object):
     def __init__(self, image, format, crop_box=None, important_box=None):
@@ -119,16 +199,46 @@ class Formatter(object):
         return (cl + move_horiz, ct + move_verti, cr + move_horiz, cb + move_verti)
 
 
+    def get_max_scale(self, crop_box=None):
+        """
+        Return how many times can the source image be shrinked while the
+        part of it given by crop_box stays at least as big as the format.
+        """
+        iw, ih = self.image.size
+        if crop_box:
+            cw, ch = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+        else:
+            cw, ch = iw, ih
+        return min(float(cw) / self.fw, float(ch) / self.fh)
+
+    def draft(self, crop_box=None):
+        """
+        Let PIL decode JPEG source in reduced size (1/2 up to 1/8) if the
+        part of the image that will be used is at least twice as big as the
+        format. Return ratio of the original size to the decoded size.
+        """
+        return draft_image(self.image, self.get_max_scale(crop_box))
+
     def crop_to_ratio(self):
-        " Get crop coordinates and perform the crop if we get any. "
+        """
+        Get crop coordinates and perform the crop if we get any. The crop box
+        is always returned in coordinates of the original image, even if the
+        image was decoded in reduced size (see draft).
+        """
         crop_box = self.get_crop_box()
 
+        if crop_box:
+            crop_box = self.center_important_part(crop_box)
+
+        scale = self.draft(crop_box)
+
         if not crop_box:
             return
 
-        crop_box = self.center_important_part(crop_box)
-
-        self.image = self.image.crop(crop_box)
+        if scale != 1:
+            self.image = self.image.crop(tuple([int(round(c / scale)) for c in crop_box]))
+        else:
+            self.image = self.image.crop(crop_box)
         return crop_box
 
     def get_resized_size(self):
@@ -169,3 +279,52 @@ class Formatter(object):
 
         self.image = self.image.resize(resized_size, Image.ANTIALIAS)
 
+
+class MultiFormatter(object):
+    """
+    Crop and resize one image into several formats while decoding it only
+    once. Formats are processed from the biggest to the smallest, smaller
+    formats are made from shrinked copies of the image instead of the
+    original.
+    """
+    def __init__(self, image, formats, crop_boxes=None, important_box=None):
+        self.image = image
+        self.formats = formats
+        self.crop_boxes = crop_boxes or {}
+        self.important_box = important_box
+
+    def get_jobs(self):
+        " Return list of (max_scale, formatter, crop_box) sorted by max_scale. "
+        jobs = []
+        for fmt in self.formats:
+            f = Formatter(self.image, fmt, crop_box=self.crop_boxes.get(fmt.pk), important_box=self.important_box)
+            crop_box = f.get_crop_box()
+            if crop_box:
+                crop_box = f.center_important_part(crop_box)
+            jobs.append((f.get_max_scale(crop_box), f, crop_box))
+        jobs.sort(key=lambda job: job[0])
+        return jobs
+
+    def format(self):
+        " Yield (format, image, crop_box) for all formats, crop_box is in coordinates of the original. "
+        jobs = self.get_jobs()
+        if not jobs:
+            return
+
+        iw, ih = self.image.size
+        image = self.image
+        scale = draft_image(image, jobs[0][0])
+        image.load()
+
+        for max_scale, f, crop_box in jobs:
+            # keep twice the size of the format for antialiasing
+            if max_scale / scale >= 4:
+                scale = max_scale / 2
+                image = image.resize((int(ceil(iw / scale)), int(ceil(ih / scale))), Image.ANTIALIAS)
+
+            if crop_box:
+                f.image = image.crop(tuple([int(round(c / scale)) for c in crop_box]))
+            else:
+                f.image = image
+            f.resize()
+            yield f.fmt, f.image, crop_box
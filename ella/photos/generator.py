@@ -0,0 +1,148 @@
+"""
+Asynchronous generation of ``FormatedPhoto`` files.
+
+With ``PHOTOS_ASYNC_GENERATION`` set, missing formated photos are not
+generated within the request. ``(photo, format)`` jobs are sent to a pool
+of ``PHOTOS_GENERATE_PROCESSES`` worker processes instead, and the blank
+image of the format is served until the job is done. Every job is queued
+only once across all processes for ``PHOTOS_GENERATE_LOCK_TIMEOUT``
+seconds.
+
+The pool is never forked while a request is being handled (the web server
+may be running other threads), it has to be started by ``GENERATOR.start()``
+when the web worker starts, e.g. from the wsgi script. Until then the jobs
+are run in a background thread.
+
+The same pool is used by the ``generate_photo_formats`` management command
+to pre-generate formats for newly uploaded photos, one job per photo so
+that every source image is decoded only once.
+"""
+import logging
+from threading import Lock, Thread
+
+from django.core.cache import cache
+from django.db import IntegrityError
+
+from ella.photos.conf import photos_settings
+
+try:
+    from multiprocessing import Pool
+except ImportError:
+    Pool = None
+
+
+log = logging.getLogger('ella.photos')
+
+def generate_formated_photo(photo_id, format_id):
+    """
+    Create ``FormatedPhoto`` for given photo and format unless it already
+    exists. Return True if the formated photo was created.
+    """
+    from ella.photos.models import FormatedPhoto
+    if FormatedPhoto.objects.filter(photo=photo_id, format=format_id).count():
+        return False
+    try:
+        FormatedPhoto.objects.create(photo_id=photo_id, format_id=format_id)
+    except (IOError, SystemError, IntegrityError), e:
+        log.error('Cannot create formatted photo %s for format %s: %s' % (photo_id, format_id, e))
+        return False
+    return True
+
+def generate_photo_formats(photo_id, format_ids):
+    """
+    Create all missing formated photos of the photo for given formats
+    from a single decode of the source image. Return number of formated
+    photos created.
+    """
+    from ella.photos.models import Photo, Format
+    try:
+        photo = Photo.objects.get(pk=photo_id)
+        return len(photo.generate_all_formats(formats=Format.objects.filter(pk__in=format_ids)))
+    except (Photo.DoesNotExist, IOError, SystemError, IntegrityError), e:
+        log.error('Cannot create formatted photos %s for formats %s: %s' % (photo_id, format_ids, e))
+        return 0
+
+def _generate_job(job):
+    return job, generate_formated_photo(*job)
+
+def _generate_photo_job(job):
+    return job, generate_photo_formats(*job)
+
+def _init_worker():
+    # forked workers cannot share the database connection of the parent,
+    # drop it without closing so that the parent's connection stays usable
+    from django.db import connection
+    connection.connection = None
+
+class PhotoGenerator(object):
+    """
+    Pool of processes generating formated photos. With ``processes=0`` the
+    jobs are run in the calling process.
+    """
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = photos_settings.GENERATE_PROCESSES
+        self.processes = processes
+        self._pool = None
+        self._lock = Lock()
+
+    def start(self):
+        """
+        Fork the worker processes. Call this when the process starts, before
+        it handles any requests or starts any threads.
+        """
+        return self.get_pool()
+
+    def get_pool(self):
+        if self._pool is None and self.processes and Pool is not None:
+            self._lock.acquire()
+            try:
+                if self._pool is None:
+                    self._pool = Pool(self.processes, _init_worker)
+            finally:
+                self._lock.release()
+        return self._pool
+
+    def enqueue(self, photo_id, format_id):
+        """
+        Schedule generation of the formated photo, return False if it is
+        already scheduled.
+        """
+        key = 'ella.photos.generator.pending:%s:%s' % (photo_id, format_id)
+        if not cache.add(key, 1, photos_settings.GENERATE_LOCK_TIMEOUT):
+            return False
+
+        # never fork the pool here, we are in the middle of a request
+        pool = self._pool
+        if pool is not None:
+            pool.apply_async(generate_formated_photo, (photo_id, format_id))
+        elif self.processes:
+            t = Thread(target=generate_formated_photo, args=(photo_id, format_id))
+            t.setDaemon(True)
+            t.start()
+        else:
+            generate_formated_photo(photo_id, format_id)
+        return True
+
+    def generate(self, jobs, func=_generate_job):
+        """
+        Generate formated photos for all ``(photo_id, format_id)`` jobs,
+        yield ``((photo_id, format_id), created)`` as they are finished.
+        Other kinds of jobs can be run by passing a module level ``func``.
+        """
+        pool = self.get_pool()
+        if pool is None:
+            for job in jobs:
+                yield func(job)
+        else:
+            for result in pool.imap_unordered(func, jobs):
+                yield result
+
+    def generate_photos(self, jobs):
+        """
+        Generate formated photos for all ``(photo_id, format_ids)`` jobs,
+        yield ``((photo_id, format_ids), number_created)``.
+        """
+        return self.generate(jobs, _generate_photo_job)
+
+GENERATOR = PhotoGenerator()
@@ -2,10 +2,17 @@ import re
 import os
 import sys
 from optparse import make_option
+from time import time
 from django.core.management.base import CommandError, BaseCommand
+from django.utils import simplejson
 from ella.photos.conf import photos_settings
 from pprint import pprint
 
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    ThreadPool = None
+
 
 class Command(BaseCommand):
 
@@ -22,6 +29,13 @@ class Command(BaseCommand):
     all = False
     extensions = None
     extensions_ic = True
+    reconcile = False
+    scan = False
+    chunk = 1000
+    threads = 8
+    checkpoint = None
+    regenerate = False
+    delete_orphans = False
 
     option_list = BaseCommand.option_list + (
         make_option('--delete',
@@ -42,6 +56,40 @@ class Command(BaseCommand):
             dest='extensions_ic',
             default=extensions_ic,
             help='Case sensitive comparation of extensions'),
+        make_option('--reconcile',
+            action='store_true',
+            dest='reconcile',
+            default=reconcile,
+            help='Update the manifest of formated photos and thumbnails to match files on disk'),
+        make_option('--scan',
+            action='store_true',
+            dest='scan',
+            default=scan,
+            help='Check files of all photos and formated photos in database instead of walking the disk'),
+        make_option('--chunk',
+            dest='chunk',
+            default=chunk,
+            type='int',
+            help='Number of photos read from database at once when scanning'),
+        make_option('--threads',
+            dest='threads',
+            default=threads,
+            type='int',
+            help='Number of threads checking files when scanning'),
+        make_option('--checkpoint',
+            dest='checkpoint',
+            default=checkpoint,
+            help='File to store scan progress in, an interrupted scan is resumed from it'),
+        make_option('--regenerate',
+            action='store_true',
+            dest='regenerate',
+            default=regenerate,
+            help='Generate missing files of formated photos when scanning'),
+        make_option('--delete-orphans',
+            action='store_true',
+            dest='delete_orphans',
+            default=delete_orphans,
+            help='Delete formated photos with missing files that cannot be regenerated when scanning'),
         )
 
     def process_options(self, options):
@@ -50,6 +98,13 @@ class Command(BaseCommand):
         self.all = bool(options['all'])
         self.extensions = options['extensions'] and options['extensions'].split(',')
         self.extensions_ic = options['extensions_ic']
+        self.reconcile = bool(options['reconcile'])
+        self.scan = bool(options['scan'])
+        self.chunk = options['chunk']
+        self.threads = options['threads']
+        self.checkpoint = options['checkpoint']
+        self.regenerate = bool(options['regenerate'])
+        self.delete_orphans = bool(options['delete_orphans'])
 
     def print_message(self, message, level, fd=None):
         if level <= self.verbosity:
@@ -91,6 +146,10 @@ class Command(BaseCommand):
         from ella.photos.models import Photo
         storage = Photo().image.storage
 
+        if self.scan:
+            self.scan_database(storage)
+            return
+
         extensions = self.extensions or photos_settings.TYPE_EXTENSION.values()
         self.print_info('Accepted extensions: ' +str(extensions))
         photo_extension_re = re.compile(
@@ -130,6 +189,9 @@ class Command(BaseCommand):
         if self.delete:
             self.delete_files(storage, photo_files_set -db_files_set)
 
+        if self.reconcile:
+            self.reconcile_manifest(photo_files_set)
+
     def print_summarization(self, photo_files_set, db_files_set):
 
         self.print_stat("Count of files on disk (selected extensions): %d"
@@ -160,3 +222,128 @@ class Command(BaseCommand):
                 storage.delete(f)
             self.print_stat("%d files are deleted" % len(to_delete))
 
+    def reconcile_manifest(self, photo_files_set):
+        """
+        Add formated photos and thumbnails found on disk to the manifest and
+        remove manifest entries of files that no longer exist.
+        """
+        from ella.photos.models import Photo, FormatedPhoto, DerivedFile
+
+        expected = {}
+        for photo_id, name in FormatedPhoto.objects.values_list('photo', 'image'):
+            expected[name] = photo_id
+        photo = Photo()
+        for photo_id, name in Photo.objects.values_list('pk', 'image'):
+            expected[photo.get_thumbnail_path(name)] = photo_id
+
+        listed = set(DerivedFile.objects.values_list('name', flat=True))
+
+        stale = listed - photo_files_set
+        for name in stale:
+            self.print_info("Remove '%s' from manifest" % name)
+            DerivedFile.objects.remove(name)
+
+        missing = (set(expected) & photo_files_set) - listed
+        for name in missing:
+            self.print_info("Add '%s' to manifest" % name)
+            DerivedFile.objects.add(name, expected[name])
+
+        self.print_stat("Manifest reconciled: %d files added, %d removed"
+                % (len(missing), len(stale)))
+
+    def load_checkpoint(self):
+        stats = {'last_pk': 0, 'files': 0, 'missing_photos': 0, 'missing_formated_photos': 0, 'regenerated': 0, 'deleted': 0}
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            f = open(self.checkpoint)
+            try:
+                stats.update(simplejson.load(f))
+            finally:
+                f.close()
+            self.print_stat("Resuming scan after photo %s" % stats['last_pk'])
+        return stats
+
+    def save_checkpoint(self, stats):
+        if not self.checkpoint:
+            return
+        # write a new file and rename it over the old one so that an
+        # interrupted write never corrupts the checkpoint
+        tmp = self.checkpoint + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            simplejson.dump(stats, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.checkpoint)
+
+    def fix_formated_photo(self, pk, stats):
+        from ella.photos.models import FormatedPhoto
+        formated_photo = FormatedPhoto.objects.get(pk=pk)
+        if self.regenerate:
+            try:
+                formated_photo.generate()
+                stats['regenerated'] += 1
+                self.print_info("Regenerated file '%s'" % formated_photo.image.name)
+                return
+            except (IOError, SystemError), e:
+                self.print_warning("Cannot regenerate file '%s': %s" % (formated_photo.image.name, e))
+        if self.delete_orphans:
+            formated_photo.delete()
+            stats['deleted'] += 1
+            self.print_info("Deleted formated photo %s" % pk)
+
+    def scan_database(self, storage):
+        """
+        Check that files of all photos and formated photos exist, reading the
+        database in chunks ordered by photo pk and checking the files in
+        parallel threads. Progress is stored in the checkpoint after every
+        chunk.
+        """
+        from ella.photos.models import Photo, FormatedPhoto
+
+        stats = self.load_checkpoint()
+        pool = None
+        if ThreadPool is not None and self.threads > 1:
+            pool = ThreadPool(self.threads)
+        start, files = time(), 0
+
+        while True:
+            photos = list(Photo.objects.filter(pk__gt=stats['last_pk']).order_by('pk').values_list('pk', 'image')[:self.chunk])
+            if not photos:
+                break
+            formated_photos = list(FormatedPhoto.objects.filter(photo__in=[pk for pk, name in photos]).values_list('pk', 'image'))
+
+            names = [name for pk, name in photos] + [name for pk, name in formated_photos]
+            if pool is not None:
+                exists = dict(zip(names, pool.map(storage.exists, names)))
+            else:
+                exists = dict(zip(names, map(storage.exists, names)))
+
+            for pk, name in photos:
+                if not exists[name]:
+                    stats['missing_photos'] += 1
+                    self.print_warning("Photo %s has no file '%s'" % (pk, name))
+
+            for pk, name in formated_photos:
+                if not exists[name]:
+                    stats['missing_formated_photos'] += 1
+                    self.print_info("Formated photo %s has no file '%s'" % (pk, name))
+                    self.fix_formated_photo(pk, stats)
+
+            files += len(names)
+            stats['files'] += len(names)
+            stats['last_pk'] = photos[-1][0]
+            self.save_checkpoint(stats)
+            self.print_info("Checked photos up to %s, %.1f files/s" % (stats['last_pk'], files / max(time() - start, 0.001)))
+
+        if pool is not None:
+            pool.close()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+        elapsed = time() - start
+        self.print_stat("Count of checked files: %d" % stats['files'])
+        self.print_stat("Count of photos without file: %d" % stats['missing_photos'])
+        self.print_stat("Count of formated photos without file: %d" % stats['missing_formated_photos'])
+        self.print_stat("Count of regenerated files: %d" % stats['regenerated'])
+        self.print_stat("Count of deleted formated photos: %d" % stats['deleted'])
+        self.print_stat("Checked %d files in %.1fs (%.1f files/s)" % (files, elapsed, files / max(elapsed, 0.001)))
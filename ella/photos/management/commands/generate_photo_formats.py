@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ella.photos.conf import photos_settings
+from ella.photos.generator import PhotoGenerator
+from ella.photos.models import Photo, Format, FormatedPhoto
+
+
+class Command(BaseCommand):
+    help = 'Generate missing formated photos for recently uploaded photos, decoding each photo only once.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+            dest='days',
+            default=1,
+            type='int',
+            help='Process photos uploaded in last DAYS days, 0 for all photos'),
+        make_option('--formats',
+            dest='formats',
+            default=None,
+            help='Comma separated names of formats to generate, all formats by default'),
+        make_option('--site',
+            dest='site',
+            default=None,
+            type='int',
+            help='Only generate formats for given site id'),
+        make_option('--processes',
+            dest='processes',
+            default=photos_settings.GENERATE_PROCESSES,
+            type='int',
+            help='Number of worker processes, 0 to generate in this process (defaults to PHOTOS_GENERATE_PROCESSES)'),
+        make_option('--chunk',
+            dest='chunk',
+            default=500,
+            type='int',
+            help='Number of photos to process at once'),
+        )
+
+    def get_jobs(self, photos, format_ids, chunk):
+        last_pk = 0
+        while True:
+            pks = list(photos.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk])
+            if not pks:
+                return
+            last_pk = pks[-1]
+
+            existing = set(FormatedPhoto.objects.filter(photo__in=pks, format__in=format_ids).values_list('photo', 'format'))
+            for pk in pks:
+                missing = [format_id for format_id in format_ids if (pk, format_id) not in existing]
+                if missing:
+                    yield (pk, missing)
+
+    def handle(self, *args, **options):
+        formats = Format.objects.all()
+        if options['formats']:
+            formats = formats.filter(name__in=options['formats'].split(','))
+        if options['site']:
+            formats = formats.filter(sites=options['site'])
+        format_ids = list(formats.values_list('pk', flat=True).distinct())
+        if not format_ids:
+            raise CommandError('No formats to generate.')
+
+        photos = Photo.objects.all()
+        if options['days']:
+            photos = photos.filter(created__gte=datetime.now() - timedelta(days=options['days']))
+
+        verbosity = int(options['verbosity'])
+        generator = PhotoGenerator(options['processes'])
+        start = time()
+        created = failed = 0
+        for (photo_id, missing), count in generator.generate_photos(self.get_jobs(photos, format_ids, options['chunk'])):
+            created += count
+            failed += len(missing) - count
+            if verbosity > 1:
+                print 'photo %s: %d of %d formats created' % (photo_id, count, len(missing))
+
+        if verbosity:
+            print '%d formated photos created, %d failed in %.1fs' % (created, failed, time() - start)
@@ -0,0 +1,62 @@
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from ella.photos.models import Photo, FormatedPhoto, DerivedFile
+
+
+class Command(BaseCommand):
+    help = 'Delete generated files (listed in the manifest) that no formated photo or thumbnail uses anymore.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk',
+            dest='chunk',
+            default=1000,
+            type='int',
+            help='Number of manifest entries to process at once'),
+        make_option('--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only list the files that would be deleted'),
+        )
+
+    def get_unused(self, entries):
+        " Return entries of the chunk not used by any formated photo or thumbnail. "
+        names = [name for pk, photo_id, name in entries]
+        used = set(FormatedPhoto.objects.filter(image__in=names).values_list('image', flat=True))
+
+        # entries of deleted photos have no photo_id, their thumbnails are unused
+        photo_ids = set([photo_id for pk, photo_id, name in entries if photo_id is not None])
+        photo = Photo()
+        for photo_id, image in Photo.objects.filter(pk__in=photo_ids).values_list('pk', 'image'):
+            used.add(photo.get_thumbnail_path(image))
+
+        return [(pk, name) for pk, photo_id, name in entries if name not in used]
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        storage = Photo().image.storage
+        start = time()
+        last_pk = checked = deleted = 0
+
+        while True:
+            entries = list(DerivedFile.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'photo', 'name')[:options['chunk']])
+            if not entries:
+                break
+            last_pk = entries[-1][0]
+            checked += len(entries)
+
+            for pk, name in self.get_unused(entries):
+                if verbosity > 1:
+                    print 'Delete file %s' % name
+                deleted += 1
+                if options['dry_run']:
+                    continue
+                if storage.exists(name):
+                    storage.delete(name)
+                DerivedFile.objects.remove(name)
+
+        if verbosity:
+            print '%d of %d generated files %s in %.1fs' % (deleted, checked, options['dry_run'] and 'unused' or 'deleted', time() - start)
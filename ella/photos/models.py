@@ -1,8 +1,12 @@
-from django.core.files.images import get_image_dimensions
 from PIL import Image
 from datetime import datetime
+from hashlib import md5
 from os import path
 import os
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 
 from django.db import models, IntegrityError
 from django.utils.translation import ugettext, ugettext_lazy as _
@@ -10,8 +14,10 @@ from django.contrib.sites.models import Site
 from django.utils.safestring import mark_safe
 from django.core.files.uploadedfile import UploadedFile
 from django.core.files.base import ContentFile
+from django.core.cache import cache
 from django.conf import settings
 from django.template.defaultfilters import slugify
+from django.utils.encoding import smart_str
 
 from ella.core.models.main import Author, Source
 from ella.core.box import Box
@@ -19,9 +25,10 @@ from ella.core.cache.utils import get_cached_object
 from ella.utils.filemanipulation import file_rename
 from ella.photos.conf import photos_settings
 
-from formatter import Formatter, detect_img_type
+from formatter import Formatter, MultiFormatter, probe_image
+from generator import GENERATOR
 
-__all__ = ("Format", "FormatedPhoto", "Photo")
+__all__ = ("Format", "FormatedPhoto", "Photo", "DerivedFile")
 
 class PhotoBox(Box):
     def get_context(self):
@@ -78,6 +85,16 @@ class Photo(models.Model):
         return mark_safe("""<a href="%s" class="js-nohashadr thickbox" title="%s" target="_blank"><img src="%s" alt="Thumbnail %s" /></a>""" % (self.image_url(), self.title, thumb_url, self.title))
     thumb.allow_tags = True
 
+    def get_image_info(self):
+        """
+        Return ImageInfo (format and dimensions) of the
+        image file, the header is only read once for every file name.
+        """
+        name = self.image.name
+        if getattr(self, '_image_info', None) is None or self._image_info[0] != name:
+            self._image_info = (name, probe_image(self.image.path))
+        return self._image_info[1]
+
     def get_thumbnail_path(self, image_name=None):
         """
         Return relative path for thumbnail file for storage
@@ -99,15 +116,18 @@ class Photo(models.Model):
         # cache thumbnail for future use to avoid hitting storage.exists() every time
         # and to allow thumbnail detection after instance has been deleted
         self.thumbnail_path = self.get_thumbnail_path()
+        storage = self.image.storage
+        if photos_settings.USE_MANIFEST and DerivedFile.objects.exists(self.thumbnail_path):
+            return storage.url(self.thumbnail_path)
+
         if photos_settings.IMAGE_URL_PREFIX and not path.exists(self.image.path):
             # custom URL prefix (debugging purposes)
             return photos_settings.IMAGE_URL_PREFIX.rstrip('/') + '/' + self.thumbnail_path
 
-        type = detect_img_type(self.image.path)
-        if not type:
+        info = self.get_image_info()
+        if not info:
             return None
-
-        storage = self.image.storage
+        type = info.format
 
         if not storage.exists(self.thumbnail_path):
             try:
@@ -117,6 +137,11 @@ class Photo(models.Model):
             except IOError:
                 # TODO Logging something wrong
                 return None
+            if DerivedFile.objects.is_enabled():
+                DerivedFile.objects.add(self.thumbnail_path, self.pk)
+        elif photos_settings.USE_MANIFEST:
+            # thumbnail created before the manifest was used
+            DerivedFile.objects.add(self.thumbnail_path, self.pk)
         return storage.url(self.thumbnail_path)
 
     def save(self, force_insert=False, force_update=False, **kwargs):
@@ -134,7 +159,7 @@ class Photo(models.Model):
             # FIXME: better unique identifier, supercalifragilisticexpialidocious?
             self.slug = ''
             super(Photo, self).save(force_insert, force_update)
-            self.width, self.height = get_image_dimensions(self.image.path)
+            self.set_dimensions()
             self.slug = str(self.id) + '-' + slugify(self.title)
             # truncate slug in order to fit in an ImageField and/or paths in Redirects
             self.slug = self.slug[:64]
@@ -144,24 +169,49 @@ class Photo(models.Model):
             old = Photo.objects.get(pk = self.pk)
             image_changed = old.image != self.image
         # rename image by slug
-        imageType = detect_img_type(self.image.path)
-        if imageType is not None:
-            self.image = file_rename(self.image.name.encode('utf-8'), self.slug, photos_settings.TYPE_EXTENSION[ imageType ])
+        info = self.get_image_info()
+        if info is not None:
+            self.image = file_rename(self.image.name.encode('utf-8'), self.slug, photos_settings.TYPE_EXTENSION[ info.format ])
+            # still the same file
+            self._image_info = (self.image.name, info)
         # delete formatedphotos if new image was uploaded
         if image_changed:
             super(Photo, self).save(force_insert=force_insert, force_update=force_update, **kwargs)
-            self.width, self.height = get_image_dimensions(self.image.path)
+            self.set_dimensions()
             force_insert, force_update = False, True
             for f_photo in self.formatedphoto_set.all():
                 f_photo.delete()
         super(Photo, self).save(force_insert=force_insert, force_update=force_update, **kwargs)
 
+    def get_checksum(self):
+        " Return md5 hexdigest of the image file, computed once for every file name. "
+        name = self.image.name
+        if getattr(self, '_checksum', None) is None or self._checksum[0] != name:
+            digest = md5()
+            f = open(self.image.path, 'rb')
+            try:
+                for chunk in iter(lambda: f.read(64 * 1024), ''):
+                    digest.update(chunk)
+            finally:
+                f.close()
+            self._checksum = (name, digest.hexdigest())
+        return self._checksum[1]
+
+    def set_dimensions(self):
+        info = self.get_image_info()
+        if info is None:
+            self.width, self.height = None, None
+        else:
+            self.width, self.height = info.size
+
     def delete_thumbnail(self):
         """
         If thumbnail was generated for this photo, delete it
         """
         if self.image.storage.exists(self.thumbnail_path):
             self.image.storage.delete(self.thumbnail_path)
+        if DerivedFile.objects.is_enabled():
+            DerivedFile.objects.remove(self.thumbnail_path)
         self.thumbnail_path = None
 
     def delete(self, *args, **kwargs):
@@ -175,12 +225,50 @@ class Photo(models.Model):
         else:
             return None
 
+    def get_important_box(self):
+        if self.important_top is None:
+            return None
+        return (self.important_left, self.important_top, self.important_right, self.important_bottom)
+
+    def generate_all_formats(self, sites=None, formats=None):
+        """
+        Create all missing formated photos of this photo for formats
+        available on given sites (all formats by default), decoding the
+        source image only once. Return list of created formated photos.
+        """
+        if formats is None:
+            formats = Format.objects.all()
+            if sites is not None:
+                formats = formats.filter(sites__in=sites).distinct()
+        existing = set(self.formatedphoto_set.values_list('format', flat=True))
+        formats = [f for f in formats if f.pk not in existing]
+        if not formats:
+            return []
+
+        source = Image.open(self.image.path)
+        image_format = self.get_image_info().format or 'JPEG'
+        formatter = MultiFormatter(source, formats, important_box=self.get_important_box())
+
+        created = []
+        for format, image, crop_box in formatter.format():
+            formated_photo = FormatedPhoto(photo=self, format=format)
+            formated_photo._formated = (image, crop_box, image_format)
+            formated_photo.save(force_insert=True)
+            created.append(formated_photo)
+        return created
+
     def get_formated_photo(self, format):
-        "Return formated photo"
+        """
+        Return formated photo. With PHOTOS_ASYNC_GENERATION missing formated
+        photo is only scheduled for generation and None is returned.
+        """
         format_object = Format.objects.get(name=format, sites=settings.SITE_ID)
         try:
             formated_photo = get_cached_object(FormatedPhoto, photo=self, format=format_object)
         except FormatedPhoto.DoesNotExist:
+            if photos_settings.ASYNC_GENERATION:
+                GENERATOR.enqueue(self.pk, format_object.pk)
+                return None
             try:
                 formated_photo = FormatedPhoto.objects.create(photo=self, format=format_object)
             except (IOError, SystemError, IntegrityError):
@@ -251,47 +339,45 @@ class FormatedPhoto(models.Model):
     width = models.PositiveIntegerField(editable=False)
     height = models.PositiveIntegerField(editable=False)
 
+    def file_exists(self):
+        " Check the manifest or the filesystem for the photo file. "
+        if photos_settings.USE_MANIFEST:
+            return DerivedFile.objects.exists(self.image.name)
+        return path.exists(self.image.path)
+
     @property
     def url(self):
         "Returns url of the photo file."
-        if photos_settings.IMAGE_URL_PREFIX and not path.exists(self.image.path):
+        if photos_settings.IMAGE_URL_PREFIX and not self.file_exists():
             # custom URL prefix (debugging purposes)
             return photos_settings.IMAGE_URL_PREFIX.rstrip('/') + '/' + self.image.name
 
         if not photos_settings.DO_URL_CHECK:
             return self.image.url
 
-        if not path.exists(self.image.path):
+        if not self.file_exists():
             # NFS not available - we have no chance of creating it
             return self.format.get_blank_img()['url']
 
-        if path.exists(self.image.path):
-            # image exists
-            return self.image.url
-
-        # image does not exist - try and create it
-        try:
-            self.generate()
-            return self.image.url
-        except (IOError, SystemError):
-            return self.format.get_blank_img()['url']
-
+        return self.image.url
 
     def generate(self, save=True):
         "Generates photo file in current format"
-        crop_box = None
-        if self.crop_left:
-            crop_box = (self.crop_left, self.crop_top, \
-                    self.crop_left + self.crop_width, self.crop_top + self.crop_height)
-
-        important_box = None
-        if self.photo.important_top is not None:
-            p = self.photo
-            important_box = (p.important_left, p.important_top, p.important_right, p.important_bottom)
+        if getattr(self, '_formated', None):
+            # already rendered by Photo.generate_all_formats
+            stretched_photo, crop_box, image_format = self._formated
+            self._formated = None
+        else:
+            crop_box = None
+            if self.crop_left:
+                crop_box = (self.crop_left, self.crop_top, \
+                        self.crop_left + self.crop_width, self.crop_top + self.crop_height)
 
-        formatter = Formatter(Image.open(self.photo.image.path), self.format, crop_box=crop_box, important_box=important_box)
+            source = Image.open(self.photo.image.path)
+            image_format = self.photo.get_image_info().format or 'JPEG'
+            formatter = Formatter(source, self.format, crop_box=crop_box, important_box=self.photo.get_important_box())
 
-        stretched_photo, crop_box = formatter.format()
+            stretched_photo, crop_box = formatter.format()
 
         # set crop_box to (0,0,0,0) if photo not cropped
         if not crop_box:
@@ -302,20 +388,42 @@ class FormatedPhoto(models.Model):
         self.crop_height = bottom - self.crop_top
 
         self.width, self.height = stretched_photo.size
-        stretched_photo.save(self.file(), quality=self.format.resample_quality)
 
-        f = open(self.file(), 'rb')
-        file = ContentFile(f.read())
-        f.close()
-
-        self.image.save(self.file(relative=True), file, save)
+        # encode the image only once and let the storage write it
+        if photos_settings.CONTENT_ADDRESSED_FILES:
+            name = self.file(relative=True)
+            storage = self.image.storage
+            if not storage.exists(name):
+                buffer = StringIO()
+                stretched_photo.save(buffer, image_format, quality=self.format.resample_quality)
+                name = storage.save(name, ContentFile(buffer.getvalue()))
+            # same name means same content, no need to write it again
+            self.image.name = name
+        else:
+            buffer = StringIO()
+            stretched_photo.save(buffer, image_format, quality=self.format.resample_quality)
+            self.image.save(self.file(relative=True), ContentFile(buffer.getvalue()), False)
+        if DerivedFile.objects.is_enabled():
+            DerivedFile.objects.add(self.image.name, self.photo_id)
+        if save:
+            # self.save() would remove the file again
+            super(FormatedPhoto, self).save()
 
     def save(self, **kwargs):
         """Overrides models.Model.save
 
         - Removes old file from the FS
         - Generates new file.
+
+        With PHOTOS_CONTENT_ADDRESSED_FILES the old file is kept and a new
+        one is only generated when the name (its content) changes.
         """
+        if photos_settings.CONTENT_ADDRESSED_FILES:
+            if not self.image or self.image.name != self.file(relative=True):
+                self.generate(save=False)
+            super(FormatedPhoto, self).save(**kwargs)
+            return
+
         self.remove_file()
         if not self.image:
             self.generate(save=False)
@@ -324,12 +432,17 @@ class FormatedPhoto(models.Model):
         super(FormatedPhoto, self).save(**kwargs)
 
     def delete(self):
-        self.remove_file()
+        if not photos_settings.CONTENT_ADDRESSED_FILES:
+            self.remove_file()
         super(FormatedPhoto, self).delete()
 
     def remove_file(self):
-        if path.exists(path.join(settings.MEDIA_ROOT, self.file(relative=True))):
-            os.remove(path.join(settings.MEDIA_ROOT, self.file(relative=True)))
+        # the storage may have saved the file under another name to avoid a clash
+        name = self.image and self.image.name or self.file(relative=True)
+        if path.exists(path.join(settings.MEDIA_ROOT, name)):
+            os.remove(path.join(settings.MEDIA_ROOT, name))
+        if DerivedFile.objects.is_enabled():
+            DerivedFile.objects.remove(name)
 
     def file(self, relative=False):
         """ Method returns formated photo path - derived from format.id and source Photo filename """
@@ -337,8 +450,21 @@ class FormatedPhoto(models.Model):
             source_file = path.split(self.photo.image.name)
         else:
             source_file = path.split(self.photo.image.path)
+        if photos_settings.CONTENT_ADDRESSED_FILES:
+            name, ext = path.splitext(source_file[1])
+            return path.join(source_file[0], '%s-%s%s' % (name, self.get_content_hash(), ext))
         return path.join(source_file[0],  str (self.format.id) + '-' + source_file[1])
 
+    def get_content_hash(self):
+        " Hash of everything the file content depends on - source file, format and crop box. "
+        f = self.format
+        params = (
+            self.photo.get_checksum(),
+            f.max_width, f.max_height, f.flexible_height, f.flexible_max_height, f.stretch, f.nocrop, f.resample_quality,
+            self.crop_left, self.crop_top, self.crop_width, self.crop_height,
+        )
+        return md5(':'.join([str(p) for p in params])).hexdigest()[:16]
+
     def __unicode__(self):
         return u"%s - %s" % (self.photo, self.format)
 
@@ -347,3 +473,46 @@ class FormatedPhoto(models.Model):
         verbose_name_plural = _('Formated photos')
         unique_together = (('photo','format'),)
 
+
+class DerivedFileManager(models.Manager):
+    def get_cache_key(self, name):
+        return 'ella.photos.models.DerivedFile:%s' % md5(smart_str(name)).hexdigest()
+
+    def is_enabled(self):
+        " Generated files are only recorded when something reads the manifest. "
+        return photos_settings.USE_MANIFEST or photos_settings.CONTENT_ADDRESSED_FILES
+
+    def exists(self, name):
+        " Return True if file of given name is listed in the manifest. "
+        key = self.get_cache_key(name)
+        found = cache.get(key)
+        if found is None:
+            found = int(self.filter(name=name).count() > 0)
+            cache.set(key, found, photos_settings.MANIFEST_CACHE_TIMEOUT)
+        return bool(found)
+
+    def add(self, name, photo_id):
+        self.get_or_create(name=name, defaults={'photo_id': photo_id})
+        cache.set(self.get_cache_key(name), 1, photos_settings.MANIFEST_CACHE_TIMEOUT)
+
+    def remove(self, name):
+        self.filter(name=name).delete()
+        cache.set(self.get_cache_key(name), 0, photos_settings.MANIFEST_CACHE_TIMEOUT)
+
+class DerivedFile(models.Model):
+    """
+    Manifest entry of a file generated from a photo (formated photo or
+    thumbnail) that exists in the storage. Entries outlive their photo so
+    that sweep_formated_photos can still delete the files.
+    """
+    photo = models.ForeignKey(Photo, blank=True, null=True, on_delete=models.SET_NULL)
+    name = models.CharField(max_length=255, unique=True)
+
+    objects = DerivedFileManager()
+
+    def __unicode__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = _('Derived file')
+        verbose_name_plural = _('Derived files')
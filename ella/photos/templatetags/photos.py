@@ -5,6 +5,8 @@ from django.conf import settings
 from django.db import IntegrityError
 
 from ella.photos.models import Photo, Format, FormatedPhoto
+from ella.photos.generator import GENERATOR
+from ella.photos.conf import photos_settings
 from ella.core.cache.utils import get_cached_object
 
 log = logging.getLogger('ella.photos')
@@ -26,6 +28,10 @@ class ImgTag(template.Node):
             try:
                 formated_photo = get_cached_object(FormatedPhoto, photo=photo, format=self.format)
             except FormatedPhoto.DoesNotExist:
+                if photos_settings.ASYNC_GENERATION:
+                    GENERATOR.enqueue(photo.pk, self.format.pk)
+                    context[self.var_name] = self.format.get_blank_img()
+                    return ''
                 try:
                     formated_photo = FormatedPhoto.objects.create(photo=photo, format=self.format)
                 except (IOError, SystemError, IntegrityError), e:
@@ -3,26 +3,80 @@ from datetime import datetime
 
 from django.utils.translation import ugettext_lazy as _, ugettext
 from django.db import models
-from django.db.models import Q
 from django.contrib.contenttypes.models import ContentType
 from django.template import Template, TemplateSyntaxError
 
-from ella.core.models import Category
+from ella.core.models import Category, Publishable, prefetch_publishables
 from ella.core.box import Box
-from ella.core.cache import CACHE_DELETER, cache_this, CachedGenericForeignKey
+from ella.core.cache import CACHE_DELETER, cache_this, CachedGenericForeignKey, prefetch_generic_foreign_key
 
 
 log = logging.getLogger('ella.positions.models')
 
-def get_position_key(func, self, category, name, nofallback=False):
-    return 'ella.positions.models.PositionManager.get_active_position:%d:%s:%s' % (
-            category.pk, name, nofallback and '1' or '0'
-    )
-def invalidate_cache(key,  self, category, name, nofallback=False):
-    CACHE_DELETER.register_test(Position, "category_id:%s;name:%s" % (category.pk, name) , key)
+def get_positions_key(func, self, category):
+    return 'ella.positions.models.PositionManager.get_category_positions:%d' % category.pk
+
+def invalidate_cache(key, self, category):
+    for category_id in [category.pk] + category.get_tree().get_ancestors(category.pk):
+        CACHE_DELETER.register_test(Position, "category_id:%s" % category_id, key)
+
+class PagePositions(object):
+    """
+    All positions for a page of one category, resolved in memory. Positions
+    are kept with their active_from and active_till so that the whole map
+    can be cached and still resolve correctly over time.
+    """
+    def __init__(self, category, positions):
+        self.category = category
+        self.positions = {}
+        for position in positions:
+            self.positions.setdefault(position.name, []).append(position)
+
+    def get(self, name, nofallback=False, now=None):
+        """
+        Return the active position of given name from the category or, unless
+        ``nofallback`` is set, from its closest ancestor that has one.
+        """
+        if now is None:
+            now = datetime.now()
+        found = None
+        for position in self.positions.get(name, []):
+            if nofallback and position.category_id != self.category.pk:
+                break
+            if found is not None and position.category_id != found.category_id:
+                break
+            if position.active_from is not None and position.active_from > now:
+                continue
+            if position.active_till is not None and position.active_till <= now:
+                continue
+            if found is not None:
+                raise Position.MultipleObjectsReturned('More than one active Position %s for category %s.' % (name, found.category_id))
+            found = position
+
+        if found is None:
+            raise Position.DoesNotExist('No active position %s in category %s%s.' % (name, self.category.pk, not nofallback and ' or its parents' or ''))
+        return found
 
 class PositionManager(models.Manager):
-    @cache_this(get_position_key, invalidate_cache)
+    @cache_this(get_positions_key, invalidate_cache)
+    def get_category_positions(self, category):
+        """
+        Return all enabled and not yet expired positions of the category and
+        its ancestors in one query, positions of the closest category first.
+        """
+        category_ids = [category.pk] + category.get_tree().get_ancestors(category.pk)
+        order = dict((category_id, i) for i, category_id in enumerate(category_ids))
+        positions = list(self.filter(category__in=category_ids, disabled=False).exclude(active_till__lte=datetime.now()))
+        positions.sort(key=lambda p: order[p.category_id])
+        return positions
+
+    def get_page_positions(self, category):
+        " Return PagePositions for all positions on the category's page, with targets prefetched. "
+        positions = self.get_category_positions(category)
+        prefetch_generic_foreign_key(positions, 'target')
+        prefetch_publishables([p.target for p in positions if isinstance(p.target, Publishable)])
+        return PagePositions(category, positions)
+
     def get_active_position(self, category, name, nofallback=False):
         """
         Get active position for given position name.
@@ -33,22 +87,7 @@ class PositionManager(models.Manager):
             nofallback - if True than do not fall back to parent
                         category if active position is not found for category
         """
-        now = datetime.now()
-        lookup = (Q(active_from__isnull=True) | Q(active_from__lte=now)) & (Q(active_till__isnull=True) | Q(active_till__gt=now))
-        while True:
-            try:
-                return self.get(lookup, category=category, name=name, disabled=False)
-            except Position.DoesNotExist:
-                # if nofallback was specified, do not look into parent categories
-                if nofallback:
-                    raise
-
-                # traverse the category tree to the top otherwise
-                category = category.get_tree_parent()
-
-                # we reached the top and still haven't found the position - raise
-                if category is None:
-                    raise
+        return self.get_page_positions(category).get(name, nofallback)
 
 def PositionBox(position, *args, **kwargs):
     " Delegate the boxing. "
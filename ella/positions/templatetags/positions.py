@@ -9,6 +9,13 @@ from ella.positions.models import Position
 
 register = template.Library()
 
+def get_page_positions(context, category):
+    " PagePositions of the category, loaded once per rendered template. "
+    key = ('ella.positions.PagePositions', category.pk)
+    if key not in context.render_context:
+        context.render_context[key] = Position.objects.get_page_positions(category)
+    return context.render_context[key]
+
 
 @register.tag
 def position(parser, token):
@@ -62,7 +69,7 @@ class PositionNode(template.Node):
             cat = get_cached_object(Category, site=settings.SITE_ID, tree_parent__isnull=True)
 
         try:
-            pos = Position.objects.get_active_position(cat, self.position, self.nofallback)
+            pos = get_page_positions(context, cat).get(self.position, self.nofallback)
         except Position.DoesNotExist:
             return ''
 
@@ -117,9 +124,10 @@ class IfPositionNode(template.Node):
         except (template.VariableDoesNotExist, Category.DoesNotExist):
             cat = get_cached_object(Category, site=settings.SITE_ID, tree_parent__isnull=True)
 
+        positions = get_page_positions(context, cat)
         for pos in self.positions:
             try:
-                Position.objects.get_active_position(cat, pos, self.nofallback)
+                positions.get(pos, self.nofallback)
                 return self.nodelist_true.render(context)
             except Position.DoesNotExist:
                 pass
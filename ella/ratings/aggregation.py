@@ -1,11 +1,34 @@
 """
 This file is for aggregation records from Rating,Agg tables to Agg and TotalRate table
+
+``transfer_new_ratings`` aggregates incrementally - only ratings added since
+the last run (tracked by a watermark of processed ``Rating.id``) are added
+to the daily ``Agg`` rows and to ``TotalRate``. Every chunk is processed in
+its own transaction together with moving the watermark, so the job can be
+interrupted and restarted at any time and ``TotalRate`` is never empty.
+Only ratings older than ``RATINGS_AGGREGATION_LAG`` are aggregated so that
+ratings committed late (with ids below the watermark) are not skipped.
+
+Both jobs rebuild the percentiles used by normalized ratings (see
+``TotalRateManager.build_percentiles``) and the leaderboards of top rated
+objects (``TopRated``) for the content types they changed. Leaderboards of
+all content types are rebuilt on the first run of every day, when the
+periods move.
+
+``transfer_data`` is the original full rebuild (MySQL only), do not mix the
+two on one database.
 """
 
 import logging
 
-from datetime import datetime, timedelta
-from ella.ratings.models import Rating, Agg, TotalRate
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+
+from ella.ratings.models import Rating, Agg, TotalRate, TopRated, Watermark, RATINGS_WATERMARK, \
+        LEADERBOARD_WATERMARK, RATINGS_AGGREGATION_CHUNK, RATINGS_AGGREGATION_LAG
 
 logger = logging.getLogger('ella.ratings')
 
@@ -56,10 +79,123 @@ def transfer_data():
         Rating.objects.filter(time__lte=time_agg).delete()
     transfer_agg_to_agg()
     transfer_agg_to_totalrate()
+    ct_ids = TotalRate.objects.values_list('target_ct', flat=True).distinct()
+    rebuild_percentiles(ct_ids)
+    rebuild_leaderboards(ct_ids, date.today())
     logger.info("transfer_data END")
     return True
 
 
+def rebuild_percentiles(ct_ids):
+    for ct_id in ct_ids:
+        TotalRate.objects.build_percentiles(ct_id)
+
+def rebuild_leaderboards(ct_ids, today):
+    last_day = Watermark.objects.get_stored_value(LEADERBOARD_WATERMARK)
+    if last_day != today.toordinal():
+        ct_ids = set(ct_ids)
+        ct_ids.update(TotalRate.objects.values_list('target_ct', flat=True).distinct())
+        ct_ids.update(TopRated.objects.values_list('target_ct', flat=True).distinct())
+
+    for ct_id in ct_ids:
+        TopRated.objects.rebuild(ct_id, today)
+
+    if last_day != today.toordinal():
+        if Watermark.objects.advance(LEADERBOARD_WATERMARK, last_day, today.toordinal()):
+            Watermark.objects.set_cache(LEADERBOARD_WATERMARK, today.toordinal())
+
+def get_time_coeficient(days):
+    """
+    Weight of a rating ``days`` old, python version of the
+    ``karma_get_time_coeficient`` SQL function.
+    """
+    days = max(days, 0)
+    if days <= 50:
+        coef = 100 - days
+    elif days <= 100:
+        coef = 75 - days / 2.0
+    elif days <= 200:
+        coef = 50 - days / 4.0
+    else:
+        coef = 0
+    return Decimal(str((coef + 10) / 100.0)).quantize(Decimal('.01'))
+
+def group_ratings(ratings, today):
+    """
+    Sum ``(id, target_ct_id, target_id, amount, time)`` rows of Rating into
+    daily aggregations and totals weighted by their age.
+    """
+    daily = {}
+    totals = {}
+    for pk, ct_id, target_id, amount, time in ratings:
+        day = time.date()
+        people_amount = daily.setdefault((ct_id, target_id, day), [0, Decimal(0)])
+        people_amount[0] += 1
+        people_amount[1] += amount
+
+        total = totals.get((ct_id, target_id), Decimal(0))
+        totals[(ct_id, target_id)] = total + amount * get_time_coeficient((today - day).days)
+    return daily, totals
+
+@transaction.commit_on_success
+def apply_ratings(ratings, last_id, today):
+    """
+    Add the ratings to Agg and TotalRate and move the watermark past them
+    in one transaction. Return False if other run already processed them.
+    """
+    if not Watermark.objects.advance(RATINGS_WATERMARK, last_id, ratings[-1][0]):
+        return False
+
+    daily, totals = group_ratings(ratings, today)
+    for (ct_id, target_id, day), (people, amount) in daily.iteritems():
+        aggs = Agg.objects.filter(target_ct=ct_id, target_id=target_id, time=day, period='d', detract=0)
+        if not aggs.update(people=F('people') + people, amount=F('amount') + amount):
+            Agg.objects.create(target_ct_id=ct_id, target_id=target_id, time=day, period='d', people=people, amount=amount)
+
+    for (ct_id, target_id), amount in totals.iteritems():
+        amount = amount.quantize(Decimal('.01'))
+        if not TotalRate.objects.filter(target_ct=ct_id, target_id=target_id).update(amount=F('amount') + amount):
+            TotalRate.objects.create(target_ct_id=ct_id, target_id=target_id, amount=amount)
+    return True
+
+def transfer_new_ratings(chunk=RATINGS_AGGREGATION_CHUNK, lag=RATINGS_AGGREGATION_LAG):
+    """
+    Aggregate ratings added since the last run to Agg and TotalRate. The
+    work done is proportional to the number of new ratings. Ratings are
+    weighted by their age at the time they are aggregated.
+
+    Ratings are processed in the order of their ids up to the first one
+    younger than ``lag`` seconds, the rest is left for the next run.
+
+    Return number of ratings processed.
+    """
+    logger.info("transfer_new_ratings BEGIN")
+    today = date.today()
+    until = datetime.now() - timedelta(seconds=lag)
+    processed = 0
+    ct_ids = set()
+    while True:
+        last_id = Watermark.objects.get_stored_value(RATINGS_WATERMARK)
+        ratings = list(Rating.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', 'target_ct', 'target_id', 'amount', 'time')[:chunk])
+        for i, r in enumerate(ratings):
+            if r[4] >= until:
+                ratings = ratings[:i]
+                break
+        if not ratings:
+            break
+        if apply_ratings(ratings, last_id, today):
+            Watermark.objects.set_cache(RATINGS_WATERMARK, ratings[-1][0])
+            processed += len(ratings)
+            ct_ids.update(r[1] for r in ratings)
+        else:
+            logger.warning("transfer_new_ratings: ratings after %s were aggregated by other process" % last_id)
+        if len(ratings) < chunk:
+            break
+    rebuild_percentiles(ct_ids)
+    rebuild_leaderboards(ct_ids, today)
+    logger.info("transfer_new_ratings END, %d ratings processed" % processed)
+    return processed
+
 
 if __name__ == "__main__":
     transfer_data()
@@ -1,3 +1,6 @@
+from optparse import make_option
+from time import time
+
 from django.core.management.base import NoArgsCommand
 from django.db import transaction
 
@@ -5,11 +8,31 @@ from ella.utils import installedapps
 installedapps.init_logger()
 
 # Logging must be inicialized
-from ella.ratings.aggregation import transfer_data
+from ella.ratings.aggregation import transfer_data, transfer_new_ratings
+from ella.ratings.models import RATINGS_AGGREGATION_CHUNK
 
 class Command(NoArgsCommand):
-    help = 'Aggregate ratings'
+    help = 'Aggregate ratings added since the last run'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk',
+            dest='chunk',
+            default=RATINGS_AGGREGATION_CHUNK,
+            type='int',
+            help='Number of ratings to aggregate in one transaction'),
+        make_option('--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='Run the original full rebuild of Agg and TotalRate (MySQL only), do not mix with the incremental aggregation'),
+        )
 
-    @transaction.commit_on_success
     def handle(self, **options):
-        transfer_data()
+        if options['full']:
+            transaction.commit_on_success(transfer_data)()
+            return
+
+        start = time()
+        processed = transfer_new_ratings(options['chunk'])
+        if int(options['verbosity']):
+            print '%d ratings aggregated in %.1fs' % (processed, time() - start)
@@ -1,14 +1,22 @@
-from datetime import datetime, timedelta
+import atexit
+from array import array
+from bisect import bisect_right
+from datetime import datetime, date, timedelta
 from decimal import Decimal
+from threading import Lock
+from time import time
 
-from django.db import models, connection
+from django.db import models, connection, transaction, IntegrityError
+from django.core.signals import request_finished
+from django.db.models import F, Sum, Min, Count
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
-from ella.core.cache import CachedGenericForeignKey, cache_this
+from ella.core.cache import CachedGenericForeignKey, cache_this, get_cached_objects
 
 # ratings - specific settings
 ANONYMOUS_KARMA = getattr(settings, 'ANONYMOUS_KARMA', 1)
@@ -19,6 +27,32 @@ RATINGS_COOKIE_NAME = getattr(settings, 'RATINGS_COOKIE_NAME', 'ratings_voted')
 RATINGS_MAX_COOKIE_LENGTH = getattr(settings, 'RATINGS_MAX_COOKIE_LENGTH', 20)
 RATINGS_MAX_COOKIE_AGE = getattr(settings, 'RATINGS_MAX_COOKIE_AGE', 3600)
 RATINGS_COEFICIENT = getattr(settings, 'RATINGS_COEFICIENT', Decimal("1.1"))
+# how long the cache remembers that a user rated an object (the unique constraint catches the rest)
+RATINGS_DEDUP_TIMEOUT = getattr(settings, 'RATINGS_DEDUP_TIMEOUT', 60*60)
+# buffer ratings in memory and write them in batches every RATINGS_FLUSH_INTERVAL seconds, 0 to write them right away
+RATINGS_FLUSH_INTERVAL = getattr(settings, 'RATINGS_FLUSH_INTERVAL', 0)
+# number of ratings aggregated in one transaction by the incremental aggregation
+RATINGS_AGGREGATION_CHUNK = getattr(settings, 'RATINGS_AGGREGATION_CHUNK', 10000)
+# only ratings older than this (in seconds) are aggregated, so that ratings inserted by transactions
+# still running (or sitting in the buffer) are not skipped by the watermark
+RATINGS_AGGREGATION_LAG = getattr(settings, 'RATINGS_AGGREGATION_LAG', 5*60 + RATINGS_FLUSH_INTERVAL)
+# how long to cache the id of the last aggregated rating
+RATINGS_WATERMARK_CACHE_TIMEOUT = getattr(settings, 'RATINGS_WATERMARK_CACHE_TIMEOUT', 60)
+# max number of buffered ratings, also the number of ratings inserted by one statement
+RATINGS_BUFFER_SIZE = getattr(settings, 'RATINGS_BUFFER_SIZE', 100)
+
+# max number of points stored for each content type to compute normalized ratings
+RATINGS_PERCENTILE_POINTS = getattr(settings, 'RATINGS_PERCENTILE_POINTS', 10000)
+# how long to cache the points, they are rebuilt by the aggregation job
+RATINGS_PERCENTILE_CACHE_TIMEOUT = getattr(settings, 'RATINGS_PERCENTILE_CACHE_TIMEOUT', 7*24*60*60)
+
+# number of top rated objects kept for each content type and period
+RATINGS_LEADERBOARD_SIZE = getattr(settings, 'RATINGS_LEADERBOARD_SIZE', 100)
+
+# name of the watermark holding id of the last aggregated Rating
+RATINGS_WATERMARK = 'ratings'
+# name of the watermark holding the day (ordinal) leaderboards were last rebuilt for
+LEADERBOARD_WATERMARK = 'ratings.leaderboard'
 
 PERIOD_CHOICES = (
     ('d', 'day'),
@@ -27,6 +61,11 @@ PERIOD_CHOICES = (
     ('y', 'year'),
 )
 
+# leaderboards are kept for the same periods as aggregations (in days) and for all time
+LEADERBOARD_ALL = 'a'
+LEADERBOARD_PERIODS = {'d': 1, 'w': 7, 'm': 30, 'y': 365, LEADERBOARD_ALL: None}
+LEADERBOARD_CHOICES = PERIOD_CHOICES + ((LEADERBOARD_ALL, 'all'),)
+
 
 MODEL_WEIGHT_CACHE = {}
 class ModelWeightManager(models.Manager):
@@ -94,6 +133,120 @@ class ModelWeight(models.Model):
     def __unicode__(self):
         return u'%s %d %s' % (self.content_type, self.weight, self.owner_field)
 
+KEY_WATERMARK = 'ella.ratings.models.watermark:%s'
+class WatermarkManager(models.Manager):
+    def get_value(self, name):
+        """
+        Return current value of the watermark, 0 if it was never moved.
+        """
+        key = KEY_WATERMARK % name
+        value = cache.get(key)
+        if value is None:
+            value = self.get_stored_value(name)
+            # add, not set - never overwrite a newer value stored by set_cache
+            cache.add(key, value, RATINGS_WATERMARK_CACHE_TIMEOUT)
+        return value
+
+    def get_stored_value(self, name):
+        " Return value of the watermark from the database. "
+        values = self.filter(name=name).values_list('value', flat=True)
+        return values and values[0] or 0
+
+    def advance(self, name, old, new):
+        """
+        Move the watermark from ``old`` to ``new``. Return False when the
+        watermark is no longer at ``old`` (moved by a concurrent run).
+        Must be called within the transaction that processes the data so
+        that both are committed or rolled back together.
+        """
+        self.get_or_create(name=name)
+        return bool(self.filter(name=name, value=old).update(value=new, updated=datetime.now()))
+
+    def set_cache(self, name, value):
+        " Publish value of the watermark once the transaction that moved it is committed. "
+        cache.set(KEY_WATERMARK % name, value, RATINGS_WATERMARK_CACHE_TIMEOUT)
+
+
+class Watermark(models.Model):
+    """
+    Id of the last record processed by an incremental job.
+    """
+    name = models.CharField(_('Name'), max_length=50, unique=True)
+    value = models.PositiveIntegerField(_('Value'), default=0)
+    updated = models.DateTimeField(_('Updated'), default=datetime.now)
+
+    objects = WatermarkManager()
+
+    class Meta:
+        verbose_name = _('Watermark')
+        verbose_name_plural = _('Watermarks')
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.value)
+
+KEY_PERCENTILES = 'ella.ratings.models.percentiles:%s'
+class RatingPercentiles(object):
+    """
+    Sorted positive and (absolute values of) negative total amounts of one
+    content type. At most ``RATINGS_PERCENTILE_POINTS`` of them are kept
+    for each sign, evenly spaced by rank, so the percentile of a rating is
+    exact for small tables and close enough for big ones.
+    """
+    def __init__(self, amounts=(), points=RATINGS_PERCENTILE_POINTS):
+        positive = sorted(float(a) for a in amounts if a > 0)
+        negative = sorted(-float(a) for a in amounts if a < 0)
+        self.positive_count, self.positive = len(positive), self.sample(positive, points)
+        self.negative_count, self.negative = len(negative), self.sample(negative, points)
+
+    def sample(self, values, points):
+        if len(values) > points:
+            n = len(values)
+            values = [values[(i + 1) * n // points - 1] for i in xrange(points)]
+        return array('d', values)
+
+    def get_data(self):
+        " Compact picklable representation for the cache. "
+        return (self.positive_count, self.positive.tostring(), self.negative_count, self.negative.tostring())
+
+    @classmethod
+    def from_data(cls, data):
+        self = cls()
+        self.positive_count, self.negative_count = data[0], data[2]
+        self.positive = array('d')
+        self.positive.fromstring(data[1])
+        self.negative = array('d')
+        self.negative.fromstring(data[3])
+        return self
+
+    def get_percentile(self, total):
+        """
+        Return share of amounts of the same sign as ``total`` that are not
+        further from 0 than ``total`` is.
+        """
+        if total > 0:
+            count, values = self.positive_count, self.positive
+        else:
+            count, values = self.negative_count, self.negative
+        if not count:
+            return Decimal(0)
+        rank = bisect_right(values, abs(float(total)))
+        return Decimal(str(min(float(rank) / len(values), 1.0)))
+
+    def normalize(self, total, max, step=None):
+        " Return ``total`` normalized to <-max, max> rounded to step, see TotalRateManager.get_normalized_rating. "
+        if total == 0:
+            return Decimal("0").quantize(step or Decimal("1"))
+
+        ref = total > 0 and max or -max
+        result = self.get_percentile(total) * ref
+        if step:
+            result = (result / step).quantize(Decimal("1")) * step
+        if result < -max:
+            result = -max
+        if result > max:
+            result = max
+        return result
+
 def normalized_rating_key(func, self, obj, max, step=None):
     return 'ella.ratings.models.normalized_rating:%s.%s:%s:%s:%s' % (
             obj._meta.app_label, obj._meta.object_name, obj.pk, max, step)
@@ -108,9 +261,58 @@ class TotalRateManager(models.Manager):
         """
         rate = Rating.objects.get_for_object(obj)
         aggr = TotalRate.objects.get_for_object(obj)
-        sum = Decimal(str(rate)) + aggr
+        sum = Decimal(str(rate)) + Decimal(str(aggr))
         return sum.quantize(Decimal(".0"))
 
+    def get_total_ratings(self, objects):
+        """
+        Return dict mapping the objects to their total rating (see
+        get_total_rating), using one query for each content type.
+
+        Params:
+                objects: list of objects to work with
+        """
+        by_ct = {}
+        for obj in objects:
+            by_ct.setdefault(ContentType.objects.get_for_model(obj).id, []).append(obj)
+
+        watermark = int(Watermark.objects.get_value(RATINGS_WATERMARK))
+        out = {}
+        cursor = connection.cursor()
+        for ct_id, objs in by_ct.iteritems():
+            ids = list(set(o.pk for o in objs))
+            sql = '''SELECT target_id, SUM(amount)
+                     FROM (
+                        SELECT target_id, amount * %(coef)s AS amount FROM %(rate_tab)s WHERE target_ct_id = %%s AND target_id IN (%(ids)s) AND id > %%s
+                        UNION ALL
+                        SELECT target_id, amount FROM %(total_tab)s WHERE target_ct_id = %%s AND target_id IN (%(ids)s)
+                     ) rates
+                     GROUP BY target_id''' % {
+                'coef' : RATINGS_COEFICIENT,
+                'rate_tab' : connection.ops.quote_name(Rating._meta.db_table),
+                'total_tab' : connection.ops.quote_name(TotalRate._meta.db_table),
+                'ids' : ', '.join(['%s'] * len(ids)),
+            }
+            cursor.execute(sql, [ct_id] + ids + [watermark, ct_id] + ids)
+            totals = dict((int(target_id), amount) for target_id, amount in cursor.fetchall())
+            for o in objs:
+                out[o] = Decimal(str(totals.get(o.pk) or 0)).quantize(Decimal(".0"))
+        return out
+
+    def get_normalized_ratings(self, objects, max, step=None):
+        """
+        Return dict mapping the objects to their normalized rating (see
+        get_normalized_rating), using one query for each content type.
+        """
+        out = {}
+        percentiles = {}
+        for obj, total in self.get_total_ratings(objects).iteritems():
+            ct_id = ContentType.objects.get_for_model(obj).id
+            if ct_id not in percentiles:
+                percentiles[ct_id] = self.get_percentiles(ct_id)
+            out[obj] = percentiles[ct_id].normalize(total, max, step)
+        return out
+
     @cache_this(normalized_rating_key)
     def get_normalized_rating(self, obj, max, step=None):
         """
@@ -122,41 +324,29 @@ class TotalRateManager(models.Manager):
         - results between 0 and min/max should be uniformly distributed
         """
         total = self.get_total_rating(obj)
-        if total == 0:
-            return Decimal("0").quantize(step or Decimal("1"))
-
-        # Handle positive and negative score separately
-        lt = "<"
-        gt = ">"
-        ref = max
-        if total < 0:
-            lt = ">"
-            gt = "<"
-            ref = -max
-
         ct_id = ContentType.objects.get_for_model(obj).id
-        sql = "SELECT (SELECT count(*) FROM %(table)s WHERE target_ct_id=%%s AND amount %(lt)s= %%s AND amount %(gt)s 0) / (SELECT count(*) FROM %(table)s WHERE target_ct_id=%%s AND amount %(gt)s 0)" \
-            % {'table': connection.ops.quote_name(TotalRate._meta.db_table),
-               'gt' :gt, 'lt' : lt,}
-
-        cursor = connection.cursor()
-        cursor.execute(sql, (ct_id, total, ct_id))
-        (percentil,) = cursor.fetchone()
-
-        if percentil is None:
-            # First rating
-            percentil = Decimal(0)
-        cursor.close()
+        return self.get_percentiles(ct_id).normalize(total, max, step)
 
-        result = percentil * ref
-        if step:
-            result = (result / step).quantize(Decimal("1")) * step
-        if result < -max:
-            result = -max
-        if result > max:
-            result = max
-        return result
+    def get_percentiles(self, ct_id):
+        """
+        Return RatingPercentiles for all TotalRate amounts of the content
+        type, from cache if possible.
+        """
+        key = KEY_PERCENTILES % ct_id
+        data = cache.get(key)
+        if data is None:
+            return self.build_percentiles(ct_id)
+        return RatingPercentiles.from_data(data)
 
+    def build_percentiles(self, ct_id):
+        """
+        Read all TotalRate amounts of the content type and store
+        RatingPercentiles for them in cache. Called by the aggregation job.
+        """
+        amounts = self.filter(target_ct=ct_id).exclude(amount=0).values_list('amount', flat=True)
+        percentiles = RatingPercentiles(amounts)
+        cache.set(KEY_PERCENTILES % ct_id, percentiles.get_data(), RATINGS_PERCENTILE_CACHE_TIMEOUT)
+        return percentiles
 
     def get_for_object(self, obj):
         """
@@ -185,55 +375,7 @@ class TotalRateManager(models.Manager):
             count: number of objects to return
             mods: if specified, limit the result to given model classes
         """
-        where_rate = ''
-        where_agg = ''
-        if mods:
-            where_agg = ' WHERE total.target_ct_id IN (%s) ' % ', '.join('%s' % ContentType.objects.get_for_model(m).id for m in mods)
-            where_rate = ' WHERE new.target_ct_id IN (%s) ' % ', '.join('%s' % ContentType.objects.get_for_model(m).id for m in mods)
-
-        sql = '''
-            SELECT DISTINCT
-                ct.app_label, ct.model, tr.target_id, tr.amount
-            FROM
-                (
-                    (
-                    SELECT
-                        total.target_ct_id, total.target_id, total.amount + COALESCE(new.sum,0) as amount
-                    FROM
-                        %(total_tab)s as total LEFT OUTER JOIN
-                        (
-                         SELECT target_ct_id, target_id, SUM(amount * %(coef)s) as sum FROM %(rate_tab)s GROUP BY target_ct_id, target_id
-) as new ON total.target_ct_id = new.target_ct_id and total.target_id = new.target_id
-                    %(cond_agg)s
-)
-                    UNION
-                    (
-                    SELECT
-                        new.target_ct_id, new.target_id, COALESCE(total.amount,0) + new.sum as amount
-                    FROM
-                        %(total_tab)s as total RIGHT OUTER JOIN
-                        (
-                         SELECT target_ct_id, target_id, SUM(amount * %(coef)s) as sum FROM %(rate_tab)s GROUP BY target_ct_id, target_id
-) as new ON total.target_ct_id = new.target_ct_id and total.target_id = new.target_id
-                    %(cond_rate)s
-)
-
-) tr JOIN %(ct_tab)s ct on ct.id = tr.target_ct_id
-            ORDER BY
-                tr.amount DESC,
-                tr.target_id
-            LIMIT %%s''' % {
-                'total_tab' : connection.ops.quote_name(TotalRate._meta.db_table),
-                'cond_agg' : where_agg,
-                'cond_rate' : where_rate,
-                'coef' : RATINGS_COEFICIENT,
-                'ct_tab' : connection.ops.quote_name(ContentType._meta.db_table),
-                'rate_tab' : connection.ops.quote_name(Rating._meta.db_table),
-        }
-        cursor = connection.cursor()
-        cursor.execute(sql, (count,))
-
-        return [ (models.get_model(*row[:2])._default_manager.get(pk=row[2]), row[3].quantize(Decimal(".0"))) for row in cursor.fetchall() ]
+        return TopRated.objects.get_top_objects(count, mods)
 
 class TotalRate(models.Model):
     """
@@ -255,6 +397,87 @@ class TotalRate(models.Model):
 
 
 
+class TopRatedManager(models.Manager):
+    def get_top_objects(self, count, mods=[], period=LEADERBOARD_ALL):
+        """
+        Return list of ``(object, amount)`` for count objects with the highest
+        rating in the period, read from the leaderboard maintained by the
+        aggregation job. Objects are retrieved with one cache round-trip per
+        content type.
+
+        Params:
+            count: number of objects to return
+            mods: if specified, limit the result to given model classes
+            period: one of LEADERBOARD_PERIODS
+        """
+        qset = self.filter(period=period)
+        if mods:
+            qset = qset.filter(target_ct__in=[ContentType.objects.get_for_model(m).id for m in mods])
+        rows = list(qset.order_by('-amount', 'target_id').values_list('target_ct', 'target_id', 'amount')[:count])
+
+        by_ct = {}
+        for ct_id, target_id, amount in rows:
+            by_ct.setdefault(ct_id, []).append(target_id)
+        objects = {}
+        for ct_id, ids in by_ct.iteritems():
+            for obj in get_cached_objects(ContentType.objects.get_for_id(ct_id), ids):
+                objects[(ct_id, obj.pk)] = obj
+
+        return [(objects[(ct_id, target_id)], amount.quantize(Decimal(".0")))
+                for ct_id, target_id, amount in rows if (ct_id, target_id) in objects]
+
+    def get_leaders(self, ct_id, period, today):
+        " Return top ``(target_id, amount)`` pairs of the content type in the period. "
+        days = LEADERBOARD_PERIODS[period]
+        if days is None:
+            qset = TotalRate.objects.filter(target_ct=ct_id).values_list('target_id', 'amount').order_by('-amount', 'target_id')
+        else:
+            qset = Agg.objects.filter(target_ct=ct_id, period='d', time__gt=today - timedelta(days=days)).values('target_id')
+            qset = qset.annotate(total=Sum('amount')).values_list('target_id', 'total').order_by('-total', 'target_id')
+        return [(target_id, amount) for target_id, amount in qset[:RATINGS_LEADERBOARD_SIZE] if amount > 0]
+
+    def fill(self, ct_id, today=None):
+        " Insert leaderboards of the content type for all periods. "
+        today = today or date.today()
+        rows = []
+        for period in LEADERBOARD_PERIODS:
+            rows.extend((ct_id, target_id, period, amount) for target_id, amount in self.get_leaders(ct_id, period, today))
+        if rows:
+            sql = 'INSERT INTO %s (target_ct_id, target_id, period, amount) VALUES (%%s, %%s, %%s, %%s)' % (
+                connection.ops.quote_name(TopRated._meta.db_table),
+            )
+            cursor = connection.cursor()
+            cursor.executemany(sql, rows)
+
+    @transaction.commit_on_success
+    def rebuild(self, ct_id, today=None):
+        """
+        Replace leaderboards of the content type for all periods. Readers
+        see either the old or the new leaderboard.
+        """
+        self.filter(target_ct=ct_id).delete()
+        self.fill(ct_id, today)
+
+class TopRated(models.Model):
+    """
+    Leaderboard of the best rated objects of each content type and period.
+    """
+    target_ct = models.ForeignKey(ContentType, db_index=True)
+    target_id = models.PositiveIntegerField(_('Object ID'))
+    target = CachedGenericForeignKey('target_ct', 'target_id')
+    period = models.CharField(_('Period'), max_length=1, choices=LEADERBOARD_CHOICES)
+    amount = models.DecimalField(_('Amount'), max_digits=10, decimal_places=2)
+
+    objects = TopRatedManager()
+
+    def __unicode__(self):
+        return u'%s points for %s' % (self.amount, self.target)
+
+    class Meta:
+        verbose_name = _('Top rated object')
+        verbose_name_plural = _('Top rated objects')
+
+
 class AggManager(models.Manager):
 
     def copy_agg_to_agg(self, time_limit, time_format, time_period):
@@ -332,21 +555,161 @@ class Agg(models.Model):
         ordering = ('-time',)
 
 
+class RatingBuffer(object):
+    """
+    Per-process buffer of ratings that were not yet written to the
+    database, see ``RatingManager.add``.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._ratings = []
+        self._last_flush = time()
+
+    def add(self, ratings):
+        """
+        Buffer the ratings, return True if the buffer should be flushed.
+        """
+        self._lock.acquire()
+        try:
+            self._ratings.extend(ratings)
+            size = len(self._ratings)
+        finally:
+            self._lock.release()
+        return size >= RATINGS_BUFFER_SIZE or self.is_due()
+
+    def is_due(self):
+        return bool(self._ratings) and time() - self._last_flush >= RATINGS_FLUSH_INTERVAL
+
+    def pop(self):
+        " Empty the buffer and return its contents. "
+        self._lock.acquire()
+        try:
+            ratings, self._ratings = self._ratings, []
+            self._last_flush = time()
+        finally:
+            self._lock.release()
+        return ratings
+
+RATING_BUFFER = RatingBuffer()
+
 class RatingManager(models.Manager):
 
+    def add(self, rating):
+        """
+        Add new rating unless it is a duplicate (see ``Rating.is_duplicate``).
+        With ``RATINGS_FLUSH_INTERVAL`` set the rating is only buffered and
+        written along with others by ``flush_ratings``.
+        """
+        if not RATINGS_FLUSH_INTERVAL:
+            rating.save()
+            return
+        if rating.is_duplicate():
+            return
+        if RATING_BUFFER.add([rating]):
+            self.flush_ratings()
+
+    def flush_ratings(self):
+        " Write all buffered ratings to the database. "
+        ratings = RATING_BUFFER.pop()
+        try:
+            self.bulk_insert(ratings)
+        except:
+            # keep the ratings for the next flush
+            RATING_BUFFER.add(ratings)
+            raise
+
+    def bulk_insert(self, ratings):
+        """
+        Insert the ratings with one statement per ``RATINGS_BUFFER_SIZE``
+        of them. Ratings of users who have already rated the object are
+        skipped (found by one query), if a chunk still violates the unique
+        constraint its ratings are inserted one by one.
+        """
+        user_ratings = [r for r in ratings if r.user_id]
+        if user_ratings:
+            rated = set(self.filter(
+                    user__in=set(r.user_id for r in user_ratings),
+                    target_id__in=set(r.target_id for r in user_ratings)
+                ).values_list('target_ct', 'target_id', 'user'))
+            unique = []
+            for r in ratings:
+                if r.user_id:
+                    if (r.target_ct_id, r.target_id, r.user_id) in rated:
+                        continue
+                    rated.add((r.target_ct_id, r.target_id, r.user_id))
+                unique.append(r)
+            ratings = unique
+
+        if not ratings:
+            return
+
+        opts = self.model._meta
+        fields = [opts.get_field(name) for name in ('target_ct', 'target_id', 'time', 'user', 'amount', 'ip_address')]
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            connection.ops.quote_name(opts.db_table),
+            ', '.join(connection.ops.quote_name(f.column) for f in fields),
+            ', '.join(['%s'] * len(fields)),
+        )
+
+        cursor = connection.cursor()
+        step = RATINGS_BUFFER_SIZE
+        for i in range(0, len(ratings), step):
+            chunk = ratings[i:i + step]
+            sid = transaction.savepoint()
+            try:
+                cursor.executemany(sql, [[f.get_db_prep_save(f.pre_save(r, True), connection=connection) for f in fields] for r in chunk])
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                for r in chunk:
+                    sid = transaction.savepoint()
+                    try:
+                        super(Rating, r).save(force_insert=True)
+                        transaction.savepoint_commit(sid)
+                    except IntegrityError:
+                        # the user has already rated the object
+                        transaction.savepoint_rollback(sid)
+        transaction.commit_unless_managed()
+
+    def remove_duplicates(self):
+        """
+        Delete all but the first rating of every user for each object (left
+        by the former check-then-insert in Rating.save) and subtract the
+        deleted ratings that were already aggregated from the daily Agg rows
+        and TotalRate. Return number of ratings deleted.
+        """
+        from ella.ratings.aggregation import get_time_coeficient
+        watermark = Watermark.objects.get_stored_value(RATINGS_WATERMARK)
+        groups = self.filter(user__isnull=False).values('target_ct', 'target_id', 'user').annotate(first=Min('pk'), ratings=Count('pk')).filter(ratings__gt=1)
+
+        deleted = 0
+        for g in groups:
+            extra = self.filter(target_ct=g['target_ct'], target_id=g['target_id'], user=g['user']).exclude(pk=g['first'])
+            for r in extra.filter(pk__lte=watermark):
+                # ratings are aggregated within minutes, i.e. with the coeficient of a fresh rating
+                Agg.objects.filter(target_ct=r.target_ct_id, target_id=r.target_id, time=r.time.date(), period='d').update(
+                        people=F('people') - 1, amount=F('amount') - r.amount)
+                TotalRate.objects.filter(target_ct=r.target_ct_id, target_id=r.target_id).update(
+                        amount=F('amount') - (r.amount * get_time_coeficient(0)).quantize(Decimal('.01')))
+            deleted += extra.count()
+            extra.delete()
+        return deleted
+
     def get_for_object(self, obj):
         """
-        Return the rating for a given object.
+        Return the rating for a given object from ratings that were not
+        aggregated to TotalRate yet.
 
         Params:
             obj: object to work with
         """
         content_type = ContentType.objects.get_for_model(obj)
-        sql = 'SELECT SUM(amount * %s) FROM %s WHERE target_id = %s AND target_ct_id = %s' % (
+        sql = 'SELECT SUM(amount * %s) FROM %s WHERE target_id = %s AND target_ct_id = %s AND id > %s' % (
             RATINGS_COEFICIENT,
             connection.ops.quote_name(Rating._meta.db_table),
             obj.id,
             content_type.id,
+            int(Watermark.objects.get_value(RATINGS_WATERMARK)),
         )
         cursor = connection.cursor()
         cursor.execute(sql, ())
@@ -400,28 +763,64 @@ class Rating(models.Model):
         verbose_name = _('Rating')
         verbose_name_plural = _('Ratings')
         ordering = ('-time',)
-
-    def save(self, force_insert=False, force_update=False):
+        unique_together = (('target_ct', 'target_id', 'user'),)
+
+    def get_dedup_key(self):
+        if self.user_id:
+            rater = 'user:%s' % self.user_id
+        elif self.ip_address:
+            rater = 'ip:%s' % self.ip_address
+        else:
+            return None
+        return 'ella.ratings.models.rated:%s:%s:%s' % (self.target_ct_id, self.target_id, rater)
+
+    def is_duplicate(self):
+        """
+        Return True if the user (or the anonymous IP address within
+        ``MINIMAL_ANONYMOUS_IP_DELAY``) has already rated the target.
+        Repeated ratings are caught by a single cache ``add``. Duplicate
+        ratings of users the cache doesn't remember are stopped by the
+        unique constraint, anonymous ones by a query for recent ratings
+        from the same IP address.
         """
-        Modified save() method that checks for duplicit entries.
+        key = self.get_dedup_key()
+        if key is None:
+            return False
+        timeout = self.user_id and RATINGS_DEDUP_TIMEOUT or MINIMAL_ANONYMOUS_IP_DELAY
+        if not cache.add(key, 1, timeout):
+            return True
+        if self.user_id:
+            return False
+        return Rating.objects.filter(
+                target_ct=self.target_ct_id,
+                target_id=self.target_id,
+                user__isnull=True,
+                ip_address=self.ip_address,
+                time__gte=(self.time or datetime.now()) - timedelta(seconds=MINIMAL_ANONYMOUS_IP_DELAY)
+            ).count() > 0
+
+    def save(self, force_insert=False, force_update=False, **kwargs):
         """
-        if not self.id:
-            # fail silently on inserting duplicate ratings
-            if self.user:
-                try:
-                    Rating.objects.get(target_ct=self.target_ct, target_id=self.target_id, user=self.user)
-                    return
-                except Rating.DoesNotExist:
-                    pass
-            elif (self.ip_address and Rating.objects.filter(
-                        target_ct=self.target_ct,
-                        target_id=self.target_id,
-                        user__isnull=True,
-                        ip_address=self.ip_address ,
-                        time__gte=(self.time or datetime.now()) - timedelta(seconds=MINIMAL_ANONYMOUS_IP_DELAY)
-                ).count() > 0):
-                return
+        Modified save() method that silently skips duplicit entries.
+        """
+        if self.id:
+            super(Rating, self).save(force_insert, force_update, **kwargs)
+            return
+
+        # fail silently on inserting duplicate ratings
+        if self.is_duplicate():
+            return
 
-        super(Rating, self).save(force_insert, force_update)
+        sid = transaction.savepoint()
+        try:
+            super(Rating, self).save(force_insert, force_update, **kwargs)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
 
+def flush_rating_buffer(sender, **kwargs):
+    if RATING_BUFFER.is_due():
+        Rating.objects.flush_ratings()
 
+request_finished.connect(flush_rating_buffer)
+atexit.register(lambda: Rating.objects.flush_ratings())
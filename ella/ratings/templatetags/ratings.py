@@ -6,17 +6,21 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
 
-from ella.ratings.models import TotalRate
-from ella.ratings.forms import RateForm
-from ella.ratings.views import get_was_rated
+from django.conf import settings
 from django.utils.translation import ugettext as _
 
-from recepty import settings
+from ella.core.models import Listing, Publishable
+from ella.ratings.models import TotalRate, TopRated, LEADERBOARD_CHOICES, LEADERBOARD_ALL
+from ella.ratings.forms import RateForm
+from ella.ratings.views import get_was_rated
 
 register = template.Library()
 
 DOUBLE_RENDER = getattr(settings, 'DOUBLE_RENDER', False)
 
+# context variable with ratings resolved by ratings_for, keyed by (max, step)
+RATINGS_FOR_KEY = '_ratings_for'
+
 #class RateUrlsNode(template.Node):
 #    def __init__(self, object, up_name, down_name, form_name=None):
 #        self.object, self.up_name, self.down_name = object, up_name, down_name
@@ -142,9 +146,13 @@ class RatingNode(template.Node):
                     value = best_approximation
 
             elif (self.min is not None and self.max is not None):
-                value = TotalRate.objects.get_normalized_rating(obj, Decimal(self.max), Decimal(self.step))
+                value = get_prefetched_rating(context, obj, Decimal(self.max), Decimal(self.step))
+                if value is None:
+                    value = TotalRate.objects.get_normalized_rating(obj, Decimal(self.max), Decimal(self.step))
             else:
-                value = TotalRate.objects.get_total_rating(obj)
+                value = get_prefetched_rating(context, obj)
+                if value is None:
+                    value = TotalRate.objects.get_total_rating(obj)
             # Set as string to be able to compare value in template
             context[self.name] = str(value)
         return ''
@@ -194,6 +202,73 @@ def do_rating(parser, token):
     raise template.TemplateSyntaxError, \
         "{% rating for OBJ as VAR %} or {% rating for OBJ max X step Y as VAR %}"
 
+def get_prefetched_rating(context, obj, max=None, step=None):
+    " Return rating of the object resolved by an enclosing ratings_for tag or None. "
+    return context.get(RATINGS_FOR_KEY, {}).get((max, step), {}).get(obj)
+
+def get_rated_object(obj):
+    " Objects are rated as their final class, listings as the listed object. "
+    if isinstance(obj, Listing):
+        obj = obj.target
+    if isinstance(obj, Publishable):
+        obj = obj.target
+    return obj
+
+class RatingsForNode(template.Node):
+    def __init__(self, objects, name, max=None, step=None):
+        self.objects, self.name = template.Variable(objects), name
+        self.max = max is not None and Decimal(max) or None
+        self.step = step is not None and Decimal(step) or None
+
+    def render(self, context):
+        try:
+            objects = [get_rated_object(o) for o in self.objects.resolve(context) if o]
+        except template.VariableDoesNotExist:
+            return ''
+
+        if self.max is not None:
+            ratings = TotalRate.objects.get_normalized_ratings(objects, self.max, self.step)
+        else:
+            ratings = TotalRate.objects.get_total_ratings(objects)
+
+        if RATINGS_FOR_KEY not in context:
+            context[RATINGS_FOR_KEY] = {}
+        context[RATINGS_FOR_KEY].setdefault((self.max, self.step), {}).update(ratings)
+        context[self.name] = ratings
+        return ''
+
+@register.tag('ratings_for')
+def do_ratings_for(parser, token):
+    """
+    Get ratings of all the given objects (or listings) with one query for
+    each content type and store them in context as a dictionary keyed by
+    the objects. ``{% rating %}`` tags with the same parameters that follow
+    will not query the database for these objects.
+
+    Usage::
+
+        {% ratings_for OBJECTS as VAR %}
+
+        {% ratings_for OBJECTS max X step Y as VAR %}
+
+    Example::
+
+        {% listing 10 for category as listings %}
+        {% ratings_for listings max 1 step 0.5 as listing_ratings %}
+        {% for l in listings %}
+            {% rating for l.target.target max 1 step 0.5 as object_rating %}
+            ...
+        {% endfor %}
+    """
+    bits = token.split_contents()
+    if len(bits) == 4 and bits[2] == 'as':
+        return RatingsForNode(bits[1], bits[3])
+    if len(bits) == 8 and bits[2] == 'max' and bits[4] == 'step' and bits[6] == 'as':
+        return RatingsForNode(bits[1], bits[7], bits[3], bits[5])
+
+    raise template.TemplateSyntaxError, \
+        "{% ratings_for OBJECTS as VAR %} or {% ratings_for OBJECTS max X step Y as VAR %}"
+
 class WasRatedNode(template.Node):
 
     def __init__(self, object, name):
@@ -217,13 +292,13 @@ def do_was_rated(parser, token):
 
 
 class TopRatedNode(template.Node):
-    def __init__(self, count, name, mods=None):
-        self.count, self.name, self.mods = count, name, mods
+    def __init__(self, count, name, mods=None, period=LEADERBOARD_ALL):
+        self.count, self.name, self.mods, self.period = count, name, mods, period
 
     def render(self, context):
         # FIXME: remove try-except after rating migration
         try:
-            context[self.name] = TotalRate.objects.get_top_objects(self.count, self.mods)
+            context[self.name] = TopRated.objects.get_top_objects(self.count, self.mods, self.period)
         except:
             pass
         return ''
@@ -235,7 +310,7 @@ def do_top_rated(parser, token):
 
     Usage::
 
-        {% top_rated 5 [app.model ...] as var %}
+        {% top_rated 5 [app.model ...] [period day|week|month|year|all] as var %}
 
     Example::
 
@@ -247,6 +322,8 @@ def do_top_rated(parser, token):
 
         {% top_rated 10 articles.article photos.photo as top_objects %}
         {% for obj in top_objects %}   ...   {% endfor %}
+
+        {% top_rated 10 articles.article period week as top_articles %}
     """
     bits = token.split_contents()
     if len(bits) < 3 or bits[-2] != 'as':
@@ -254,6 +331,13 @@ def do_top_rated(parser, token):
 
     count = int(bits[1])
 
+    period = LEADERBOARD_ALL
+    if len(bits) > 4 and bits[-4] == 'period':
+        periods = dict((name, code) for code, name in LEADERBOARD_CHOICES)
+        if bits[-3] not in periods:
+            raise template.TemplateSyntaxError, "Period must be one of %s" % ', '.join(periods)
+        period = periods[bits[-3]]
+        bits = bits[:-4] + bits[-2:]
 
     mods = []
     for mod in bits[2:-2]:
@@ -262,7 +346,7 @@ def do_top_rated(parser, token):
             raise template.TemplateSyntaxError, "%r .... TODO ....." % token.contents.split()[0]
         mods.append(model)
 
-    return TopRatedNode(count, bits[-1], mods)
+    return TopRatedNode(count, bits[-1], mods, period)
 
 class IfWasRatedNode(template.Node):
 
@@ -84,7 +84,7 @@ def do_rate(request, ct, target, plusminus):
     # Do the rating
     # Rating will not be neccessary added but fail silently
     rt = Rating(target_ct_id=ct.id, target_id=target.id, **kwa)
-    rt.save()
+    Rating.objects.add(rt)
 
     response =  get_response(request, target, message=_('Your rating was succesfully added.'))
     set_was_rated(request, response, ct, target)
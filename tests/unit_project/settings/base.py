@@ -49,6 +49,7 @@ INSTALLED_APPS = (
     'ella.polls',
     'ella.interviews',
     'ella.ellaexports',
+    'ella.ratings',
     'djangomarkup',
     'tagging',
     'threadedcomments',
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import get_cache
+from django.contrib.contenttypes.models import ContentType
+
+from djangosanetesting import DatabaseTestCase, UnitTestCase
+
+from ella.core.cache import utils
+from ella.core.cache.utils import get_cached_object, get_cached_objects, prefetch_generic_foreign_key, \
+        LocalCache, start_request_cache, end_request_cache, get_request_cache_stats, \
+        cache_this, SoftExpiringValue, normalize_key
+from ella.core.models import Category, Publishable, Related, prefetch_targets
+from ella.articles.models import Article
+
+from unit_project.test_core import create_basic_categories, create_and_place_a_publishable, \
+        create_and_place_more_publishables
+
+class CacheTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        self.old_cache = utils.cache
+        utils.cache = get_cache('locmem://')
+        utils.cache.clear()
+
+    def tearDown(self):
+        utils.cache = self.old_cache
+        super(CacheTestCase, self).tearDown()
+
+class TestGetCachedObjects(CacheTestCase):
+    def setUp(self):
+        super(TestGetCachedObjects, self).setUp()
+        create_basic_categories(self)
+
+    def test_returns_objects_in_order_of_pks(self):
+        pks = [self.category_nested_second.pk, self.category.pk, self.category_nested.pk]
+        self.assert_equals(pks, [c.pk for c in get_cached_objects(Category, pks)])
+
+    def test_accepts_content_type(self):
+        ct = ContentType.objects.get_for_model(Category)
+        self.assert_equals([self.category], get_cached_objects(ct, [self.category.pk]))
+
+    def test_skips_nonexistent_pks(self):
+        self.assert_equals([self.category], get_cached_objects(Category, [self.category.pk, 12345]))
+
+    def test_stores_objects_under_get_cached_object_keys(self):
+        get_cached_objects(Category, [self.category.pk])
+        Category.objects.filter(pk=self.category.pk).update(title='Updated')
+        self.assert_not_equals('Updated', get_cached_object(Category, pk=self.category.pk).title)
+
+    def test_uses_objects_cached_by_get_cached_object(self):
+        get_cached_object(Category, pk=self.category.pk)
+        Category.objects.filter(pk=self.category.pk).update(title='Updated')
+        objs = get_cached_objects(Category, [self.category.pk, self.category_nested.pk])
+        self.assert_not_equals('Updated', objs[0].title)
+        self.assert_equals(self.category_nested, objs[1])
+
+class TestPrefetchTargets(CacheTestCase):
+    def setUp(self):
+        super(TestPrefetchTargets, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+
+    def test_publishable_targets_are_filled_in(self):
+        publishables = list(Publishable.objects.order_by('pk'))
+        prefetch_targets(publishables)
+        for p in publishables:
+            self.assert_true(hasattr(p, '_target'))
+            self.assert_equals(Article, p.target.__class__)
+            self.assert_equals(p.pk, p.target.pk)
+
+    def test_generic_foreign_key_is_filled_in(self):
+        r = Related(publishable=self.publishables[0])
+        r.related = self.publishable
+        r.save()
+
+        related = list(Related.objects.all())
+        prefetch_generic_foreign_key(related, 'related')
+        self.assert_equals(self.publishable, related[0]._related_cache)
+
+class TestLocalCache(UnitTestCase):
+    def test_returns_stored_value(self):
+        c = LocalCache(10, 60)
+        c.set('key', [1, 2])
+        self.assert_equals([1, 2], c.get('key'))
+        self.assert_equals(1, c.hits)
+
+    def test_returns_copies_of_stored_value(self):
+        c = LocalCache(10, 60)
+        value = [1, 2]
+        c.set('key', value)
+        self.assert_false(value is c.get('key'))
+
+    def test_expired_value_is_not_returned(self):
+        c = LocalCache(10, -1)
+        c.set('key', 'value')
+        self.assert_equals(None, c.get('key'))
+        self.assert_equals(1, c.misses)
+
+    def test_least_recently_used_entries_are_culled(self):
+        c = LocalCache(4, 60, cull_frequency=2)
+        for i in range(4):
+            c.set(i, i)
+        c.get(0)
+        c.get(1)
+        c.set(4, 4)
+        self.assert_equals([0, 1, None, None, 4], [c.get(i) for i in range(5)])
+
+class TestRequestCache(CacheTestCase):
+    def setUp(self):
+        super(TestRequestCache, self).setUp()
+        create_basic_categories(self)
+
+    def tearDown(self):
+        end_request_cache()
+        super(TestRequestCache, self).tearDown()
+
+    def test_stats_are_none_outside_of_request(self):
+        self.assert_equals(None, get_request_cache_stats())
+
+    def test_repeated_lookups_are_served_locally(self):
+        start_request_cache()
+        get_cached_object(Category, pk=self.category.pk)
+        get_cached_object(Category, pk=self.category.pk)
+        get_cached_objects(Category, [self.category.pk, self.category_nested.pk])
+        self.assert_equals({'hits': 2, 'misses': 2}, end_request_cache())
+
+    def test_cache_is_dropped_at_the_end_of_request(self):
+        start_request_cache()
+        get_cached_object(Category, pk=self.category.pk)
+        end_request_cache()
+        start_request_cache()
+        get_cached_object(Category, pk=self.category.pk)
+        self.assert_equals({'hits': 0, 'misses': 1}, get_request_cache_stats())
+
+def get_counter_key(func, counter):
+    return 'unit_project.test_core.test_cache.counter'
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+
+    @cache_this(get_counter_key)
+    def get(self):
+        self.calls += 1
+        return self.calls
+
+class TestStaleWhileRevalidate(CacheTestCase):
+    def setUp(self):
+        super(TestStaleWhileRevalidate, self).setUp()
+        self.counter = Counter()
+        self.key = normalize_key(get_counter_key(None, self.counter))
+
+    def expire(self):
+        value = utils.cache.get(self.key)
+        value.refresh_at = 0
+        utils.cache.set(self.key, value)
+
+    def test_value_is_stored_with_refresh_time(self):
+        self.counter.get()
+        self.assert_true(isinstance(utils.cache.get(self.key), SoftExpiringValue))
+
+    def test_fresh_value_is_served_from_cache(self):
+        self.counter.get()
+        self.assert_equals(1, self.counter.get())
+
+    def test_first_caller_recomputes_stale_value(self):
+        self.counter.get()
+        self.expire()
+        self.assert_equals(2, self.counter.get())
+        self.assert_equals(2, self.counter.get())
+
+    def test_stale_value_is_served_while_being_recomputed(self):
+        self.counter.get()
+        self.expire()
+        utils.cache.add('ella.core.cache.utils.refresh_lock:' + self.key, 1)
+        self.assert_equals(1, self.counter.get())
+        self.assert_equals(1, self.counter.calls)
+
+    def test_plain_values_are_still_understood(self):
+        utils.cache.set(self.key, 42)
+        self.assert_equals(42, self.counter.get())
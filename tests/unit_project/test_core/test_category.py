@@ -60,3 +60,33 @@ class TestCategory(DatabaseTestCase):
         url = reverse('category_detail', args=(self.category_nested.tree_path, ))
         self.assert_equals(url, self.category_nested.get_absolute_url())
 
+    def test_category_rename_children_in_other_branches_untouched(self):
+        other = Category.objects.create(title=u"other", tree_parent=self.category, site_id=self.site_id, slug=u"nested-category-other")
+        self.category_nested.slug = u"new-nested-category"
+        self.category_nested.save()
+        self.assert_equals(u"nested-category-other", Category.objects.get(pk=other.pk).tree_path)
+
+class TestCategoryTree(DatabaseTestCase):
+    def setUp(self):
+        super(TestCategoryTree, self).setUp()
+        create_basic_categories(self)
+        self.tree = self.category.get_tree()
+
+    def test_ancestors(self):
+        self.assert_equals([self.category_nested.pk, self.category.pk], self.tree.get_ancestors(self.category_nested_second.pk))
+
+    def test_descendants_in_tree_order(self):
+        self.assert_equals([self.category.pk, self.category_nested.pk, self.category_nested_second.pk], self.tree.get_descendants(self.category.pk, include_self=True))
+
+    def test_children(self):
+        self.assert_equals([self.category_nested.pk], self.tree.get_children(self.category.pk))
+
+    def test_main_parent_of_root_is_none(self):
+        self.assert_equals(None, self.tree.get_main_parent_id(self.category.pk))
+
+    def test_tree_is_invalidated_on_save(self):
+        third = Category.objects.create(title=u"third", tree_parent=self.category_nested_second, site_id=self.site_id, slug=u"third")
+        self.assert_equals(
+            [self.category_nested.pk, self.category_nested_second.pk, third.pk],
+            third.get_tree().get_descendants(self.category_nested.pk, include_self=True)
+        )
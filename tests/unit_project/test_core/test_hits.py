@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 from djangosanetesting import DatabaseTestCase
 
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import DatabaseError
+
 from ella.core.models import HitCount
+from ella.core.managers import HIT_BUFFER
 from ella.articles.models import Article
 
 from unit_project.test_core import create_basic_categories, create_and_place_a_publishable, create_and_place_more_publishables
@@ -48,3 +53,82 @@ class TestTopObjects(DatabaseTestCase):
         HitCount.objects.hit(self.placement)
         HitCount.objects.hit(self.placements[0])
         self.assert_equals([self.placement, self.placements[0]], [hc.placement for hc in HitCount.objects.get_top_objects(2, mods=[Article])])
+
+class TestBufferedHitCounts(DatabaseTestCase):
+    def setUp(self):
+        super(TestBufferedHitCounts, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        settings.HITCOUNT_FLUSH_INTERVAL = 60
+
+    def tearDown(self):
+        del settings.HITCOUNT_FLUSH_INTERVAL
+        HIT_BUFFER.pop()
+        super(TestBufferedHitCounts, self).tearDown()
+
+    def get_hits(self, placement):
+        return HitCount.objects.get(placement=placement).hits
+
+    def test_hit_is_buffered(self):
+        HitCount.objects.hit(self.placement)
+        self.assert_equals(0, self.get_hits(self.placement))
+        self.assert_equals({self.placement.pk: 1}, HIT_BUFFER.pending())
+
+    def test_flush_writes_buffered_hits(self):
+        HitCount.objects.hit(self.placement)
+        HitCount.objects.hit(self.placement)
+        HitCount.objects.hit(self.placements[0])
+        HitCount.objects.flush_hits()
+        self.assert_equals(2, self.get_hits(self.placement))
+        self.assert_equals(1, self.get_hits(self.placements[0]))
+        self.assert_equals({}, HIT_BUFFER.pending())
+
+    def test_flush_creates_missing_hitcounts(self):
+        HitCount.objects.all().delete()
+        HitCount.objects.hit(self.placement)
+        HitCount.objects.flush_hits()
+        self.assert_equals(1, self.get_hits(self.placement))
+
+    def test_failed_flush_at_request_end_keeps_hits(self):
+        def add_hits(hits):
+            raise DatabaseError('database is down')
+        HitCount.objects.hit(self.placement)
+        HitCount.objects.add_hits = add_hits
+        try:
+            HIT_BUFFER._last_flush = 0
+            request_finished.send(sender=None)
+        finally:
+            del HitCount.objects.add_hits
+        self.assert_equals({self.placement.pk: 1}, HIT_BUFFER.pending())
+
+    def test_full_buffer_is_flushed(self):
+        settings.HITCOUNT_BUFFER_SIZE = 2
+        try:
+            HitCount.objects.hit(self.placement)
+            HitCount.objects.hit(self.placements[0])
+        finally:
+            del settings.HITCOUNT_BUFFER_SIZE
+        self.assert_equals(1, self.get_hits(self.placement))
+        self.assert_equals(1, self.get_hits(self.placements[0]))
+
+    def test_top_objects_include_buffered_hits(self):
+        HitCount.objects.filter(placement=self.placement).update(hits=2)
+        HitCount.objects.filter(placement=self.placements[0]).update(hits=1)
+        HitCount.objects.hit(self.placements[0])
+        HitCount.objects.hit(self.placements[0])
+        top = HitCount.objects.get_top_objects(2)
+        self.assert_equals([self.placements[0], self.placement], [hc.placement for hc in top])
+        self.assert_equals(3, top[0].hits)
+
+    def test_top_objects_do_not_modify_stored_ones(self):
+        stored = list(HitCount.objects.filter(placement__in=[self.placement, self.placements[0]]).order_by('-hits'))
+        HitCount.objects.get_stored_top_objects = lambda count, days=None, mods=[]: stored
+        try:
+            HitCount.objects.hit(self.placements[0])
+            HitCount.objects.get_top_objects(2)
+            top = HitCount.objects.get_top_objects(2)
+        finally:
+            del HitCount.objects.get_stored_top_objects
+        self.assert_equals(1, top[0].hits)
+        self.assert_equals([0, 0], [hc.hits for hc in stored])
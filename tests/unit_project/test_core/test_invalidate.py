@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import os
+from tempfile import mkstemp
+
+from djangosanetesting import UnitTestCase, DatabaseTestCase
+
+from django.core.management.base import CommandError
+
+from ella.core.cache.invalidate import CacheDeleter, InvalidationRegister, LocalTransport, \
+        FileQueueTransport, Transport, model_label, get_shard
+from ella.core.cache import storage
+from ella.core.management.commands.cacheinvalidator import Command
+from ella.core.cache.storage import MemoryStorage, SQLiteStorage
+from ella.core.models import Category, Publishable
+
+from unit_project.test_core import create_basic_categories, create_and_place_a_publishable
+from unit_project.test_core.test_cache import CacheTestCase
+from ella.core.cache import utils
+
+class CollectingTransport(Transport):
+    def __init__(self):
+        self.batches = []
+
+    def send(self, messages):
+        self.batches.append(messages)
+
+class TestCacheDeleter(DatabaseTestCase):
+    def setUp(self):
+        super(TestCacheDeleter, self).setUp()
+        create_basic_categories(self)
+        self.transport = CollectingTransport()
+        self.deleter = CacheDeleter(self.transport, batch_size=3)
+
+    def test_messages_are_sent_in_batches(self):
+        for i in range(4):
+            self.deleter.register_dependency('src', 'dst%d' % i)
+        self.assert_equals(1, len(self.transport.batches))
+        self.assert_equals(3, len(self.transport.batches[0]))
+        self.deleter.flush()
+        self.assert_equals(2, len(self.transport.batches))
+        self.assert_equals([{'type': 'dep', 'key': 'src', 'dst': 'dst3'}], self.transport.batches[1])
+
+    def test_pk_message_carries_only_model_label_and_pk(self):
+        self.deleter.register_pk(self.category, 'key')
+        self.deleter.flush()
+        self.assert_equals([{'type': 'pk', 'model': 'core.category', 'pk': self.category.pk, 'key': 'key'}], self.transport.batches[0])
+
+    def test_signal_is_propagated_for_parent_models(self):
+        create_and_place_a_publishable(self)
+        self.deleter.propagate_signal(self.publishable.__class__, self.publishable)
+        self.deleter.flush()
+        models = [m['model'] for m in self.transport.batches[0]]
+        self.assert_equals(['articles.article', 'core.publishable'], models)
+        self.assert_equals(unicode(self.category_nested.pk), self.transport.batches[0][0]['fields']['category_id'])
+
+class TestInvalidationRegister(CacheTestCase):
+    def setUp(self):
+        super(TestInvalidationRegister, self).setUp()
+        create_basic_categories(self)
+        self.deleter = CacheDeleter(LocalTransport(), batch_size=1)
+        utils.cache.set('key', 'value')
+        utils.cache.set('dependent', 'value')
+
+    def test_registered_pk_is_invalidated_on_save(self):
+        self.deleter.register_pk(self.category, 'key')
+        self.deleter.propagate_signal(Category, self.category)
+        self.assert_equals(None, utils.cache.get('key'))
+
+    def test_other_pk_doesnt_invalidate(self):
+        self.deleter.register_pk(self.category, 'key')
+        self.deleter.propagate_signal(Category, self.category_nested)
+        self.assert_equals('value', utils.cache.get('key'))
+
+    def test_matching_test_invalidates(self):
+        self.deleter.register_test(Category, 'tree_parent_id:%s' % self.category.pk, 'key')
+        self.deleter.propagate_signal(Category, self.category)
+        self.assert_equals('value', utils.cache.get('key'))
+        self.deleter.propagate_signal(Category, self.category_nested)
+        self.assert_equals(None, utils.cache.get('key'))
+
+    def test_dependencies_are_invalidated(self):
+        self.deleter.register_pk(self.category, 'key')
+        self.deleter.register_dependency('key', 'dependent')
+        self.deleter.propagate_signal(Category, self.category)
+        self.assert_equals(None, utils.cache.get('dependent'))
+
+class TestFileQueueTransport(UnitTestCase):
+    def setUp(self):
+        super(TestFileQueueTransport, self).setUp()
+        fd, self.path = mkstemp()
+        os.close(fd)
+        self.transport = FileQueueTransport(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(TestFileQueueTransport, self).tearDown()
+
+    def test_batches_are_received_in_order(self):
+        self.transport.send([{'type': 'dep', 'key': 'a', 'dst': 'b'}])
+        self.transport.send([{'type': 'dep', 'key': 'c', 'dst': 'd'}])
+        self.assert_equals(
+                [[{'type': 'dep', 'key': 'a', 'dst': 'b'}], [{'type': 'dep', 'key': 'c', 'dst': 'd'}]],
+                self.transport.receive()
+            )
+
+    def test_queue_is_emptied_by_receive(self):
+        self.transport.send([{'type': 'dep', 'key': 'a', 'dst': 'b'}])
+        self.transport.receive()
+        self.assert_equals([], self.transport.receive())
+
+class TestModelLabel(UnitTestCase):
+    def test_label_for_model_and_string(self):
+        self.assert_equals('core.publishable', model_label(Publishable))
+        self.assert_equals('core.publishable', model_label('core.publishable'))
+
+class StorageTestMixin(object):
+    def test_pks_are_popped(self):
+        self.storage.add_pk('core.category', u'1', 'key')
+        self.storage.add_pk('core.category', u'1', 'key')
+        self.storage.add_pk('core.category', u'1', 'other')
+        self.assert_equals(['key', 'other'], sorted(self.storage.pop_pk('core.category', u'1')))
+        self.assert_equals([], self.storage.pop_pk('core.category', u'1'))
+
+    def test_tests_are_found_by_first_term(self):
+        self.storage.add_test('core.category', 'tree_parent_id:1;site_id:1', 'key')
+        self.storage.add_test('core.category', 'tree_parent_id:2', 'other')
+        self.storage.add_test('core.category', '', 'all')
+        self.assert_equals(
+                [('all', ''), ('key', 'tree_parent_id:1;site_id:1')],
+                sorted(self.storage.get_tests('core.category', [u'', u'tree_parent_id:1']))
+            )
+
+    def test_removed_tests_are_not_found(self):
+        self.storage.add_test('core.category', 'tree_parent_id:1', 'key')
+        self.storage.remove_tests('core.category', 'key')
+        self.assert_equals([], self.storage.get_tests('core.category', [u'tree_parent_id:1']))
+
+    def test_dependencies_are_popped(self):
+        self.storage.add_dependency('src', 'dst')
+        self.assert_equals(['dst'], self.storage.pop_dependencies('src'))
+        self.assert_equals([], self.storage.pop_dependencies('src'))
+
+    def test_removed_keys_are_not_found(self):
+        self.storage.add_key('key')
+        self.assert_true(self.storage.has_key('key'))
+        self.storage.remove_key('key')
+        self.assert_false(self.storage.has_key('key'))
+
+class TestMemoryStorage(StorageTestMixin, UnitTestCase):
+    def setUp(self):
+        super(TestMemoryStorage, self).setUp()
+        self.storage = MemoryStorage()
+
+class TestSQLiteStorage(StorageTestMixin, UnitTestCase):
+    def setUp(self):
+        super(TestSQLiteStorage, self).setUp()
+        self.storage = SQLiteStorage(':memory:')
+
+class TestShardStorage(UnitTestCase):
+    def test_shards_use_own_cache_keys(self):
+        self.assert_not_equals(storage.get_storage(shard=0).register_key, storage.get_storage(shard=1).register_key)
+
+    def test_shards_use_own_database_files(self):
+        path = mkstemp(prefix="ella-ci-tests-")[1]
+        try:
+            self.assert_equals(path + '.1', storage.get_storage(path=path, shard=1).path)
+        finally:
+            os.remove(path)
+            os.remove(path + '.1')
+
+class TestTestTerm(UnitTestCase):
+    def test_first_term_is_normalized(self):
+        self.assert_equals(u'name:value', storage.get_test_term(' name : value ;other:1'))
+
+    def test_empty_test_has_empty_term(self):
+        self.assert_equals(u'', storage.get_test_term(''))
+
+class TestShardedRegister(CacheTestCase):
+    def setUp(self):
+        super(TestShardedRegister, self).setUp()
+        create_basic_categories(self)
+        utils.cache.set('key', 'value')
+        shard = get_shard(Category, 2)
+        self.own = InvalidationRegister(persistent=False, shard=(shard, 2))
+        self.other = InvalidationRegister(persistent=False, shard=(1 - shard, 2))
+        self.messages = [
+            {'type': 'pk', 'model': 'core.category', 'pk': self.category.pk, 'key': 'key'},
+            {'type': 'dep', 'key': 'key', 'dst': 'dependent'},
+        ]
+
+    def test_only_owning_shard_registers_model(self):
+        self.own.process(self.messages)
+        self.other.process(self.messages)
+        self.assert_equals(['key'], self.own.storage.pop_pk('core.category', unicode(self.category.pk)))
+        self.assert_equals([], self.other.storage.pop_pk('core.category', unicode(self.category.pk)))
+
+    def test_dependencies_are_kept_by_owning_shard_only(self):
+        self.own.process(self.messages)
+        self.other.process(self.messages)
+        self.assert_equals(['dependent'], self.own.storage.pop_dependencies('key'))
+        self.assert_equals([], self.other.storage.pop_dependencies('key'))
+
+    def test_dependencies_of_dependencies_are_kept(self):
+        self.own.process(self.messages + [{'type': 'dep', 'key': 'dependent', 'dst': 'page'}])
+        self.assert_equals(['page'], self.own.storage.pop_dependencies('dependent'))
+
+    def test_owning_shard_invalidates(self):
+        self.own.process(self.messages)
+        self.own.process([{'type': 'del', 'model': 'core.category', 'pk': self.category.pk, 'fields': {}}])
+        self.assert_equals(None, utils.cache.get('key'))
+
+class TestShardedInvalidatorCommand(UnitTestCase):
+    def test_shard_requires_broadcasting_transport(self):
+        self.assert_raises(CommandError, Command().handle, transport='ella.core.cache.invalidate.LocalTransport',
+                shard='0/2', storage=None, regenerate_threads=0)
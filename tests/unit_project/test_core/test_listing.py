@@ -3,10 +3,16 @@ from datetime import datetime, timedelta
 
 from djangosanetesting import DatabaseTestCase
 
-from ella.core.models import Listing, Category
+from django.conf import settings
+from django.db import connection
+
+from ella.core.models import Listing, Category, Author, prefetch_listings
+from ella.core.managers import get_listing_namespaces, encode_listing_cursor, decode_listing_cursor
+from ella.core.cache.utils import get_generations
 
 from unit_project.test_core import create_basic_categories, create_and_place_a_publishable, \
         create_and_place_more_publishables, list_all_placements_in_category_by_hour
+from unit_project.test_core.test_cache import CacheTestCase
 
 class TestListing(DatabaseTestCase):
 
@@ -134,3 +140,165 @@ class TestListing(DatabaseTestCase):
         l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, offset=2, count=2)
 
         self.assert_equals(expected, l)
+
+    def test_explicit_default_priority_is_listed(self):
+        l = self.listings[-1]
+        l.priority_value = 0
+        l.priority_from = datetime.now() - timedelta(days=1)
+        l.priority_to = datetime.now() + timedelta(days=1)
+        l.save()
+
+        l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL)
+
+        self.assert_equals(self.listings, l)
+
+    def test_explicit_default_priority_is_merged_with_default(self):
+        for l, value in zip(self.listings, (10, 0, None)):
+            if value is not None:
+                l.priority_value = value
+                l.priority_from = datetime.now() - timedelta(days=1)
+                l.priority_to = datetime.now() + timedelta(days=1)
+                l.save()
+
+        now = datetime.now()
+        qset = Listing.objects.get_listing_queryset(self.category, Listing.objects.ALL, now=now)
+        self.assert_equals(self.listings, Listing.objects.get_merged_listing(qset, now, 0, 3, set()))
+        self.assert_equals(self.listings, Listing.objects.get_ordered_listing(qset, now, 0, 3))
+
+    def test_unique_placements_are_skipped(self):
+        unique = set([self.listings[0].placement_id])
+        l = Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL, unique=unique)
+        self.assert_equals(self.listings[1:], l)
+
+    def test_ordered_and_merged_listings_are_equal(self):
+        for l, value in zip(self.listings, (-5, 10, 0, 5)):
+            l.priority_value = value
+            l.priority_from = datetime.now() - timedelta(days=1)
+            l.priority_to = datetime.now() + timedelta(days=1)
+            l.save()
+        Listing.objects.create(
+                placement=self.placements[0],
+                category=self.category_nested_second,
+                publish_from=datetime.now() - timedelta(days=2),
+            )
+
+        now = datetime.now()
+        qset = Listing.objects.get_listing_queryset(self.category, Listing.objects.ALL, now=now)
+        for offset in range(len(self.listings)):
+            self.assert_equals(
+                    Listing.objects.get_merged_listing(qset, now, offset, offset + 2, set()),
+                    Listing.objects.get_ordered_listing(qset, now, offset, offset + 2)
+                )
+
+class TestListingPrefetch(DatabaseTestCase):
+    def setUp(self):
+        super(TestListingPrefetch, self).setUp()
+        create_basic_categories(self)
+        create_and_place_more_publishables(self)
+        list_all_placements_in_category_by_hour(self)
+        self.author = Author.objects.create(name=u'Author', slug=u'author')
+        self.publishables[0].authors.add(self.author)
+
+    def count_queries(self, listings):
+        " Number of queries needed to render titles, categories and authors of the listings. "
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            start = len(connection.queries)
+            listings = prefetch_listings(list(Listing.objects.filter(pk__in=[l.pk for l in listings])))
+            for l in listings:
+                publishable = l.placement.publishable
+                publishable.target.title, publishable.category.title, publishable.photo, publishable.get_authors()
+                publishable.target.category.title, publishable.target.get_authors()
+            return len(connection.queries) - start
+        finally:
+            settings.DEBUG = debug
+
+    def test_query_count_doesnt_depend_on_number_of_listings(self):
+        self.assert_equals(self.count_queries(self.listings[:1]), self.count_queries(self.listings))
+
+    def test_authors_are_fetched_for_all_publishables(self):
+        listings = prefetch_listings(list(Listing.objects.filter(pk__in=[l.pk for l in self.listings])))
+        authors = dict((l.placement.publishable_id, l.placement.publishable.get_authors()) for l in listings)
+        self.assert_equals([self.author], authors[self.publishables[0].pk])
+        self.assert_equals([], authors[self.publishables[1].pk])
+
+class TestListingCacheInvalidation(CacheTestCase):
+    def setUp(self):
+        super(TestListingCacheInvalidation, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_placements_in_category_by_hour(self)
+
+    def get_generation(self, category):
+        return get_generations(get_listing_namespaces(category))[0]
+
+    def test_saving_listing_invalidates_listings_of_ancestors(self):
+        self.assert_equals(self.listings, Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL))
+        listing = Listing.objects.create(
+                placement=self.placements[0],
+                category=self.category_nested_second,
+                publish_from=datetime.now() - timedelta(days=2),
+            )
+        self.assert_equals(listing, Listing.objects.get_listing(category=self.category, children=Listing.objects.ALL)[0])
+
+    def test_saving_listing_doesnt_invalidate_listings_of_descendants(self):
+        generation = self.get_generation(self.category_nested_second)
+        Listing.objects.get(category=self.category).save()
+        self.assert_equals(generation, self.get_generation(self.category_nested_second))
+
+    def test_saving_listing_invalidates_listings_of_its_old_category(self):
+        generation = self.get_generation(self.category_nested_second)
+        listing = Listing.objects.get(category=self.category_nested_second)
+        listing.category = self.category
+        listing.save()
+        self.assert_not_equals(generation, self.get_generation(self.category_nested_second))
+
+    def test_saving_placement_invalidates_listings(self):
+        generation = self.get_generation(self.category_nested)
+        self.placement.save()
+        self.assert_not_equals(generation, self.get_generation(self.category_nested))
+
+class TestListingKeysetPagination(DatabaseTestCase):
+    def setUp(self):
+        super(TestListingKeysetPagination, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_placements_in_category_by_hour(self)
+
+    def test_cursor_roundtrip(self):
+        l = self.listings[0]
+        self.assert_equals((l.publish_from, l.pk), decode_listing_cursor(encode_listing_cursor(l)))
+
+    def test_invalid_cursor_raises_value_error(self):
+        self.assert_raises(ValueError, decode_listing_cursor, 'not a cursor')
+
+    def test_first_page_returns_newest_listings(self):
+        listings, cursor = Listing.objects.get_listing_after(category=self.category, children=Listing.objects.ALL, count=2)
+        self.assert_equals(self.listings[:2], listings)
+        self.assert_equals(encode_listing_cursor(self.listings[1]), cursor)
+
+    def test_pages_follow_cursor(self):
+        listings, cursor = Listing.objects.get_listing_after(category=self.category, children=Listing.objects.ALL, count=2)
+        listings, cursor = Listing.objects.get_listing_after(cursor=cursor, category=self.category, children=Listing.objects.ALL, count=2)
+        self.assert_equals(self.listings[2:], listings)
+        self.assert_equals(None, cursor)
+
+    def test_last_full_page_has_no_cursor(self):
+        listings, cursor = Listing.objects.get_listing_after(category=self.category, children=Listing.objects.ALL, count=len(self.listings))
+        self.assert_equals(self.listings, listings)
+        self.assert_equals(None, cursor)
+
+    def test_duplicate_placements_are_skipped_within_page(self):
+        Listing.objects.create(
+                placement=self.listings[1].placement,
+                category=self.category,
+                publish_from=self.listings[1].publish_from,
+            )
+        listings, cursor = Listing.objects.get_listing_after(category=self.category, children=Listing.objects.ALL, count=3)
+        self.assert_equals(3, len(set(l.placement_id for l in listings)))
+
+    def test_listing_count(self):
+        self.assert_equals(len(self.listings), Listing.objects.get_listing_count(category=self.category, children=Listing.objects.ALL))
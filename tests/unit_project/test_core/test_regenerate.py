@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from django import template
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.template import NodeList
+
+from ella.core import box
+from ella.core.box import Box
+from ella.core.cache import regenerate, utils
+from ella.core.cache.regenerate import BoxRegenerator, regenerate_box, get_recipe_key
+from ella.core.cache.invalidate import InvalidationRegister
+
+from unit_project import template_loader
+from unit_project.test_core.test_cache import CacheTestCase
+
+class TestBoxRegeneration(CacheTestCase):
+    def setUp(self):
+        super(TestBoxRegeneration, self).setUp()
+        self.old_box_cache, self.old_regenerate_cache = box.cache, regenerate.cache
+        box.cache = regenerate.cache = utils.cache
+        settings.BOX_REGENERATE_THREADS = 1
+        template_loader.templates['box/box.html'] = '{{ object }}:{{ box.params.level }}'
+
+        self.box = Box(Site.objects.get(pk=1), 'name', NodeList())
+        self.key = self.render()
+
+    def tearDown(self):
+        del settings.BOX_REGENERATE_THREADS
+        template_loader.templates = {}
+        box.cache, regenerate.cache = self.old_box_cache, self.old_regenerate_cache
+        super(TestBoxRegeneration, self).tearDown()
+
+    def render(self):
+        t = template.Template('{% box name for sites.site with pk 1 %}level: 2{% endbox %}')
+        self.assert_equals('example.com:2', t.render(template.Context()))
+        return utils.normalize_key('ella.core.box.Box.render:%d:Site:name:1:level:2' % settings.SITE_ID)
+
+    def test_recipe_is_stored_with_box(self):
+        recipe = utils.cache.get(get_recipe_key(self.key))
+        self.assert_equals('sites.site', recipe['model'])
+        self.assert_equals([('level', ['2'])], recipe['params'])
+
+    def test_deleted_box_is_rendered_again(self):
+        utils.cache.delete(self.key)
+        template_loader.templates['box/box.html'] = 'new {{ object }}:{{ box.params.level }}'
+        self.assert_true(regenerate_box(self.key))
+        self.assert_equals('new example.com:2', utils.cache.get(self.key))
+
+    def test_box_is_rendered_with_context_processors(self):
+        utils.cache.delete(self.key)
+        template_loader.templates['box/box.html'] = '{{ MEDIA_URL }}{{ object }}'
+        self.assert_true(regenerate_box(self.key))
+        self.assert_equals(settings.MEDIA_URL + 'example.com', utils.cache.get(self.key))
+
+    def test_cached_box_is_not_rendered_again(self):
+        self.assert_false(regenerate_box(self.key))
+
+    def test_box_without_recipe_is_skipped(self):
+        utils.cache.delete(self.key)
+        utils.cache.delete(get_recipe_key(self.key))
+        self.assert_false(regenerate_box(self.key))
+
+    def test_invalidated_keys_are_regenerated(self):
+        regenerator = BoxRegenerator(threads=0)
+        register = InvalidationRegister(persistent=False, regenerator=regenerator)
+        template_loader.templates['box/box.html'] = 'new {{ object }}'
+        register.invalidate('sites.site', self.key)
+        self.assert_equals(None, utils.cache.get(self.key))
+        regenerator.process_queue()
+        self.assert_equals('new example.com', utils.cache.get(self.key))
+
+class TestDependencyWalk(CacheTestCase):
+    def setUp(self):
+        super(TestDependencyWalk, self).setUp()
+        self.regenerator = BoxRegenerator(threads=0)
+        self.register = InvalidationRegister(persistent=False, regenerator=self.regenerator)
+        for key in ('child', 'parent', 'page'):
+            utils.cache.set(key, 'value')
+        self.register.register_dependency('child', 'parent')
+        self.register.register_dependency('parent', 'page')
+        self.register.register_dependency('page', 'child')
+
+    def test_all_dependent_keys_are_invalidated(self):
+        self.register.invalidate('sites.site', 'child')
+        self.assert_equals([None, None, None], [utils.cache.get(k) for k in ('child', 'parent', 'page')])
+
+    def test_keys_are_scheduled_once_in_order(self):
+        self.register.invalidate('sites.site', 'child')
+        self.register.invalidate('sites.site', 'child')
+        keys = []
+        while not self.regenerator.queue.empty():
+            keys.append(self.regenerator.queue.get())
+        self.assert_equals(['child', 'parent', 'page'], keys)
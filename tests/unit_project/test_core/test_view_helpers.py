@@ -6,6 +6,7 @@ from django.http import Http404
 from django.db.models import get_models
 from django.contrib.contenttypes.models import ContentType
 from django.template.defaultfilters import slugify
+from django.conf import settings
 
 from ella.core.views import ObjectDetail, get_content_type, ListContentType
 from ella.core.models import Listing, Publishable
@@ -178,3 +179,31 @@ class TestListContentType(ViewHelpersTestCase):
         self.assert_raises(Http404, self.list_content_type.get_context, self.request, '', '2008', '2', '3', 'not-a-content-type')
 
 
+
+class TestListContentTypeKeysetPagination(ViewHelpersTestCase):
+    def setUp(self):
+        super(TestListContentTypeKeysetPagination, self).setUp()
+        create_and_place_more_publishables(self)
+        list_all_placements_in_category_by_hour(self, category=self.category)
+        self.list_content_type = ListContentType()
+        settings.CATEGORY_LISTINGS_KEYSET_PAGINATION = True
+
+    def tearDown(self):
+        del settings.CATEGORY_LISTINGS_KEYSET_PAGINATION
+        super(TestListContentTypeKeysetPagination, self).tearDown()
+
+    def test_first_page_has_cursor_to_second(self):
+        c = self.list_content_type.get_context(self.request, '', '2008', paginate_by=2)
+        self.assert_equals(self.listings[:2], c['listings'])
+        self.assert_true(c['is_paginated'])
+        self.assert_not_equals(None, c['next_cursor'])
+
+    def test_second_page_is_reached_by_cursor(self):
+        c = self.list_content_type.get_context(self.request, '', '2008', paginate_by=2)
+        self.request.GET['c'] = c['next_cursor']
+        c = self.list_content_type.get_context(self.request, '', '2008', paginate_by=2)
+        self.assert_equals(self.listings[2:4], c['listings'])
+
+    def test_raises404_for_invalid_cursor(self):
+        self.request.GET['c'] = 'XXX'
+        self.assert_raises(Http404, self.list_content_type.get_context, self.request, '', '2008', paginate_by=2)
@@ -5,12 +5,14 @@ from tempfile import mkstemp
 
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.core.management import call_command
 from django.utils.translation import ugettext
 from djangosanetesting import DatabaseTestCase
 from django.contrib.sites.models import Site
 from PIL import Image
 
-from ella.photos.models import Photo, Format, FormatedPhoto
+from ella.photos.models import Photo, Format, FormatedPhoto, DerivedFile
+from ella.photos.generator import GENERATOR, PhotoGenerator
 
 from unit_project.test_photos.fixtures import create_photo_formats
 
@@ -45,6 +47,10 @@ class TestPhoto(DatabaseTestCase):
 
         self.thumbnail_path = self.photo.get_thumbnail_path()
 
+        # files generated by the test (formated photos, thumbnails) are removed in tearDown
+        self.photo_dir = os.path.dirname(self.photo.image.path)
+        self.existing_files = set(os.listdir(self.photo_dir)) - set([os.path.basename(self.photo.image.path)])
+
     def test_formatted_photo_has_zero_crop_box_if_smaller_than_format(self):
         format = Format.objects.create(
             name='sample',
@@ -135,8 +141,189 @@ class TestPhoto(DatabaseTestCase):
     def test_retrieving_ratio(self):
         self.assert_equals(2, self.photo.ratio())
 
+    def test_generated_file_is_stored_under_its_name(self):
+        fp = self.photo.get_formated_photo("basic")
+        self.assert_equals(fp.file(relative=True), fp.image.name)
+        self.assert_true(os.path.exists(fp.file()))
+
+    def set_async_generation(self):
+        settings.PHOTOS_ASYNC_GENERATION = True
+        self.old_processes, GENERATOR.processes = GENERATOR.processes, 0
+
+    def test_async_generation_returns_none_and_schedules_formated_photo(self):
+        self.set_async_generation()
+        try:
+            self.assert_equals(None, self.photo.get_formated_photo("basic"))
+        finally:
+            del settings.PHOTOS_ASYNC_GENERATION
+            GENERATOR.processes = self.old_processes
+        self.assert_equals(1, FormatedPhoto.objects.filter(photo=self.photo, format=self.basic_format).count())
+
+    def test_img_tag_renders_blank_image_while_generating(self):
+        from django import template
+        self.set_async_generation()
+        old_static_url, settings.STATIC_URL = settings.STATIC_URL, '/static/'
+        try:
+            t = template.Template('{% load photos %}{% img basic for photo as fp %}{{ fp.url }}')
+            self.assert_equals('/static/img/empty/basic.png', t.render(template.Context({'photo': self.photo})))
+        finally:
+            del settings.PHOTOS_ASYNC_GENERATION
+            GENERATOR.processes = self.old_processes
+            settings.STATIC_URL = old_static_url
+
+    def test_generator_creates_missing_formated_photos(self):
+        results = list(PhotoGenerator(0).generate([(self.photo.pk, self.basic_format.pk)] * 2))
+        self.assert_equals([True, False], [ok for job, ok in results])
+        self.assert_equals(1, self.photo.formatedphoto_set.count())
+
+    def test_generate_all_formats_creates_missing_formated_photos(self):
+        big_format = Format.objects.create(name='big', max_width=100, max_height=100, flexible_height=False, stretch=False, nocrop=False, resample_quality=85)
+        self.photo.get_formated_photo("basic")
+        created = self.photo.generate_all_formats()
+        self.assert_equals([big_format], [fp.format for fp in created])
+        self.assert_equals((100, 100), (created[0].width, created[0].height))
+        self.assert_true(os.path.exists(created[0].file()))
+        self.assert_equals([], self.photo.generate_all_formats())
+
+    def test_generate_all_formats_only_for_given_sites(self):
+        Format.objects.create(name='big', max_width=100, max_height=100, flexible_height=False, stretch=False, nocrop=False, resample_quality=85)
+        created = self.photo.generate_all_formats(sites=[settings.SITE_ID])
+        self.assert_equals([self.basic_format], [fp.format for fp in created])
+
+    def test_generator_creates_all_formats_of_photo(self):
+        results = list(PhotoGenerator(0).generate_photos([(self.photo.pk, [self.basic_format.pk])] * 2))
+        self.assert_equals([1, 0], [count for job, count in results])
+
+    def test_generated_file_is_listed_in_manifest(self):
+        settings.PHOTOS_USE_MANIFEST = True
+        try:
+            fp = self.photo.get_formated_photo("basic")
+            self.assert_true(DerivedFile.objects.exists(fp.image.name))
+            fp.delete()
+            self.assert_false(DerivedFile.objects.exists(fp.image.name))
+        finally:
+            del settings.PHOTOS_USE_MANIFEST
+
+    def test_manifest_is_not_written_when_unused(self):
+        self.photo.get_formated_photo("basic")
+        self.photo.thumb_url()
+        self.assert_equals(0, DerivedFile.objects.count())
+
+    def test_renamed_file_is_removed_with_formated_photo(self):
+        settings.PHOTOS_USE_MANIFEST = True
+        try:
+            fp = FormatedPhoto(photo=self.photo, format=self.basic_format)
+            open(fp.file(), 'w').close()
+            fp.generate()
+            self.assert_not_equals(fp.file(relative=True), fp.image.name)
+            fp.delete()
+            self.assert_false(fp.image.storage.exists(fp.image.name))
+            self.assert_false(DerivedFile.objects.exists(fp.image.name))
+        finally:
+            del settings.PHOTOS_USE_MANIFEST
+
+    def test_url_is_resolved_from_manifest(self):
+        settings.PHOTOS_USE_MANIFEST = settings.PHOTOS_DO_URL_CHECK = True
+        old_static_url, settings.STATIC_URL = settings.STATIC_URL, '/static/'
+        try:
+            fp = self.photo.get_formated_photo("basic")
+            self.assert_equals(fp.image.url, fp.url)
+            DerivedFile.objects.filter(name=fp.image.name).delete()
+            self.assert_equals('/static/img/empty/basic.png', fp.url)
+        finally:
+            del settings.PHOTOS_USE_MANIFEST, settings.PHOTOS_DO_URL_CHECK
+            settings.STATIC_URL = old_static_url
+
+    def test_thumbnail_is_listed_in_manifest(self):
+        settings.PHOTOS_USE_MANIFEST = True
+        try:
+            self.photo.thumb_url()
+            self.assert_true(DerivedFile.objects.exists(self.thumbnail_path))
+            self.photo.delete_thumbnail()
+            self.assert_false(DerivedFile.objects.exists(self.thumbnail_path))
+        finally:
+            del settings.PHOTOS_USE_MANIFEST
+
+    def test_reconciliation_restores_manifest(self):
+        fp = self.photo.get_formated_photo("basic")
+        self.photo.thumb_url()
+        DerivedFile.objects.all().delete()
+        call_command('check_photo_files_consistence', reconcile=True, verbosity=0)
+        self.assert_equals(
+            sorted([fp.image.name, self.thumbnail_path]),
+            sorted(DerivedFile.objects.filter(photo=self.photo).values_list('name', flat=True))
+        )
+
+    def test_scan_regenerates_missing_formated_photo(self):
+        fp = self.photo.get_formated_photo("basic")
+        os.remove(fp.file())
+        call_command('check_photo_files_consistence', scan=True, regenerate=True, verbosity=0)
+        self.assert_true(os.path.exists(fp.file()))
+
+    def test_scan_deletes_orphaned_formated_photo(self):
+        fp = self.photo.get_formated_photo("basic")
+        os.remove(fp.file())
+        call_command('check_photo_files_consistence', scan=True, delete_orphans=True, verbosity=0)
+        self.assert_equals(0, self.photo.formatedphoto_set.count())
+
+    def test_scan_resumes_from_checkpoint(self):
+        fp = self.photo.get_formated_photo("basic")
+        os.remove(fp.file())
+        checkpoint = mkstemp(prefix="ella-photo-tests-")[1]
+        f = open(checkpoint, 'w')
+        f.write('{"last_pk": %d}' % self.photo.pk)
+        f.close()
+        call_command('check_photo_files_consistence', scan=True, delete_orphans=True, checkpoint=checkpoint, verbosity=0)
+        self.assert_equals(1, self.photo.formatedphoto_set.count())
+        self.assert_false(os.path.exists(checkpoint))
+
+    def recrop(self, fp):
+        fp.crop_left, fp.crop_top, fp.crop_width, fp.crop_height = 10, 10, 50, 50
+        fp.save()
+        return fp
+
+    def test_content_addressed_file_changes_name_with_crop(self):
+        settings.PHOTOS_CONTENT_ADDRESSED_FILES = True
+        try:
+            fp = self.photo.get_formated_photo("basic")
+            old_name = fp.image.name
+            self.assert_equals(fp.file(relative=True), old_name)
+            self.recrop(fp)
+        finally:
+            del settings.PHOTOS_CONTENT_ADDRESSED_FILES
+        self.assert_not_equals(old_name, fp.image.name)
+        self.assert_true(fp.image.storage.exists(old_name))
+        self.assert_true(fp.image.storage.exists(fp.image.name))
+
+    def test_sweeper_deletes_superseded_files(self):
+        settings.PHOTOS_CONTENT_ADDRESSED_FILES = True
+        try:
+            fp = self.photo.get_formated_photo("basic")
+            old_name = fp.image.name
+            self.recrop(fp)
+        finally:
+            del settings.PHOTOS_CONTENT_ADDRESSED_FILES
+        call_command('sweep_formated_photos', verbosity=0)
+        self.assert_false(fp.image.storage.exists(old_name))
+        self.assert_false(DerivedFile.objects.exists(old_name))
+        self.assert_true(fp.image.storage.exists(fp.image.name))
+
+    def test_sweeper_deletes_files_of_deleted_photo(self):
+        settings.PHOTOS_CONTENT_ADDRESSED_FILES = True
+        try:
+            fp = self.photo.get_formated_photo("basic")
+            self.photo.delete()
+        finally:
+            del settings.PHOTOS_CONTENT_ADDRESSED_FILES
+        self.assert_true(DerivedFile.objects.exists(fp.image.name))
+        call_command('sweep_formated_photos', verbosity=0)
+        self.assert_false(fp.image.storage.exists(fp.image.name))
+        self.assert_equals(0, DerivedFile.objects.count())
+
     def tearDown(self):
         os.remove(self.image_file_name)
         if self.photo.pk:
             self.photo.delete()
+        for name in set(os.listdir(self.photo_dir)) - self.existing_files:
+            os.remove(os.path.join(self.photo_dir, name))
         super(TestPhoto, self).tearDown()
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 from djangosanetesting import UnitTestCase
 
+import os
+import struct
+from StringIO import StringIO
+from tempfile import mkstemp
+
 from PIL import Image
 
 from ella.photos.models import Format
-from ella.photos.formatter import Formatter
+from ella.photos.formatter import Formatter, MultiFormatter, probe_image
 
 class TestPhotoResize(UnitTestCase):
 
@@ -131,3 +136,96 @@ class TestPhotoResize(UnitTestCase):
         self.assert_equals((100, 100), i.size)
         self.assert_equals((0,0,0), i.getpixel((0,0)))
 
+
+def open_jpeg(size):
+    f = StringIO()
+    Image.new('RGB', size, "black").save(f, 'JPEG')
+    f.seek(0)
+    return Image.open(f)
+
+class TestJpegDraft(UnitTestCase):
+    def setUp(self):
+        super(TestJpegDraft, self).setUp()
+        self.format = Format(max_height=100, max_width=100)
+
+    def test_big_jpeg_is_decoded_in_reduced_size(self):
+        f = Formatter(open_jpeg((800, 1600)), self.format)
+        self.assert_equals(8, f.draft())
+        self.assert_equals((100, 200), f.image.size)
+
+    def test_crop_box_is_in_original_coordinates(self):
+        f = Formatter(open_jpeg((800, 1600)), self.format)
+        i, crop_box = f.format()
+        self.assert_equals((0, 400, 800, 1200), crop_box)
+        self.assert_equals((100, 100), i.size)
+
+    def test_small_jpeg_is_not_drafted(self):
+        f = Formatter(open_jpeg((150, 150)), self.format)
+        self.assert_equals(1, f.draft())
+        self.assert_equals((150, 150), f.image.size)
+
+class TestMultiFormatter(UnitTestCase):
+    def setUp(self):
+        super(TestMultiFormatter, self).setUp()
+        self.formats = [
+            Format(pk=1, max_height=100, max_width=100),
+            Format(pk=2, max_height=400, max_width=400),
+            Format(pk=3, max_height=20, max_width=40),
+        ]
+
+    def test_results_match_single_formatter(self):
+        results = list(MultiFormatter(open_jpeg((800, 1600)), self.formats).format())
+        for fmt, i, crop_box in results:
+            single, single_crop_box = Formatter(open_jpeg((800, 1600)), fmt).format()
+            self.assert_equals(single.size, i.size)
+            self.assert_equals(single_crop_box, crop_box)
+
+    def test_biggest_format_goes_first(self):
+        results = list(MultiFormatter(open_jpeg((800, 1600)), self.formats).format())
+        self.assert_equals([2, 1, 3], [fmt.pk for fmt, i, crop_box in results])
+
+    def test_source_is_decoded_once_for_the_biggest_format(self):
+        source = open_jpeg((800, 1600))
+        list(MultiFormatter(source, self.formats).format())
+        self.assert_equals((400, 800), source.size)
+
+    def test_explicit_crop_box_is_used(self):
+        results = list(MultiFormatter(open_jpeg((800, 1600)), self.formats[:1], crop_boxes={1: (0, 0, 400, 400)}).format())
+        self.assert_equals([(0, 0, 400, 400)], [crop_box for fmt, i, crop_box in results])
+
+class TestProbeImage(UnitTestCase):
+    def setUp(self):
+        super(TestProbeImage, self).setUp()
+        self.file_name = mkstemp(prefix="ella-photo-tests-")[1]
+
+    def tearDown(self):
+        os.remove(self.file_name)
+        super(TestProbeImage, self).tearDown()
+
+    def probe(self, format, size=(30, 20)):
+        Image.new('RGB', size, "black").save(self.file_name, format)
+        info = probe_image(self.file_name)
+        return info.format, info.size
+
+    def test_jpeg(self):
+        self.assert_equals(('JPEG', (30, 20)), self.probe('JPEG'))
+
+    def test_png(self):
+        self.assert_equals(('PNG', (30, 20)), self.probe('PNG'))
+
+    def test_gif(self):
+        self.assert_equals(('GIF', (30, 20)), self.probe('GIF'))
+
+    def test_jpeg_with_exif_segment(self):
+        f = StringIO()
+        Image.new('RGB', (30, 20), "black").save(f, 'JPEG')
+        # little endian TIFF header with single IFD0 entry: orientation 6
+        tiff = 'II*\x00' + struct.pack('<I', 8) + struct.pack('<H', 1) + struct.pack('<HHIHH', 0x0112, 3, 1, 6, 0) + struct.pack('<I', 0)
+        app1 = '\xff\xe1' + struct.pack('>H', len(tiff) + 8) + 'Exif\x00\x00' + tiff
+        data = f.getvalue()
+        open(self.file_name, 'wb').write(data[:2] + app1 + data[2:])
+        info = probe_image(self.file_name)
+        self.assert_equals((30, 20), info.size)
+
+    def test_missing_file(self):
+        self.assert_equals(None, probe_image(self.file_name + '-missing'))
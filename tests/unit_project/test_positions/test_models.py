@@ -2,7 +2,7 @@
 from datetime import datetime, timedelta
 from djangosanetesting import DatabaseTestCase
 
-from django.template import Context, NodeList
+from django.template import Context, NodeList, Template
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Max
 
@@ -95,3 +95,21 @@ class TestPosition(DatabaseTestCase):
         p = Position.objects.create(category=self.category, name='position-name', text='{% load nonexistent_tags %}', disabled=False)
         self.assert_equals('', p.render(Context({}), NodeList(), ''))
 
+    def test_page_positions_resolve_fallback_per_name(self):
+        top = Position.objects.create(category=self.category, name='top', text='root top')
+        own = Position.objects.create(category=self.category_nested, name='left', text='nested left')
+        Position.objects.create(category=self.category, name='left', text='root left')
+        positions = Position.objects.get_page_positions(self.category_nested)
+        self.assert_equals((top, own), (positions.get('top'), positions.get('left')))
+        self.assert_raises(Position.DoesNotExist, positions.get, 'top', nofallback=True)
+
+    def test_page_positions_respect_activity_at_resolution_time(self):
+        p = Position.objects.create(category=self.category, name='position-name', text='some text', active_from=datetime.now()+timedelta(days=1))
+        positions = Position.objects.get_page_positions(self.category)
+        self.assert_raises(Position.DoesNotExist, positions.get, 'position-name')
+        self.assert_equals(p, positions.get('position-name', now=datetime.now()+timedelta(days=2)))
+
+    def test_position_tags_use_page_positions(self):
+        Position.objects.create(category=self.category, name='top', text='root top')
+        t = Template('{% load positions %}{% position top for category %}{% endposition %}|{% ifposition left top for category %}yes{% else %}no{% endifposition %}|{% ifposition left for category %}yes{% else %}no{% endifposition %}')
+        self.assert_equals('root top|yes|no', t.render(Context({'category': self.category_nested})))
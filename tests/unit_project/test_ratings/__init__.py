@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+from ella.ratings.models import Rating
+
+def create_rated_objects(case, count=3):
+    """
+    Create users to be rated (any model can be rated).
+    """
+    case.objects = [User.objects.create(username='rated-%d' % i) for i in range(count)]
+    case.ct = ContentType.objects.get_for_model(User)
+
+def rate(case, obj, amount, ip_address=None, user=None, age=None):
+    """
+    Create rating of ``obj`` ``age`` (timedelta) old, 1 second by default.
+    """
+    case.ip_counter = getattr(case, 'ip_counter', 0) + 1
+    r = Rating(
+        target_ct=case.ct,
+        target_id=obj.pk,
+        amount=Decimal(str(amount)),
+        user=user,
+        ip_address=ip_address or '10.0.0.%d' % case.ip_counter,
+        time=datetime.now() - (age or timedelta(seconds=1))
+    )
+    r.save()
+    return r
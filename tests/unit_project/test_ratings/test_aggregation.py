@@ -0,0 +1,98 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from djangosanetesting import DatabaseTestCase, DestructiveDatabaseTestCase
+
+from django.core.cache import get_cache
+
+from ella.ratings import models
+from ella.ratings.models import Rating, Agg, TotalRate, Watermark, RATINGS_WATERMARK
+from ella.ratings.aggregation import transfer_new_ratings, get_time_coeficient
+
+from unit_project.test_ratings import create_rated_objects, rate
+
+class TestIncrementalAggregation(DestructiveDatabaseTestCase):
+    def setUp(self):
+        super(TestIncrementalAggregation, self).setUp()
+        create_rated_objects(self)
+
+    def test_time_coeficient_matches_sql_function(self):
+        self.assert_equals([Decimal('1.10'), Decimal('0.60'), Decimal('0.35'), Decimal('0.10')],
+            [get_time_coeficient(d) for d in (0, 50, 100, 300)])
+
+    def test_ratings_are_moved_to_total_rate(self):
+        obj = self.objects[0]
+        rate(self, obj, 1)
+        rate(self, obj, 2)
+        before = TotalRate.objects.get_total_rating(obj)
+
+        self.assert_equals(2, transfer_new_ratings(lag=0))
+        self.assert_equals(Decimal('3.30'), TotalRate.objects.get(target_id=obj.pk).amount)
+        self.assert_equals([(2, Decimal('3'))], list(Agg.objects.values_list('people', 'amount')))
+        self.assert_equals(before, TotalRate.objects.get_total_rating(obj))
+
+    def test_running_again_changes_nothing(self):
+        rate(self, self.objects[0], 1)
+        transfer_new_ratings(lag=0)
+        self.assert_equals(0, transfer_new_ratings(lag=0))
+        self.assert_equals(Decimal('1.10'), TotalRate.objects.get(target_id=self.objects[0].pk).amount)
+
+    def test_restart_continues_after_last_chunk(self):
+        for obj in self.objects:
+            rate(self, obj, 1)
+        # first run "interrupted" after one chunk
+        rating = Rating.objects.order_by('pk')[0]
+        Watermark.objects.advance(RATINGS_WATERMARK, 0, rating.pk)
+        TotalRate.objects.create(target_ct=self.ct, target_id=rating.target_id, amount=Decimal('1.10'))
+
+        self.assert_equals(2, transfer_new_ratings(chunk=1, lag=0))
+        self.assert_equals([Decimal('1.10')] * 3, [TotalRate.objects.get(target_id=o.pk).amount for o in self.objects])
+
+    def test_new_ratings_are_added_to_existing_totals(self):
+        obj = self.objects[0]
+        rate(self, obj, 1)
+        transfer_new_ratings(lag=0)
+        rate(self, obj, -2)
+        transfer_new_ratings(lag=0)
+        self.assert_equals(Decimal('-1.10'), TotalRate.objects.get(target_id=obj.pk).amount)
+        self.assert_equals(1, TotalRate.objects.count())
+
+    def test_recent_ratings_are_left_for_next_run(self):
+        obj = self.objects[0]
+        old = rate(self, obj, 1, age=timedelta(minutes=2))
+        rate(self, obj, 1)
+        rate(self, obj, 1, age=timedelta(minutes=2))
+
+        self.assert_equals(1, transfer_new_ratings(lag=60))
+        self.assert_equals(old.pk, Watermark.objects.get_stored_value(RATINGS_WATERMARK))
+        self.assert_equals(Decimal('3.3'), TotalRate.objects.get_total_rating(obj))
+
+    def test_watermark_cache_is_updated_after_run(self):
+        rating = rate(self, self.objects[0], 1)
+        transfer_new_ratings(lag=0)
+        self.assert_equals(rating.pk, Watermark.objects.get_value(RATINGS_WATERMARK))
+
+class TestWatermark(DatabaseTestCase):
+    def setUp(self):
+        super(TestWatermark, self).setUp()
+        self.old_cache = models.cache
+        models.cache = get_cache('locmem://')
+        models.cache.clear()
+
+    def tearDown(self):
+        models.cache = self.old_cache
+        super(TestWatermark, self).tearDown()
+
+    def test_advance_only_moves_from_expected_value(self):
+        self.assert_true(Watermark.objects.advance('test', 0, 10))
+        self.assert_false(Watermark.objects.advance('test', 0, 20))
+        self.assert_equals(10, Watermark.objects.get_stored_value('test'))
+
+    def test_reader_doesnt_overwrite_published_value(self):
+        Watermark.objects.set_cache('test', 10)
+        # the database still holds the old value for readers that missed the cache
+        self.assert_equals(10, Watermark.objects.get_value('test'))
+        models.cache.delete(models.KEY_WATERMARK % 'test')
+        self.assert_equals(0, Watermark.objects.get_value('test'))
+        Watermark.objects.set_cache('test', 10)
+        self.assert_equals(10, Watermark.objects.get_value('test'))
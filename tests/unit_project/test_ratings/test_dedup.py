@@ -0,0 +1,90 @@
+from decimal import Decimal
+
+from djangosanetesting import DatabaseTestCase, UnitTestCase
+
+from django.core.cache import get_cache
+from django.contrib.auth.models import User
+from django.utils.importlib import import_module
+
+from ella.ratings import models
+from ella.ratings.models import Rating
+
+from unit_project.test_ratings import create_rated_objects, rate
+
+class RatingsCacheTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(RatingsCacheTestCase, self).setUp()
+        self.old_cache = models.cache
+        models.cache = get_cache('locmem://')
+        models.cache.clear()
+        create_rated_objects(self, 2)
+        self.user = User.objects.create(username='rater')
+
+    def tearDown(self):
+        models.cache = self.old_cache
+        super(RatingsCacheTestCase, self).tearDown()
+
+    def new_rating(self, obj, **kwargs):
+        return Rating(target_ct=self.ct, target_id=obj.pk, amount=Decimal(1), **kwargs)
+
+class TestDuplicateRatings(RatingsCacheTestCase):
+    def test_second_rating_of_user_is_duplicate(self):
+        self.assert_false(self.new_rating(self.objects[0], user=self.user).is_duplicate())
+        self.assert_true(self.new_rating(self.objects[0], user=self.user).is_duplicate())
+        self.assert_false(self.new_rating(self.objects[1], user=self.user).is_duplicate())
+
+    def test_anonymous_ratings_are_told_apart_by_ip(self):
+        self.assert_false(self.new_rating(self.objects[0], ip_address='1.2.3.4').is_duplicate())
+        self.assert_true(self.new_rating(self.objects[0], ip_address='1.2.3.4').is_duplicate())
+        self.assert_false(self.new_rating(self.objects[0], ip_address='1.2.3.5').is_duplicate())
+
+    def test_anonymous_rating_forgotten_by_cache_is_duplicate(self):
+        rate(self, self.objects[0], 1, ip_address='1.2.3.4')
+        models.cache.clear()
+        self.assert_true(self.new_rating(self.objects[0], ip_address='1.2.3.4').is_duplicate())
+
+    def test_save_skips_duplicates(self):
+        rate(self, self.objects[0], 1, ip_address='1.2.3.4')
+        rate(self, self.objects[0], 1, ip_address='1.2.3.4')
+        self.assert_equals(1, Rating.objects.count())
+
+    def test_unique_constraint_stops_duplicates_the_cache_forgot(self):
+        rate(self, self.objects[0], 1, user=self.user)
+        models.cache.clear()
+        rate(self, self.objects[0], 1, user=self.user)
+        self.assert_equals(1, Rating.objects.filter(user=self.user).count())
+
+class TestBulkInsert(RatingsCacheTestCase):
+    def test_ratings_are_inserted(self):
+        Rating.objects.bulk_insert([self.new_rating(o, ip_address='1.2.3.4') for o in self.objects])
+        self.assert_equals(2, Rating.objects.count())
+
+    def test_existing_and_repeated_user_ratings_are_skipped(self):
+        rate(self, self.objects[0], 1, user=self.user)
+        Rating.objects.bulk_insert([
+                self.new_rating(self.objects[0], user=self.user),
+                self.new_rating(self.objects[1], user=self.user),
+                self.new_rating(self.objects[1], user=self.user),
+            ])
+        self.assert_equals([self.objects[0].pk, self.objects[1].pk], sorted(Rating.objects.values_list('target_id', flat=True)))
+
+    def test_buffered_ratings_are_written_on_flush(self):
+        old_interval, models.RATINGS_FLUSH_INTERVAL = models.RATINGS_FLUSH_INTERVAL, 60
+        try:
+            Rating.objects.add(self.new_rating(self.objects[0], ip_address='1.2.3.4'))
+            Rating.objects.add(self.new_rating(self.objects[0], ip_address='1.2.3.4'))
+            self.assert_equals(0, Rating.objects.count())
+            Rating.objects.flush_ratings()
+        finally:
+            models.RATINGS_FLUSH_INTERVAL = old_interval
+        self.assert_equals(1, Rating.objects.count())
+
+    def test_remove_duplicates_keeps_unique_ratings(self):
+        rate(self, self.objects[0], 1, user=self.user)
+        self.assert_equals(0, Rating.objects.remove_duplicates())
+        self.assert_equals(1, Rating.objects.count())
+
+class TestMigrations(UnitTestCase):
+    def test_migrations_can_be_imported(self):
+        for name in ('0002_add_watermark', '0003_add_toprated', '0004_rating_unique_user'):
+            self.assert_true(hasattr(import_module('ella.ratings.migrations.%s' % name).Migration, 'forwards'))
@@ -0,0 +1,104 @@
+from datetime import date, timedelta
+from decimal import Decimal
+
+from djangosanetesting import DatabaseTestCase, DestructiveDatabaseTestCase, UnitTestCase
+
+from django.conf import settings
+from django.db import connection
+
+from ella.ratings.models import TotalRate, TopRated, Agg, RatingPercentiles
+
+from unit_project.test_ratings import create_rated_objects, rate
+
+class TestRatingPercentiles(UnitTestCase):
+    def test_percentile_is_exact_for_small_tables(self):
+        p = RatingPercentiles([Decimal(i) for i in (1, 2, 3, 4, -1, -2)])
+        self.assert_equals([Decimal('0.25'), Decimal('0.5'), Decimal('1.0')], [p.get_percentile(a) for a in (1, 2, 4)])
+        self.assert_equals([Decimal('0.5'), Decimal('1.0')], [p.get_percentile(a) for a in (-1, -5)])
+
+    def test_sampled_points_keep_percentiles(self):
+        p = RatingPercentiles([Decimal(i) for i in range(1, 101)], points=10)
+        self.assert_equals(10, len(p.positive))
+        self.assert_equals(100, p.positive_count)
+        self.assert_equals(Decimal('0.5'), p.get_percentile(50))
+
+    def test_data_roundtrip(self):
+        p = RatingPercentiles.from_data(RatingPercentiles([Decimal(1), Decimal(-3)]).get_data())
+        self.assert_equals((1, 1), (p.positive_count, p.negative_count))
+        self.assert_equals(Decimal('1.0'), p.get_percentile(-3))
+
+    def test_normalize_rounds_to_step(self):
+        p = RatingPercentiles([Decimal(i) for i in (1, 2, 3, 4)])
+        self.assert_equals(Decimal('0.5'), p.normalize(Decimal(2), Decimal(1), Decimal('0.5')))
+        self.assert_equals(Decimal('0'), p.normalize(Decimal(0), Decimal(1)))
+
+    def test_no_amounts_normalize_to_zero(self):
+        self.assert_equals(Decimal(0), RatingPercentiles().normalize(Decimal(1), Decimal(1)))
+
+class TestNormalizedRating(DatabaseTestCase):
+    def setUp(self):
+        super(TestNormalizedRating, self).setUp()
+        create_rated_objects(self, 4)
+        for obj, amount in zip(self.objects, ('1', '2', '-1', '-3')):
+            TotalRate.objects.create(target=obj, amount=Decimal(amount))
+
+    def test_best_object_gets_max(self):
+        self.assert_equals(Decimal(2), TotalRate.objects.get_normalized_rating(self.objects[1], Decimal(2), Decimal(1)))
+
+    def test_negative_ratings_are_normalized_separately(self):
+        self.assert_equals(Decimal('-0.5'), TotalRate.objects.get_normalized_rating(self.objects[2], Decimal(1), Decimal('0.5')))
+        self.assert_equals(Decimal('-1.0'), TotalRate.objects.get_normalized_rating(self.objects[3], Decimal(1), Decimal('0.5')))
+
+class TestBatchRatings(DatabaseTestCase):
+    def setUp(self):
+        super(TestBatchRatings, self).setUp()
+        create_rated_objects(self, 3)
+        TotalRate.objects.create(target=self.objects[0], amount=Decimal('2'))
+        rate(self, self.objects[0], 1)
+        rate(self, self.objects[1], -1)
+
+    def test_total_ratings_match_single_lookups(self):
+        expected = dict((o, TotalRate.objects.get_total_rating(o)) for o in self.objects)
+        self.assert_equals(expected, TotalRate.objects.get_total_ratings(self.objects))
+
+    def test_normalized_ratings_match_single_lookups(self):
+        expected = dict((o, TotalRate.objects.get_normalized_rating(o, Decimal(1), Decimal('0.5'))) for o in self.objects)
+        self.assert_equals(expected, TotalRate.objects.get_normalized_ratings(self.objects, Decimal(1), Decimal('0.5')))
+
+    def test_one_query_per_content_type(self):
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            start = len(connection.queries)
+            TotalRate.objects.get_total_ratings(self.objects)
+            # the watermark (not cached in tests) and the ratings
+            self.assert_equals(2, len(connection.queries) - start)
+        finally:
+            settings.DEBUG = debug
+
+class TestLeaderboard(DestructiveDatabaseTestCase):
+    def setUp(self):
+        super(TestLeaderboard, self).setUp()
+        create_rated_objects(self, 3)
+        self.today = date.today()
+        # object 0 was rated a lot 20 days ago, object 1 a little today, object 2 only negatively
+        for obj, days, amount in ((self.objects[0], 20, 10), (self.objects[1], 0, 2), (self.objects[2], 0, -1)):
+            Agg.objects.create(target=obj, time=self.today - timedelta(days=days), people=1, amount=Decimal(amount), period='d')
+            TotalRate.objects.create(target=obj, amount=Decimal(amount))
+        TopRated.objects.rebuild(self.ct.pk, self.today)
+
+    def test_all_time_leaders(self):
+        self.assert_equals([(self.objects[0], Decimal('10.0')), (self.objects[1], Decimal('2.0'))], TotalRate.objects.get_top_objects(5))
+
+    def test_periods_only_count_their_days(self):
+        self.assert_equals([self.objects[1]], [o for o, amount in TopRated.objects.get_top_objects(5, period='w')])
+        self.assert_equals(self.objects[:2], [o for o, amount in TopRated.objects.get_top_objects(5, period='m')])
+
+    def test_count_and_models_limit_the_result(self):
+        self.assert_equals([self.objects[0]], [o for o, amount in TopRated.objects.get_top_objects(1)])
+        self.assert_equals([], TopRated.objects.get_top_objects(5, [TotalRate]))
+
+    def test_rebuild_replaces_leaderboard(self):
+        TotalRate.objects.filter(target_id=self.objects[0].pk).delete()
+        TopRated.objects.rebuild(self.ct.pk, self.today)
+        self.assert_equals([self.objects[1]], [o for o, amount in TopRated.objects.get_top_objects(5)])
@@ -0,0 +1,43 @@
+from decimal import Decimal
+
+from djangosanetesting import DatabaseTestCase
+
+from django import template
+from django.conf import settings
+from django.db import connection
+
+from ella.ratings.models import TotalRate
+
+from unit_project.test_ratings import create_rated_objects
+
+class TestRatingsForTag(DatabaseTestCase):
+    def setUp(self):
+        super(TestRatingsForTag, self).setUp()
+        create_rated_objects(self, 3)
+        for obj, amount in zip(self.objects, ('1', '2', '-1')):
+            TotalRate.objects.create(target=obj, amount=Decimal(amount))
+
+    def render(self, tpl):
+        return template.Template('{% load ratings %}' + tpl).render(template.Context({'objects': self.objects}))
+
+    def count_queries(self, tpl):
+        t = template.Template('{% load ratings %}' + tpl)
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            start = len(connection.queries)
+            out = t.render(template.Context({'objects': self.objects}))
+            return out, len(connection.queries) - start
+        finally:
+            settings.DEBUG = debug
+
+    def test_ratings_are_stored_by_object(self):
+        self.assert_equals('2.0', self.render('{% ratings_for objects as r %}{% for k, v in r.items %}{% ifequal k objects.1 %}{{ v }}{% endifequal %}{% endfor %}'))
+
+    def test_rating_tags_use_prefetched_ratings(self):
+        tpl = '{% ratings_for objects max 1 step 0.5 as r %}{% for o in objects %}{% rating for o max 1 step 0.5 as v %}{{ v }} {% endfor %}'
+        # watermark, ratings and percentiles, no query per object
+        self.assert_equals(('0.5 1.0 -1.0 ', 3), self.count_queries(tpl))
+
+    def test_wrong_syntax_raises_error(self):
+        self.assert_raises(template.TemplateSyntaxError, self.render, '{% ratings_for objects %}')